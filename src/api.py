@@ -1,19 +1,102 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 """SM2T API"""
+import gc
+import gzip
+import hashlib
+import json
+import math
 import os
+from contextlib import nullcontext
 
 from flask import Flask
 from flask_restful import Api, Resource
 from io import BytesIO
-from flask import send_file
-from flask_restful import reqparse
+from flask import send_file, Response, request, stream_with_context
+from flask_restful import inputs, reqparse
+from werkzeug.http import http_date, quote_etag
+from dotenv import load_dotenv
 
-from sm2t.utils import parse_bbox, check_bbox
-from sm2t.database import load_speed_by_bbox, open_connection
+from sm2t.utils import (
+    bboxes_shape,
+    check_area,
+    check_bbox,
+    env_flag,
+    geometry_shape,
+    output_filename,
+    parse_bbox,
+    parse_bboxes,
+    parse_body_hours,
+    parse_hours,
+    parse_osm_ids,
+)
+from sm2t.admission import (
+    estimate_rows,
+    get_heavy_slots,
+    get_token_buckets,
+    heavy_query_rows,
+)
+from sm2t.cache import get_tile_cache
+from sm2t.coverage import get_coverage_index
+from sm2t.data_version import current_data_version, last_modified
+from sm2t.memory_index import get_memory_index
+from sm2t.shards import get_shard_registry, iter_speed_shards
+from sm2t.metrics import (
+    generate_metrics,
+    metrics_available,
+    observe_request,
+    record,
+    record_rejection,
+    record_uncovered,
+    request_timings,
+    server_timing,
+    set_gauges,
+    timed,
+    timed_iter,
+)
+from sm2t.formats import (
+    OUTPUT_FORMATS,
+    accepts_encoding,
+    compress_chunks,
+    encode_chunks,
+    format_available,
+    negotiate_encoding,
+)
+from sm2t.snapshots import SNAPSHOT_MIMETYPE, read_snapshot_index, snapshot_dir
+from sm2t.tiles import (
+    get_tile_archive,
+    gzip_tile,
+    min_tile_zoom,
+    render_tile,
+    valid_tile,
+)
+from sm2t.database import (
+    CHANGE_COLUMNS,
+    GEOMETRY_FORMATS,
+    bbox_region,
+    bboxes_region,
+    geometry_region,
+    get_changeset_chain,
+    iter_changes,
+    iter_speed,
+    iter_speed_by_bbox,
+    load_speed_by_bbox,
+    node_pairs_region,
+    osm_way_ids_region,
+    output_columns,
+    pool_stats,
+    pooled_connection,
+)
 
 import logging
+import logging.config
 
+load_dotenv("../.env", verbose=True)
+
+try:
+    logging.config.fileConfig("logging.conf", disable_existing_loggers=False)
+except KeyError:
+    print("logging could not be initialized.")
 
 app = Flask(__name__)
 app.secret_key = os.environ["SECRET_KEY"]
@@ -21,9 +104,309 @@ app.secret_key = os.environ["SECRET_KEY"]
 api = Api(app, prefix="/api/v1")
 
 
+def speed_batches(
+    bboxes, conn, hours=None, wide=False, region=None, geometry=None, simplify=0
+):
+    """
+    Batches of speed data within bounding boxes from the shards, the memory index,
+    the tile cache or the database
+    :param bboxes: List of bounding boxes (min_lon, min_lat, max_lon, max_lat)
+    :param conn: psycopg2.connection object, not used if the data is sharded or the
+    memory index is enabled
+    :param hours: List of hours of day to select. If None, all hours are selected.
+    :param wide: If True, one row per segment with one speed column per hour is selected
+    :param region: Region of segments queried from the database instead of the
+    bounding boxes (see sm2t.database.bbox_region)
+    :param geometry: Output format of the geometry of the segments queried from the region
+    :param simplify: Tolerance in degree of the simplification of the geometry
+    :return: Generator of lists of row tuples
+    """
+    if region is None and not bboxes:
+        return iter(())
+    shard_registry = get_shard_registry()
+    if shard_registry is not None:
+        # Regions without bounding boxes, e.g. OSM ids, are looked up on all shards
+        if bboxes:
+            shards = shard_registry.shards_for_bboxes(bboxes)
+        else:
+            shards = shard_registry.shards()
+        if region is None:
+            region = bboxes_region(bboxes)
+        return iter_speed_shards(
+            region, shards, hours=hours, wide=wide, geometry=geometry, simplify=simplify
+        )
+    if region is not None:
+        return iter_speed(
+            region, conn, hours=hours, wide=wide, geometry=geometry, simplify=simplify
+        )
+    memory_index = get_memory_index()
+    if memory_index is not None:
+        return memory_index.iter_speed_by_bboxes(bboxes, hours=hours, wide=wide)
+    tile_cache = get_tile_cache()
+    if tile_cache is not None:
+        return tile_cache.iter_speed_by_bboxes(bboxes, conn, hours=hours, wide=wide)
+    if len(bboxes) == 1:
+        return iter_speed_by_bbox(bboxes[0], conn, hours=hours, wide=wide)
+    return iter_speed(bboxes_region(bboxes), conn, hours=hours, wide=wide)
+
+
+def stream_speed(
+    bboxes,
+    output_format="csv",
+    hours=None,
+    wide=False,
+    region=None,
+    geometry=None,
+    simplify=0,
+):
+    """
+    Stream speed data within bounding boxes or a region. The pooled connection is held
+    until the last chunk has been sent. Bounding boxes are answered without a connection
+    if the memory index is enabled or none of them is covered (see covered_bboxes).
+    Shards are queried with connections of their pools.
+    :param bboxes: List of bounding boxes (min_lon, min_lat, max_lon, max_lat)
+    :param output_format: Name of the format (csv, arrow, parquet)
+    :param hours: List of hours of day to select. If None, all hours are selected.
+    :param wide: If True, one row per segment with one speed column per hour is sent
+    :param region: Region of segments queried from the database instead of the
+    bounding boxes (see sm2t.database.bbox_region)
+    :param geometry: Output format of the geometry of the segments queried from the region
+    (see sm2t.database.GEOMETRY_FORMATS)
+    :param simplify: Tolerance in degree of the simplification of the geometry
+    :return: Generator of encoded chunks
+    """
+    columns = output_columns(hours, wide, geometry)
+    in_memory = region is None and (not bboxes or get_memory_index() is not None)
+    sharded = get_shard_registry() is not None
+    with nullcontext() if in_memory or sharded else pooled_connection() as conn:
+        yield from encode_chunks(
+            timed_iter(
+                speed_batches(bboxes, conn, hours, wide, region, geometry, simplify),
+                "query",
+                count="rows",
+            ),
+            output_format,
+            columns,
+        )
+
+
+def stream_speed_csv(bbox, hours=None, wide=False):
+    """
+    Stream speed data within bounding box as CSV
+    :param bbox: Bounding box (min_lon, min_lat, max_lon, max_lat)
+    :param hours: List of hours of day to select. If None, all hours are selected.
+    :param wide: If True, one row per segment with one speed column per hour is sent
+    :return: Generator of CSV chunks
+    """
+    return stream_speed([bbox], "csv", hours, wide)
+
+
+def stream_changes(versions, output_format="csv", region=None):
+    """
+    Stream the changes of segments in changesets. The pooled connection is held
+    until the last chunk has been sent.
+    :param versions: Versions of the changesets (see sm2t.database.get_changeset_chain)
+    :param output_format: Name of the format (csv, arrow, parquet)
+    :param region: Region of the segments (see sm2t.database.bbox_region). Defaults to all segments.
+    :return: Generator of encoded chunks
+    """
+    with pooled_connection() as conn:
+        yield from encode_chunks(
+            timed_iter(iter_changes(versions, conn, region), "query", count="rows"),
+            output_format,
+            CHANGE_COLUMNS,
+        )
+
+
+def cache_headers(variant: str, source_versions=()):
+    """
+    Validators and Cache-Control of responses holding data of the live version.
+    The ETag is derived from the content hash written by populate_database.py and
+    the layout of the speed table.
+    :param variant: Representation of the data, e.g. the output format and content encoding
+    :param source_versions: Dataset versions of the copies the data is read from, e.g.
+    the memory index, which pick up a new version only after their TTL
+    :return: Dictionary of headers, empty if DATA_VERSION_FILE is not set or written yet
+    or the data is read from a copy of another version
+    """
+    data_version = current_data_version()
+    if data_version is None:
+        return {}
+    if any(
+        version is not None and str(version) != str(data_version["version"])
+        for version in source_versions
+    ):
+        return {}
+    layout = os.getenv("SPEED_LAYOUT", "long")
+    etag = hashlib.sha256(
+        f"{data_version['hash']}-{layout}-{variant}".encode()
+    ).hexdigest()
+    return {
+        "X-Data-Version": str(data_version["version"]),
+        "ETag": quote_etag(etag[:32]),
+        "Last-Modified": http_date(last_modified()),
+        "Cache-Control": f"public, max-age={int(os.getenv('CACHE_MAX_AGE', 300))}",
+    }
+
+
+def not_modified(headers: dict):
+    """
+    Response to a conditional request whose copy of the data is current
+    :param headers: Headers of the response (see cache_headers)
+    :return: flask.Response with status 304 or None if the data must be sent
+    """
+    if "ETag" not in headers:
+        return None
+    if request.if_none_match:
+        fresh = request.if_none_match.contains_weak(headers["ETag"].strip('"'))
+    elif request.if_modified_since is not None:
+        fresh = last_modified().replace(microsecond=0) <= request.if_modified_since
+    else:
+        fresh = False
+    return Response(status=304, headers=headers) if fresh else None
+
+
+def too_many_requests(reason: str, retry_after: float, message: str):
+    """
+    Response to a request rejected by admission control
+    :param reason: heavy or rate_limit
+    :param retry_after: Seconds after which the request may succeed
+    :param message: Error message
+    :return: Response with status 429
+    """
+    record_rejection(reason)
+    return (
+        {"success": False, "message": message},
+        429,
+        {"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+
+
+def admit(bboxes, hours=None, wide=False):
+    """
+    Admission control of a request for speed data within bounding boxes. Heavy requests
+    need one of the slots for heavy requests, which is held until the response has been
+    sent (see release_after). Each request takes tokens from the bucket of the client.
+    :param bboxes: List of bounding boxes (min_lon, min_lat, max_lon, max_lat)
+    :param hours: List of hours of day to select. If None, all hours are selected.
+    :param wide: If True, one row per segment with one speed column per hour is sent
+    :return: HeavySlot or None, None or a response with status 429 if the request is rejected
+    """
+    heavy_slots = get_heavy_slots()
+    token_buckets = get_token_buckets()
+    if heavy_slots is None and token_buckets is None:
+        return None, None
+    rows = estimate_rows(bboxes, hours, wide)
+    if rows is not None:
+        record("estimated_rows", rows)
+
+    slot = None
+    if heavy_slots is not None and rows is not None and rows > heavy_query_rows():
+        slot = heavy_slots.acquire()
+        if slot is None:
+            return None, too_many_requests(
+                "heavy",
+                float(os.getenv("HEAVY_QUERY_RETRY_AFTER", 2)),
+                "Too many large requests are being served. Retry later or request "
+                "a smaller bounding box.",
+            )
+    if token_buckets is not None:
+        wait = token_buckets.take(
+            request.remote_addr or "", 1 + (rows or 0) / heavy_query_rows()
+        )
+        if wait > 0:
+            if slot is not None:
+                slot.release()
+            return None, too_many_requests(
+                "rate_limit", wait, "Rate limit exceeded. Retry later."
+            )
+    return slot, None
+
+
+def source_versions(region_query=False):
+    """
+    Dataset versions of the copies of the data held by the current process, which
+    bounding box requests are answered from
+    :param region_query: If True, the segments are queried from the database and only
+    the coverage index is used
+    :return: List of versions, None for copies whose version is not known yet
+    """
+    versions = []
+    coverage_index = get_coverage_index()
+    if coverage_index is not None:
+        versions.append(coverage_index.version)
+    if region_query or get_shard_registry() is not None:
+        return versions
+    memory_index = get_memory_index()
+    if memory_index is not None:
+        versions.append(memory_index.current["version"])
+        return versions
+    tile_cache = get_tile_cache()
+    if tile_cache is not None:
+        versions.append(tile_cache.version)
+    return versions
+
+
+def covered_bboxes(bboxes):
+    """
+    Trim bounding boxes to the cells of the coverage index holding segments. Bounding
+    boxes without segments are dropped, so requests outside all cities are answered
+    without queries.
+    :param bboxes: List of bounding boxes (min_lon, min_lat, max_lon, max_lat)
+    :return: List of trimmed bounding boxes, empty if no segment is within them
+    """
+    coverage_index = get_coverage_index()
+    if coverage_index is None:
+        return bboxes
+    bboxes = coverage_index.trim_bboxes(bboxes)
+    if not bboxes:
+        record_uncovered()
+    return bboxes
+
+
+def release_after(response, slot):
+    """
+    Release the slot of a heavy request once the response has been sent
+    :param response: flask.Response
+    :param slot: HeavySlot or None
+    :return: The response
+    """
+    if slot is not None:
+        response.call_on_close(slot.release)
+    return response
+
+
+def speed_response(chunks, output_format, filename, headers=None):
+    """
+    Streamed response of encoded speed data. CSV is compressed if the client accepts it.
+    :param chunks: Generator of encoded chunks
+    :param output_format: Name of the format (csv, arrow, parquet)
+    :param filename: Name of the downloaded CSV file
+    :param headers: Additional headers, e.g. cache headers
+    :return: flask.Response
+    """
+    filename = filename[: -len(".csv")] + OUTPUT_FORMATS[output_format]["suffix"]
+    headers = dict(headers or {})
+    headers["Content-Disposition"] = f"attachment; filename={filename}"
+    if output_format == "csv":
+        encoding = negotiate_encoding(request.headers.get("Accept-Encoding"))
+        headers["Vary"] = "Accept-Encoding"
+        if encoding is not None:
+            headers["Content-Encoding"] = encoding
+        chunks = compress_chunks(chunks, encoding)
+    chunks = timed_iter(chunks, "serialize", nested=("connect", "query"))
+    return Response(
+        stream_with_context(chunks),
+        mimetype=OUTPUT_FORMATS[output_format]["mimetype"],
+        headers=headers,
+    )
+
+
 class Traffic(Resource):
     """Resource provides traffic information"""
 
+    output_format = "csv"
+
     def get(self):
         """
         Get traffic data for specified bounding box
@@ -31,8 +414,76 @@ class Traffic(Resource):
         """
         parser = reqparse.RequestParser()
         parser.add_argument("bbox", type=str, help="Bounding box", required=True)
+        parser.add_argument(
+            "format",
+            type=str,
+            help="Output format: csv, arrow or parquet",
+            default=self.output_format,
+        )
+        parser.add_argument(
+            "hours", type=str, help="Comma separated hours of day, e.g. 7,8,9"
+        )
+        parser.add_argument("hour_from", type=int, help="First hour of day")
+        parser.add_argument("hour_to", type=int, help="Last hour of day (inclusive)")
+        parser.add_argument(
+            "layout",
+            type=str,
+            help="long: one row per segment and hour, wide: one row per segment",
+            default="long",
+        )
+        parser.add_argument(
+            "exact",
+            type=inputs.boolean,
+            help="Only segments intersecting the bounding box, not only their bounding box",
+            default=False,
+        )
+        parser.add_argument(
+            "geometry",
+            type=str,
+            help="Add the geometry of the segments: wkb (hex encoded) or geojson",
+        )
+        parser.add_argument(
+            "simplify",
+            type=float,
+            help="Tolerance in degree of the simplification of the geometry",
+            default=0,
+        )
         args = parser.parse_args()
 
+        output_format = args["format"].lower()
+        if not format_available(output_format):
+            return {
+                "success": False,
+                "message": f"Output format {output_format} is not available.",
+            }
+
+        layout = args["layout"].lower()
+        if layout not in ("long", "wide"):
+            return {
+                "success": False,
+                "message": f"Layout {layout} is not available. Use long or wide.",
+            }
+        wide = layout == "wide"
+
+        geometry = args["geometry"].lower() if args["geometry"] else None
+        if geometry is not None and geometry not in GEOMETRY_FORMATS:
+            return {
+                "success": False,
+                "message": f"Geometry format {geometry} is not available. Use wkb or geojson.",
+            }
+        if args["simplify"] < 0:
+            return {
+                "success": False,
+                "message": "Simplification tolerance must not be negative.",
+            }
+
+        hours, message = parse_hours(args["hours"], args["hour_from"], args["hour_to"])
+        if hours is False:
+            return {
+                "success": False,
+                "message": message,
+            }
+
         bbox, outfile_message = parse_bbox(args["bbox"])
         if bbox is False:
             return {
@@ -47,19 +498,428 @@ class Traffic(Resource):
                 "success": str(bbox_ok),
                 "message": message,
             }
+        record("area", (bbox[2] - bbox[0]) * (bbox[3] - bbox[1]))
+
+        # Conditional requests are answered from the data version file
+        encoding = None
+        if output_format == "csv":
+            encoding = negotiate_encoding(request.headers.get("Accept-Encoding"))
+        headers = cache_headers(
+            f"{output_format}-{encoding or 'identity'}",
+            source_versions(args["exact"] or geometry is not None),
+        )
+        if output_format == "csv":
+            headers["Vary"] = "Accept-Encoding"
+        response = not_modified(headers)
+        if response is not None:
+            return response
+
+        bboxes = covered_bboxes([bbox])
+        slot, response = admit(bboxes, hours, wide)
+        if response is not None:
+            return response
+
+        # The memory index and the tile cache only hold bounding boxes of segments
+        region = None
+        if bboxes and (args["exact"] or geometry is not None):
+            region = bbox_region(bboxes[0], exact=args["exact"])
 
         # Query data from database within bounding box
-        conn, message = open_connection()
-        logging.info(message)
-        data = load_speed_by_bbox(bbox, conn)
-        conn.close()
+        if (
+            output_format != "csv"
+            or env_flag("STREAM_CSV", default=True)
+            or get_tile_cache() is not None
+            or get_memory_index() is not None
+            or get_shard_registry() is not None
+            or not bboxes
+            or encoding is not None
+        ):
+            return release_after(
+                speed_response(
+                    stream_speed(
+                        bboxes,
+                        output_format,
+                        hours,
+                        wide,
+                        region,
+                        geometry,
+                        args["simplify"],
+                    ),
+                    output_format,
+                    outfile_message,
+                    headers,
+                ),
+                slot,
+            )
 
-        response_stream = BytesIO(data.to_csv(index=False).encode())
-        return send_file(
+        try:
+            data = load_speed_by_bbox(
+                bboxes[0],
+                hours=hours,
+                wide=wide,
+                exact=args["exact"],
+                geometry=geometry,
+                simplify=args["simplify"],
+            )
+        finally:
+            if slot is not None:
+                slot.release()
+        record("rows", len(data))
+
+        with timed("serialize"):
+            response_stream = BytesIO(data.to_csv(index=False).encode())
+        response = send_file(
             response_stream,
             mimetype="text/csv",
             download_name=outfile_message,
         )
+        response.headers.update(headers)
+        return response
+
+
+def parse_body_options(body: dict):
+    """
+    Parse output format, layout and hours of day of a POST request
+    :param body: JSON body of the request
+    :return: (output_format, hours, wide) or False, error message
+    """
+    output_format = str(body.get("format", "csv")).lower()
+    if not format_available(output_format):
+        return False, f"Output format {output_format} is not available."
+
+    layout = str(body.get("layout", "long")).lower()
+    if layout not in ("long", "wide"):
+        return False, f"Layout {layout} is not available. Use long or wide."
+
+    hours, message = parse_body_hours(body)
+    if hours is False:
+        return False, message
+    return (output_format, hours, layout == "wide"), None
+
+
+class TrafficBatch(Resource):
+    """Resource provides traffic information for several bounding boxes or a geometry"""
+
+    def post(self):
+        """
+        Get traffic data for a list of bounding boxes or a buffered GeoJSON geometry.
+        Segments within several boxes are returned once. The total area of the
+        request is limited by MAX_BATCH_AREA (default: MAX_BBOX_DEGREE squared).
+        :return:
+        """
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict) or (
+            "bboxes" not in body and "geometry" not in body
+        ):
+            return {
+                "success": False,
+                "message": "Request body must be JSON with bboxes or geometry.",
+            }
+
+        options, message = parse_body_options(body)
+        if options is False:
+            return {
+                "success": False,
+                "message": message,
+            }
+        output_format, hours, wide = options
+
+        bboxes = None
+        query_region = None
+        if "geometry" in body:
+            try:
+                buffer = float(body.get("buffer", 0))
+            except (TypeError, ValueError):
+                return {"success": False, "message": "Buffer must be a number."}
+            region, message = geometry_shape(body["geometry"], buffer)
+            if region is False:
+                return {
+                    "success": False,
+                    "message": message,
+                }
+            geometry = body["geometry"]
+            if geometry.get("type") == "Feature":
+                geometry = geometry["geometry"]
+            query_region = geometry_region(json.dumps(geometry), buffer)
+            if not covered_bboxes([region.bounds]):
+                bboxes = []
+                query_region = None
+        else:
+            bboxes, message = parse_bboxes(body["bboxes"])
+            if bboxes is False:
+                return {
+                    "success": False,
+                    "message": message,
+                }
+            region = bboxes_shape(bboxes)
+
+        # Check total area of the request
+        max_area = float(
+            os.getenv("MAX_BATCH_AREA") or float(os.getenv("MAX_BBOX_DEGREE")) ** 2
+        )
+        area_ok, message = check_area(region, max_area)
+        if not area_ok:
+            return {
+                "success": str(area_ok),
+                "message": message,
+            }
+        record("area", region.area)
+        if bboxes:
+            bboxes = covered_bboxes(bboxes)
+
+        slot, response = admit(
+            [region.bounds] if bboxes is None else bboxes, hours, wide
+        )
+        if response is not None:
+            return response
+
+        _, outfile_message = parse_bbox(",".join(str(x) for x in region.bounds))
+        return release_after(
+            speed_response(
+                stream_speed(bboxes, output_format, hours, wide, query_region),
+                output_format,
+                outfile_message,
+            ),
+            slot,
+        )
+
+
+class TrafficWays(Resource):
+    """Resource provides traffic information of OSM ways or node pairs"""
+
+    def post(self):
+        """
+        Get traffic data for a list of osm_way_ids or of (osm_start_node_id,
+        osm_end_node_id) pairs. All segments are looked up in one query.
+        The number of ids is limited by MAX_LOOKUP_IDS.
+        :return:
+        """
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict) or (
+            "osm_way_ids" not in body and "node_pairs" not in body
+        ):
+            return {
+                "success": False,
+                "message": "Request body must be JSON with osm_way_ids or node_pairs.",
+            }
+
+        options, message = parse_body_options(body)
+        if options is False:
+            return {
+                "success": False,
+                "message": message,
+            }
+        output_format, hours, wide = options
+
+        if "osm_way_ids" in body:
+            osm_way_ids, message = parse_osm_ids(body["osm_way_ids"])
+            if osm_way_ids is False:
+                return {
+                    "success": False,
+                    "message": message,
+                }
+            query_region = osm_way_ids_region(osm_way_ids)
+        else:
+            node_pairs, message = parse_osm_ids(body["node_pairs"], pairs=True)
+            if node_pairs is False:
+                return {
+                    "success": False,
+                    "message": message,
+                }
+            query_region = node_pairs_region(node_pairs)
+
+        return speed_response(
+            stream_speed(None, output_format, hours, wide, query_region),
+            output_format,
+            output_filename("osm_ways"),
+        )
+
+
+class TrafficTile(Resource):
+    """Resource provides traffic information as Mapbox Vector Tiles"""
+
+    def get(self, z, x, y):
+        """
+        Get a vector tile with the highway segments and their 24 hourly speeds.
+        Tiles are read from the pre-rendered archive at TILE_ARCHIVE if it holds
+        the zoom level, otherwise they are rendered from the database.
+        :param z: Zoom level
+        :param x: Column
+        :param y: Row, counted from the north
+        :return:
+        """
+        if not valid_tile(z, x, y):
+            return {"success": False, "message": "Tile does not exist."}
+
+        # The archive is pre-rendered after the data has been populated
+        tile_archive = get_tile_archive()
+        if tile_archive is not None:
+            zoom_range = tile_archive.zoom_range()
+            if zoom_range is None or not zoom_range[0] <= z <= zoom_range[1]:
+                tile_archive = None
+        versions = [tile_archive.metadata.get("version")] if tile_archive else []
+
+        gzipped = accepts_encoding(request.headers.get("Accept-Encoding"), "gzip")
+        headers = cache_headers(f"tile-{'gzip' if gzipped else 'identity'}", versions)
+        headers["Vary"] = "Accept-Encoding"
+        response = not_modified(headers)
+        if response is not None:
+            return response
+
+        data = None
+        if tile_archive is not None:
+            data = tile_archive.get(z, x, y)
+        if data is None:
+            # Check size of tile
+            if z < min_tile_zoom():
+                return {
+                    "success": "False",
+                    "message": f"Tile is too big. The minimum zoom level is {min_tile_zoom()}.",
+                }
+            with pooled_connection() as conn:
+                with timed("query"):
+                    data = render_tile(conn, z, x, y)
+            with timed("serialize"):
+                data = gzip_tile(data)
+
+        if not data:
+            return Response(status=204, headers=headers)
+        if gzipped:
+            # Tiles are stored gzipped and sent as they are
+            headers["Content-Encoding"] = "gzip"
+        else:
+            data = gzip.decompress(data)
+        return Response(
+            data, mimetype="application/vnd.mapbox-vector-tile", headers=headers
+        )
+
+
+class TrafficChanges(Resource):
+    """Resource provides the changes of the speed data since a dataset version"""
+
+    def get(self):
+        """
+        Get the segments which have been added, removed or whose speeds have changed
+        since a dataset version, one row per segment with its 24 hourly speeds. The
+        live version is sent in the X-Data-Version header.
+        :return:
+        """
+        parser = reqparse.RequestParser()
+        parser.add_argument(
+            "since",
+            type=int,
+            help="Dataset version of the data of the client (X-Data-Version)",
+            required=True,
+        )
+        parser.add_argument("bbox", type=str, help="Bounding box")
+        parser.add_argument(
+            "format",
+            type=str,
+            help="Output format: csv, arrow or parquet",
+            default="csv",
+        )
+        args = parser.parse_args()
+
+        output_format = args["format"].lower()
+        if not format_available(output_format):
+            return {
+                "success": False,
+                "message": f"Output format {output_format} is not available.",
+            }
+
+        region = None
+        if args["bbox"] is not None:
+            bbox, message = parse_bbox(args["bbox"])
+            if bbox is False:
+                return {"success": False, "message": message}
+            region = bbox_region(bbox)
+
+        encoding = None
+        if output_format == "csv":
+            encoding = negotiate_encoding(request.headers.get("Accept-Encoding"))
+        headers = cache_headers(f"changes-{output_format}-{encoding or 'identity'}")
+        response = not_modified(headers)
+        if response is not None:
+            return response
+
+        with pooled_connection() as conn:
+            with timed("query"):
+                versions, version = get_changeset_chain(conn, args["since"])
+        if versions is None:
+            return {
+                "success": False,
+                "message": f"Changes since version {args['since']} are not available. "
+                f"Download the data of version {version} again.",
+            }
+        headers["X-Data-Version"] = str(version)
+        return speed_response(
+            stream_changes(versions, output_format, region),
+            output_format,
+            output_filename(f"changes-{args['since']}-{version}"),
+            headers,
+        )
+
+
+class Snapshots(Resource):
+    """Resource lists the snapshot files holding the complete data of each city"""
+
+    def get(self):
+        """Get the cities with snapshot files and their sizes and hashes"""
+        directory = snapshot_dir()
+        if directory is None:
+            return {"success": False, "message": "Snapshots are disabled."}
+        return {"success": True, "snapshots": read_snapshot_index(directory)}
+
+
+class Snapshot(Resource):
+    """Resource provides the snapshot file of a city"""
+
+    def get(self, city):
+        """
+        Download the snapshot file of a city. The file is sent with sendfile and
+        supports range requests. Its hash is used as ETag, so conditional
+        requests are answered with 304 until the data of the city changes.
+        :param city: Name of the city
+        :return:
+        """
+        directory = snapshot_dir()
+        if directory is None:
+            return {"success": False, "message": "Snapshots are disabled."}
+        snapshot = read_snapshot_index(directory).get(city)
+        if snapshot is None:
+            return {"success": False, "message": f"There is no snapshot of {city}."}
+        path = os.path.join(directory, snapshot["file"])
+        return send_file(
+            path,
+            mimetype=SNAPSHOT_MIMETYPE,
+            as_attachment=True,
+            download_name=f"sm2t-{snapshot['file']}",
+            conditional=True,
+            etag=snapshot["sha256"],
+            last_modified=os.path.getmtime(path),
+        )
+
+
+class Coverage(Resource):
+    """Resource provides the coverage index of the cities"""
+
+    def get(self):
+        """
+        Get the cells of a regular grid holding segments. Cell (x, y) spans
+        x * cell_degree to (x + 1) * cell_degree in longitude and y * cell_degree to
+        (y + 1) * cell_degree in latitude. Requests for bounding boxes outside these
+        cells return no segments.
+        :return:
+        """
+        coverage_index = get_coverage_index()
+        if coverage_index is None or coverage_index.cell_size is None:
+            return {"success": False, "message": "Coverage index is not available."}
+        # The index is read again within COVERAGE_VERSION_TTL of a new data version
+        headers = cache_headers("coverage", [coverage_index.version])
+        response = not_modified(headers)
+        if response is not None:
+            return response
+        return {"success": True, "coverage": coverage_index.to_dict()}, 200, headers
 
 
 class Health(Resource):
@@ -67,15 +927,136 @@ class Health(Resource):
 
     def get(self):
         """Check if API is ready"""
-        conn, message = open_connection()
-        if conn is False:
+        try:
+            with pooled_connection():
+                pass
+        except Exception as error:
+            logging.critical(error)
             return {"success": False, "message": "not healthy"}
-        else:
-            return {"success": True, "message": "healthy"}
+        return {"success": True, "message": "healthy"}
+
+
+class CacheStats(Resource):
+    """Tile cache statistics of the worker process handling the request"""
+
+    def get(self):
+        """Get hit and miss counters of the tile cache"""
+        tile_cache = get_tile_cache()
+        if tile_cache is None:
+            return {"success": False, "message": "Tile cache is disabled."}
+        return {"success": True, "cache": tile_cache.stats()}
+
+
+class Metrics(Resource):
+    """Prometheus metrics of all worker processes"""
+
+    def get(self):
+        """Get metrics in the Prometheus text format"""
+        if not metrics_available():
+            return {"success": False, "message": "Metrics are not available."}
+        data, content_type = generate_metrics()
+        return Response(data, content_type=content_type)
+
+
+class TrafficArrow(Traffic):
+    """Resource provides traffic information as Arrow IPC stream"""
+
+    output_format = "arrow"
+
+
+class TrafficParquet(Traffic):
+    """Resource provides traffic information as Parquet file"""
+
+    output_format = "parquet"
 
 
 api.add_resource(Traffic, "/traffic/csv")
+api.add_resource(TrafficBatch, "/traffic/batch")
+api.add_resource(TrafficWays, "/traffic/ways")
+api.add_resource(TrafficTile, "/traffic/tiles/<int:z>/<int:x>/<int:y>")
+api.add_resource(TrafficChanges, "/traffic/changes")
+api.add_resource(TrafficArrow, "/traffic/arrow")
+api.add_resource(TrafficParquet, "/traffic/parquet")
+api.add_resource(Coverage, "/coverage")
+api.add_resource(Snapshots, "/snapshots")
+api.add_resource(Snapshot, "/snapshots/<string:city>")
 api.add_resource(Health, "/health")
+api.add_resource(CacheStats, "/cache")
+api.add_resource(Metrics, "/metrics")
+
+
+@app.before_request
+def start_timer():
+    """Start measuring the request"""
+    request_timings()
+
+
+@app.after_request
+def instrument_response(response):
+    """
+    Observe the metrics of the request once the response has been sent. If the
+    request has the header X-Profile: true, the timings are returned in the
+    Server-Timing header. Streamed responses are then sent once they are complete.
+    :param response: flask.Response
+    :return: flask.Response
+    """
+    timings = request_timings()
+    endpoint = request.endpoint or "unknown"
+    if request.headers.get("X-Profile", "").lower() in ("1", "true"):
+        if response.is_streamed and not response.direct_passthrough:
+            response.get_data()
+        response.headers["Server-Timing"] = server_timing(timings)
+        # Profiled responses are not stored by caches
+        response.headers["Cache-Control"] = "no-store"
+
+    n_bytes = [response.content_length]
+    if response.direct_passthrough:
+        # Files are passed to the server as they are, without close callbacks
+        observe_request(endpoint, response.status_code, timings, n_bytes[0])
+    elif response.is_streamed:
+        n_bytes[0] = 0
+
+        def count_bytes(chunks):
+            for chunk in chunks:
+                n_bytes[0] += len(chunk)
+                yield chunk
+
+        response.response = count_bytes(response.response)
+    else:
+        n_bytes[0] = len(response.get_data())
+    if not response.direct_passthrough:
+        response.call_on_close(
+            lambda: observe_request(endpoint, response.status_code, timings, n_bytes[0])
+        )
+    tile_cache = get_tile_cache()
+    set_gauges(pool_stats(), tile_cache.stats() if tile_cache is not None else None)
+    return response
+
+
+def preload():
+    """
+    Set up read-only state before uWSGI forks the workers. The application is imported
+    in the master process (lazy-apps is off), so the imported modules, the data version
+    and the arrays of the memory index are shared copy-on-write by all workers. Database
+    connections and the tile archive are opened by each worker after the fork.
+    """
+    current_data_version()
+    get_memory_index()
+    if not env_flag("STREAM_CSV", default=True):
+        # CSV responses are built with pandas, which is otherwise not loaded
+        import pandas  # noqa: F401
+    # Objects created so far are not tracked by the garbage collector of the
+    # workers, which would otherwise write to and thereby copy their pages
+    gc.freeze()
+
+
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+if uwsgi is not None and uwsgi.worker_id() == 0:
+    preload()
 
 
 if __name__ == "__main__":
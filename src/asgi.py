@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""SM2T API as ASGI application with asynchronous database access
+
+Serves a subset of api.py, but a single process can keep many database queries
+in flight: CSV of bounding boxes (/traffic/csv with bbox, hours, hour_from, hour_to
+and layout) and /health. Other parameters are rejected. Responses are neither
+compressed nor sent with validators, and requests are not subject to admission
+control. If DB_SHARDS is set, each shard has its own pool and requests are routed
+by the city registry of the primary database as by api.py.
+Run e.g. with: uvicorn asgi:app --port 5000
+"""
+import asyncio
+import contextlib
+import logging
+import os
+
+import asyncpg
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+from dotenv import load_dotenv
+
+from sm2t.database import (
+    PRIMARY_SHARD,
+    database_address,
+    live_schema,
+    output_columns,
+    shard_addresses,
+    speed_by_bbox_query,
+)
+from sm2t.queries import positional_query
+from sm2t.shards import REGISTRY_QUERY, ShardRegistry
+from sm2t.utils import check_bbox, encode_csv, parse_bbox, parse_hours
+
+load_dotenv("../.env", verbose=True)
+
+# Marks the end of the rows of a shard in the queue of batches
+_DONE = object()
+
+# Query parameters of /traffic/csv served by this application
+TRAFFIC_PARAMETERS = {"bbox", "format", "hours", "hour_from", "hour_to", "layout"}
+
+
+async def open_async_pool(shard=None):
+    """
+    Create an asyncpg connection pool sized by ASYNC_POOL_MIN and ASYNC_POOL_MAX
+    :param shard: Name of the shard in DB_SHARDS. Defaults to DB_SHARD or the primary.
+    :return: asyncpg.Pool
+    """
+    address = database_address(shard)
+    return await asyncpg.create_pool(
+        host=address["host"],
+        port=address["port"],
+        database=address["dbname"],
+        user=os.environ["POSTGRES_USER"],
+        password=os.environ["POSTGRES_PASSWORD"],
+        min_size=int(os.getenv("ASYNC_POOL_MIN", 2)),
+        max_size=int(os.getenv("ASYNC_POOL_MAX", 20)),
+        server_settings={"search_path": f"{live_schema()},public"},
+    )
+
+
+async def fetch_batches(pool, query, args):
+    """
+    Fetch the rows of a query in batches of STREAM_BATCH_SIZE rows
+    :param pool: asyncpg.Pool
+    :param query: SQL query with positional parameters
+    :param args: Values of the parameters
+    :return: Asynchronous generator of lists of asyncpg.Record
+    """
+    batch_size = int(os.getenv("STREAM_BATCH_SIZE", 5000))
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            cursor = await conn.cursor(query, *args)
+            while True:
+                rows = await cursor.fetch(batch_size)
+                if not rows:
+                    break
+                yield rows
+
+
+async def produce_batches(pool, query, args, batches):
+    """
+    Put the batches of rows of a shard into a queue, followed by _DONE or the error
+    :param pool: asyncpg.Pool of the shard
+    :param query: SQL query with positional parameters
+    :param args: Values of the parameters
+    :param batches: asyncio.Queue shared by the shards
+    """
+    try:
+        async for rows in fetch_batches(pool, query, args):
+            await batches.put(rows)
+    except Exception as error:
+        logging.error(f"Query on shard failed: {error}")
+        await batches.put(error)
+        return
+    await batches.put(_DONE)
+
+
+async def stream_speed_csv(pools, bbox, hours=None, wide=False):
+    """
+    Stream speed data within bounding box as CSV. Several shards are queried
+    concurrently and their batches are sent in the order they arrive.
+    :param pools: List of asyncpg.Pool of the shards holding the bounding box
+    :param bbox: Bounding box (min_lon, min_lat, max_lon, max_lat)
+    :param hours: List of hours of day to select. If None, all hours are selected.
+    :param wide: If True, one row per segment with one speed column per hour is sent
+    :return: Asynchronous generator of CSV chunks
+    """
+    query, params = speed_by_bbox_query(bbox, hours, wide)
+    # asyncpg takes positional parameters and caches the prepared statement
+    query, names = positional_query(query)
+    args = [params[name] for name in names]
+    yield encode_csv([output_columns(hours, wide)])
+    if len(pools) == 1:
+        async for rows in fetch_batches(pools[0], query, args):
+            yield encode_csv(tuple(row) for row in rows)
+        return
+    batches = asyncio.Queue(maxsize=2 * len(pools))
+    tasks = [
+        asyncio.create_task(produce_batches(pool, query, args, batches))
+        for pool in pools
+    ]
+    try:
+        running = len(tasks)
+        while running:
+            item = await batches.get()
+            if item is _DONE:
+                running -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield encode_csv(tuple(row) for row in item)
+    finally:
+        # Stop the other shards if the client has gone or a shard failed
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def shard_pools(app, bbox):
+    """
+    Pools of the shards holding cities which overlap a bounding box. The registry
+    is read from the primary database every SHARD_REGISTRY_TTL seconds.
+    :param app: Starlette application
+    :param bbox: Bounding box (min_lon, min_lat, max_lon, max_lat)
+    :return: List of asyncpg.Pool
+    """
+    registry = app.state.shard_registry
+    if registry is None:
+        return [app.state.pool]
+    async with app.state.registry_lock:
+        if registry.refresh_due():
+            registry.update(await app.state.pools[PRIMARY_SHARD].fetch(REGISTRY_QUERY))
+    return [
+        app.state.pools[shard]
+        for shard in registry.shards_for_bboxes([bbox], refresh=False)
+    ]
+
+
+async def traffic(request):
+    """
+    Get traffic data for specified bounding box
+    :param request: starlette.requests.Request
+    :return:
+    """
+    params = request.query_params
+    if "bbox" not in params:
+        return JSONResponse({"message": {"bbox": "Bounding box"}}, status_code=400)
+    unsupported = sorted(set(params) - TRAFFIC_PARAMETERS)
+    if params.get("format", "csv").lower() != "csv":
+        unsupported.append("format")
+    if unsupported:
+        return JSONResponse(
+            {
+                "success": False,
+                "message": f"Parameters {', '.join(unsupported)} are not supported "
+                "by the ASGI server. Only CSV of bounding boxes is served.",
+            },
+            status_code=400,
+        )
+
+    layout = params.get("layout", "long").lower()
+    if layout not in ("long", "wide"):
+        return JSONResponse(
+            {
+                "success": False,
+                "message": f"Layout {layout} is not available. Use long or wide.",
+            }
+        )
+
+    hours, message = parse_hours(
+        params.get("hours"), params.get("hour_from"), params.get("hour_to")
+    )
+    if hours is False:
+        return JSONResponse({"success": False, "message": message})
+
+    bbox, outfile_message = parse_bbox(params["bbox"])
+    if bbox is False:
+        return JSONResponse({"success": False, "message": outfile_message})
+
+    # Check size of bounding box
+    bbox_ok, message = check_bbox(bbox, float(os.getenv("MAX_BBOX_DEGREE")))
+    if not bbox_ok:
+        return JSONResponse({"success": str(bbox_ok), "message": message})
+
+    return StreamingResponse(
+        stream_speed_csv(
+            await shard_pools(request.app, bbox), bbox, hours, layout == "wide"
+        ),
+        media_type="text/csv",
+        headers={"Content-Disposition": f"attachment; filename={outfile_message}"},
+    )
+
+
+async def health(request):
+    """Check if API is ready"""
+    try:
+        async with request.app.state.pool.acquire() as conn:
+            await conn.fetchval("SELECT 1")
+    except Exception as error:
+        logging.critical(error)
+        return JSONResponse({"success": False, "message": "not healthy"})
+    return JSONResponse({"success": True, "message": "healthy"})
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    """Open the connection pools on startup and close them on shutdown"""
+    app.state.pool = await open_async_pool()
+    app.state.pools = {}
+    app.state.shard_registry = None
+    if shard_addresses():
+        for shard in [PRIMARY_SHARD] + list(shard_addresses()):
+            app.state.pools[shard] = await open_async_pool(shard)
+        app.state.shard_registry = ShardRegistry(
+            float(os.getenv("SHARD_REGISTRY_TTL", 60))
+        )
+        app.state.registry_lock = asyncio.Lock()
+    yield
+    await app.state.pool.close()
+    for pool in app.state.pools.values():
+        await pool.close()
+
+
+app = Starlette(
+    debug=os.environ.get("DEBUG", "False") == "True",
+    routes=[
+        Route("/api/v1/traffic/csv", traffic),
+        Route("/api/v1/health", health),
+    ],
+    lifespan=lifespan,
+)
@@ -0,0 +1,7 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmarks"""
+
+from dotenv import load_dotenv
+
+load_dotenv("../.env", verbose=True)
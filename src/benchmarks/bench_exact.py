@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measure the cost of the exact intersection and geometry options of bbox queries.
+
+Each option is compared with the default query, which only compares bounding boxes.
+The bounding boxes are shifted slightly in each repetition, so that every request
+has different parameters, as in production.
+Run from the src directory: python -m benchmarks.bench_exact
+"""
+
+import argparse
+import statistics
+import time
+
+from sm2t import queries
+from sm2t.database import pooled_connection, speed_by_bbox_query
+
+DEFAULT_BBOXES = [
+    "13.3792,52.5136,13.3842,52.5168",
+    "13.3472,52.499,13.4117,52.5304",
+]
+
+OPTIONS = {
+    "default": {},
+    "exact": {"exact": True},
+    "wkb": {"geometry": "wkb"},
+    "geojson": {"geometry": "geojson"},
+    "geojson simplified": {"geometry": "geojson", "simplify": 0.0001},
+    "exact wkb": {"exact": True, "geometry": "wkb"},
+}
+
+
+def shifted(bbox, i):
+    """Bounding box shifted by i * 1e-5 degree"""
+    return [x + i * 1e-5 for x in bbox]
+
+
+def measure(conn, bbox, options, repeat, wide=False):
+    """Median request latency in milliseconds, rows and bytes of the result"""
+    cur = conn.cursor()
+    latency = []
+    for i in range(repeat):
+        query, params = speed_by_bbox_query(shifted(bbox, i), wide=wide, **options)
+        start = time.perf_counter()
+        queries.execute(cur, query, params)
+        rows = cur.fetchall()
+        latency.append((time.perf_counter() - start) * 1000)
+    cur.close()
+    conn.commit()
+    n_bytes = sum(len(str(value)) for row in rows for value in row)
+    return statistics.median(latency), len(rows), n_bytes
+
+
+def main():
+    """Run benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--bbox", action="append", help="min_lon,min_lat,max_lon,max_lat"
+    )
+    parser.add_argument("--repeat", "-n", type=int, default=20)
+    parser.add_argument("--wide", action="store_true", help="Wide layout")
+    args = parser.parse_args()
+
+    with pooled_connection() as conn:
+        for bbox in args.bbox or DEFAULT_BBOXES:
+            coords = [float(x) for x in bbox.split(",")]
+            baseline = None
+            for name, options in OPTIONS.items():
+                latency, n_rows, n_bytes = measure(
+                    conn, coords, options, args.repeat, args.wide
+                )
+                baseline = baseline or latency
+                print(
+                    f"{bbox:>34} {name:>18}: {latency:8.2f} ms median "
+                    f"({latency / baseline:4.2f}x), {n_rows} rows, {n_bytes / 1024:.0f} KiB"
+                )
+
+
+if __name__ == "__main__":
+    main()
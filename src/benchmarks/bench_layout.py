@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare query latency and storage size of the long (highways + speed) and the
+packed (highways_packed) speed layout.
+
+Requires a database populated with SPEED_LAYOUT=packed, so that both layouts exist.
+Run from the src directory: python -m benchmarks.bench_layout
+"""
+
+import argparse
+import os
+import statistics
+import time
+
+from sm2t.database import pooled_connection, speed_by_bbox_query
+
+DEFAULT_BBOXES = [
+    "13.3792,52.5136,13.3842,52.5168",
+    "13.3472,52.499,13.4117,52.5304",
+    "13.3,52.45,13.5,52.65",
+]
+LAYOUTS = {
+    "long": ["highways", "speed"],
+    "packed": ["highways_packed"],
+}
+
+
+def query_latency(conn, bbox, layout, repeat):
+    """Median latency of the bbox query in the given layout"""
+    os.environ["SPEED_LAYOUT"] = layout
+    query, params = speed_by_bbox_query(bbox)
+    cur = conn.cursor()
+    durations = []
+    n_rows = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        cur.execute(query, params)
+        n_rows = len(cur.fetchall())
+        durations.append(time.perf_counter() - start)
+    cur.close()
+    return statistics.median(durations), n_rows
+
+
+def relation_sizes(conn, tables):
+    """Size of tables and their indexes in bytes"""
+    cur = conn.cursor()
+    table_size = 0
+    index_size = 0
+    for table in tables:
+        cur.execute("SELECT pg_table_size(%s), pg_indexes_size(%s);", (table, table))
+        sizes = cur.fetchone()
+        table_size += sizes[0]
+        index_size += sizes[1]
+    cur.close()
+    return table_size, index_size
+
+
+def main():
+    """Run benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--bbox", action="append", help="min_lon,min_lat,max_lon,max_lat"
+    )
+    parser.add_argument("--repeat", "-n", type=int, default=20)
+    args = parser.parse_args()
+
+    with pooled_connection() as conn:
+        for layout, tables in LAYOUTS.items():
+            table_size, index_size = relation_sizes(conn, tables)
+            print(
+                f"{layout:>6}: tables {table_size / 2**20:8.1f} MB, "
+                f"indexes {index_size / 2**20:8.1f} MB"
+            )
+        for bbox in args.bbox or DEFAULT_BBOXES:
+            coords = [float(x) for x in bbox.split(",")]
+            for layout in LAYOUTS:
+                latency, n_rows = query_latency(conn, coords, layout, args.repeat)
+                print(
+                    f"{bbox:>34} {layout:>6}: {latency * 1000:8.2f} ms median, {n_rows} rows"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare requests/s of the connect-per-request path against the connection pool.
+
+Any local PostgreSQL server can be used as stand-in for the production database, e.g.
+
+    docker run --rm -e POSTGRES_PASSWORD=postgres -p 5432:5432 postgis/postgis
+
+The connection is configured by the usual environment variables (HOST, POSTGRES_PORT, ...).
+Run from the src directory: python -m benchmarks.bench_pool --requests 500
+"""
+
+import argparse
+import time
+
+from sm2t.database import (
+    load_speed_by_bbox,
+    open_connection,
+    pooled_connection,
+)
+
+
+def run_query(conn, bbox, query):
+    """Run the benchmark query on a connection"""
+    if bbox is not None:
+        return load_speed_by_bbox(bbox, conn)
+    cur = conn.cursor()
+    cur.execute(query)
+    rows = cur.fetchall()
+    cur.close()
+    return rows
+
+
+def connect_per_request(n_requests, bbox, query):
+    """Open a new connection for each request, as done before the pool was introduced"""
+    start = time.perf_counter()
+    for _ in range(n_requests):
+        conn, message = open_connection()
+        run_query(conn, bbox, query)
+        conn.close()
+    return time.perf_counter() - start
+
+
+def pooled(n_requests, bbox, query):
+    """Borrow a connection from the pool for each request"""
+    # Warm up the pool so that the initial connect is not measured
+    with pooled_connection():
+        pass
+    start = time.perf_counter()
+    for _ in range(n_requests):
+        with pooled_connection() as conn:
+            run_query(conn, bbox, query)
+    return time.perf_counter() - start
+
+
+def main():
+    """Run benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", "-n", type=int, default=200)
+    parser.add_argument(
+        "--bbox",
+        type=str,
+        default=None,
+        help="Query speed data within min_lon,min_lat,max_lon,max_lat (requires populated database)",
+    )
+    parser.add_argument(
+        "--query",
+        type=str,
+        default="SELECT 1",
+        help="Query to run if no bbox is given",
+    )
+    args = parser.parse_args()
+    bbox = [float(x) for x in args.bbox.split(",")] if args.bbox else None
+
+    for name, func in [("connect-per-request", connect_per_request), ("pool", pooled)]:
+        duration = func(args.requests, bbox, args.query)
+        print(
+            f"{name:>20}: {args.requests / duration:8.1f} requests/s ({duration:.2f} s)"
+        )
+
+
+if __name__ == "__main__":
+    main()
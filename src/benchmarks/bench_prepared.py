@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare planning time and latency of the bbox query run directly and as prepared statement.
+
+The bounding boxes are shifted slightly in each repetition, so that every request
+has different parameters, as in production.
+Run from the src directory: python -m benchmarks.bench_prepared
+"""
+
+import argparse
+import statistics
+import time
+
+from sm2t import queries
+from sm2t.database import pooled_connection, speed_by_bbox_query
+
+DEFAULT_BBOXES = [
+    "13.3792,52.5136,13.3842,52.5168",
+    "13.3472,52.499,13.4117,52.5304",
+]
+
+
+def shifted(bbox, i):
+    """Bounding box shifted by i * 1e-5 degree"""
+    return [x + i * 1e-5 for x in bbox]
+
+
+def planning_time(cur, bbox, prepared):
+    """Planning time reported by EXPLAIN ANALYZE in milliseconds"""
+    query, params = speed_by_bbox_query(bbox)
+    if prepared:
+        name, names = queries.prepare(cur, query)
+        arguments = ", ".join(f"%({parameter})s" for parameter in names)
+        query = f"EXECUTE {name}({arguments})"
+    cur.execute(f"EXPLAIN (ANALYZE, FORMAT JSON) {query}", params)
+    return cur.fetchone()[0][0]["Planning Time"]
+
+
+def measure(conn, bbox, prepared, repeat):
+    """Median planning time and request latency in milliseconds"""
+    cur = conn.cursor()
+    planning = []
+    latency = []
+    for i in range(repeat):
+        planning.append(planning_time(cur, shifted(bbox, i), prepared))
+        query, params = speed_by_bbox_query(shifted(bbox, i))
+        start = time.perf_counter()
+        if prepared:
+            queries.execute(cur, query, params)
+        else:
+            cur.execute(query, params)
+        cur.fetchall()
+        latency.append((time.perf_counter() - start) * 1000)
+    cur.close()
+    conn.commit()
+    # The first executions of a prepared statement are planned with custom plans
+    warm = slice(min(6, repeat - 1), None)
+    return statistics.median(planning[warm]), statistics.median(latency[warm])
+
+
+def main():
+    """Run benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--bbox", action="append", help="min_lon,min_lat,max_lon,max_lat"
+    )
+    parser.add_argument("--repeat", "-n", type=int, default=50)
+    args = parser.parse_args()
+
+    with pooled_connection() as conn:
+        for bbox in args.bbox or DEFAULT_BBOXES:
+            coords = [float(x) for x in bbox.split(",")]
+            for prepared in (False, True):
+                planning, latency = measure(conn, coords, prepared, args.repeat)
+                print(
+                    f"{bbox:>34} {'prepared' if prepared else 'direct':>8}: "
+                    f"planning {planning:6.3f} ms, request {latency:8.2f} ms median"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare peak memory and latency of buffered and streamed CSV responses.
+
+Each mode and bounding box is run in a fresh subprocess so that the peak
+resident set size (ru_maxrss) is not inflated by previous runs.
+Requires a populated database configured by the usual environment variables.
+Run from the src directory: python -m benchmarks.bench_stream
+"""
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+from io import BytesIO
+
+DEFAULT_BBOXES = [
+    "13.3792,52.5136,13.3842,52.5168",
+    "13.3472,52.499,13.4117,52.5304",
+    "13.3,52.45,13.5,52.65",
+]
+
+
+def buffered(bbox):
+    """Build the complete CSV in memory as done by the non-streaming path"""
+    from sm2t.database import load_speed_by_bbox
+
+    data = load_speed_by_bbox(bbox)
+    response_stream = BytesIO(data.to_csv(index=False).encode())
+    first_byte = time.perf_counter()
+    n_bytes = len(response_stream.getvalue())
+    return first_byte, n_bytes
+
+
+def streamed(bbox):
+    """Consume the chunks of the streaming path"""
+    from api import stream_speed_csv
+
+    first_byte = None
+    n_bytes = 0
+    for chunk in stream_speed_csv(bbox):
+        if first_byte is None:
+            first_byte = time.perf_counter()
+        n_bytes += len(chunk)
+    return first_byte, n_bytes
+
+
+def run_single(mode, bbox):
+    """Run one measurement and print the result as JSON"""
+    func = {"buffered": buffered, "streamed": streamed}[mode]
+    bbox = [float(x) for x in bbox.split(",")]
+    start = time.perf_counter()
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    first_byte, n_bytes = func(bbox)
+    end = time.perf_counter()
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(
+        json.dumps(
+            {
+                "mode": mode,
+                "bbox": bbox,
+                "bytes": n_bytes,
+                "time_to_first_byte_s": first_byte - start,
+                "total_s": end - start,
+                "peak_rss_increase_kb": peak_rss - baseline_rss,
+            }
+        )
+    )
+
+
+def main():
+    """Run benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--bbox", action="append", help="min_lon,min_lat,max_lon,max_lat"
+    )
+    parser.add_argument(
+        "--single", choices=["buffered", "streamed"], help=argparse.SUPPRESS
+    )
+    args = parser.parse_args()
+
+    if args.single:
+        run_single(args.single, args.bbox[0])
+        return
+
+    for bbox in args.bbox or DEFAULT_BBOXES:
+        for mode in ["buffered", "streamed"]:
+            output = subprocess.run(
+                [
+                    sys.executable,
+                    "-m",
+                    "benchmarks.bench_stream",
+                    "--single",
+                    mode,
+                    "--bbox",
+                    bbox,
+                ],
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(
+                f"{bbox:>34} {mode:>9}: {result['bytes'] / 1e6:8.2f} MB, "
+                f"first byte {result['time_to_first_byte_s'] * 1000:8.1f} ms, "
+                f"total {result['total_s'] * 1000:8.1f} ms, "
+                f"peak RSS +{result['peak_rss_increase_kb'] / 1024:7.1f} MB"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Load test of running API deployments: p50/p99 latency and throughput.
+
+Each target is a name and the base URL of a deployment. Compare deployments
+through the same front, e.g. nginx with nginx.conf in front of uWSGI and with
+nginx.asgi.conf in front of the ASGI server started with SERVER_MODE=asgi, each
+published on its own PORT:
+
+    python -m benchmarks.loadtest --target uwsgi=http://localhost:8080/api/v1/ \
+        --target asgi=http://localhost:8081/api/v1/ --concurrency 32 --requests 2000
+
+Requests carry the header X-Cache-Bypass, so that nginx passes them to the API
+instead of answering them from its cache (disable with --allow-cache).
+
+Bounding boxes are drawn at random within --extent, so the workload mixes
+dense and sparse areas.
+"""
+
+import argparse
+import json
+import random
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+BERLIN = "13.088333,52.338241,13.760469,52.674915"
+
+
+def random_bboxes(extent, size, n, seed=0):
+    """
+    Random bounding boxes of a given size within an extent
+    :param extent: Bounding box (min_lon, min_lat, max_lon, max_lat)
+    :param size: Width and height of the bounding boxes in degree
+    :param n: Number of bounding boxes
+    :param seed: Seed of the random number generator
+    :return: List of bbox strings
+    """
+    rng = random.Random(seed)
+    bboxes = []
+    for _ in range(n):
+        min_lon = rng.uniform(extent[0], extent[2] - size)
+        min_lat = rng.uniform(extent[1], extent[3] - size)
+        bboxes.append(
+            f"{min_lon:.6f},{min_lat:.6f},{min_lon + size:.6f},{min_lat + size:.6f}"
+        )
+    return bboxes
+
+
+def percentile(values, q):
+    """Percentile q (0-100) of a list of values"""
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(q / 100 * (len(values) - 1)))))
+    return values[index]
+
+
+def run(base_url, bboxes, concurrency, bypass_cache=True):
+    """
+    Send one request per bounding box with the given number of concurrent clients
+    :param bypass_cache: If True, responses are not taken from the cache of nginx
+    :return: Dictionary of latency percentiles, throughput and errors
+    """
+    local = threading.local()
+    headers = {"X-Cache-Bypass": "1"} if bypass_cache else {}
+
+    def fetch(bbox):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        start = time.perf_counter()
+        try:
+            response = local.session.get(
+                base_url + "traffic/csv", params={"bbox": bbox}, headers=headers
+            )
+            ok = response.status_code == 200
+            n_bytes = len(response.content)
+        except requests.RequestException:
+            ok = False
+            n_bytes = 0
+        return time.perf_counter() - start, ok, n_bytes
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(fetch, bboxes))
+    duration = time.perf_counter() - start
+
+    latencies = [result[0] for result in results if result[1]]
+    return {
+        "requests": len(results),
+        "errors": sum(1 for result in results if not result[1]),
+        "throughput_rps": len(results) / duration,
+        "p50_ms": percentile(latencies, 50) * 1000 if latencies else None,
+        "p99_ms": percentile(latencies, 99) * 1000 if latencies else None,
+        "mean_ms": statistics.mean(latencies) * 1000 if latencies else None,
+        "bytes": sum(result[2] for result in results),
+    }
+
+
+def main():
+    """Run load test"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--target", action="append", required=True, help="name=base_url"
+    )
+    parser.add_argument("--concurrency", "-c", type=int, default=16)
+    parser.add_argument("--requests", "-n", type=int, default=500)
+    parser.add_argument("--extent", type=str, default=BERLIN)
+    parser.add_argument("--size", type=float, default=0.05, help="bbox size in degree")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    parser.add_argument(
+        "--allow-cache",
+        action="store_true",
+        help="Let nginx answer requests from its cache",
+    )
+    args = parser.parse_args()
+
+    extent = [float(x) for x in args.extent.split(",")]
+    bboxes = random_bboxes(extent, args.size, args.requests)
+    results = {}
+    for target in args.target:
+        name, base_url = target.split("=", 1)
+        results[name] = run(base_url, bboxes, args.concurrency, not args.allow_cache)
+        if not args.json:
+            result = results[name]
+            if result["p50_ms"] is None:
+                print(f"{name:>10}: all {result['errors']} requests failed")
+                continue
+            print(
+                f"{name:>10}: {result['throughput_rps']:8.1f} req/s, "
+                f"p50 {result['p50_ms']:8.1f} ms, p99 {result['p99_ms']:8.1f} ms, "
+                f"{result['errors']} errors"
+            )
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measure the import time and memory of the API and of its uWSGI workers.
+
+The import of the application is measured in fresh interpreters. With --uwsgi, uWSGI
+is started with uwsgi.ini and the memory of the forked workers is read from
+/proc/<pid>/smaps_rollup (Linux): RSS counts pages shared with the master in every
+worker, PSS divides them between the processes sharing them and private memory is
+what each additional worker costs.
+Run from the src directory: python -m benchmarks.startup --uwsgi
+"""
+
+import argparse
+import json
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import time
+
+HEAVY_MODULES = [
+    "geopandas",
+    "pandas",
+    "sqlalchemy",
+    "shapely",
+    "pyarrow",
+    "numpy",
+    "psycopg2",
+]
+
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+with open("/proc/self/status") as src:
+    rss = next(int(line.split()[1]) for line in src if line.startswith("VmRSS:"))
+print(json.dumps({{
+    "seconds": seconds,
+    "rss_kib": rss,
+    "modules": [name for name in {heavy!r} if name in sys.modules],
+}}))
+"""
+
+
+def measure_import(module, repeat):
+    """Median import time and RSS of a module in fresh interpreters"""
+    env = dict(os.environ, SECRET_KEY=os.getenv("SECRET_KEY") or "benchmark")
+    results = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                IMPORT_SCRIPT.format(module=module, heavy=HEAVY_MODULES),
+            ],
+            env=env,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        results.append(json.loads(output.splitlines()[-1]))
+    return {
+        "module": module,
+        "import_ms": statistics.median(r["seconds"] for r in results) * 1000,
+        "rss_mib": statistics.median(r["rss_kib"] for r in results) / 1024,
+        "modules": results[-1]["modules"],
+    }
+
+
+def smaps_rollup(pid):
+    """RSS, PSS and private memory of a process in MiB"""
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as src:
+        for line in src:
+            fields = line.split()
+            if len(fields) == 3 and fields[2] == "kB":
+                values[fields[0].rstrip(":")] = int(fields[1]) / 1024
+    return {
+        "rss_mib": values.get("Rss", 0),
+        "pss_mib": values.get("Pss", 0),
+        "private_mib": values.get("Private_Clean", 0) + values.get("Private_Dirty", 0),
+    }
+
+
+def children(pid):
+    """Process ids of the children of a process"""
+    with open(f"/proc/{pid}/task/{pid}/children") as src:
+        return [int(child) for child in src.read().split()]
+
+
+def measure_uwsgi(processes, timeout):
+    """Time until all uWSGI workers have been forked and memory of master and workers"""
+    start = time.perf_counter()
+    master = subprocess.Popen(
+        [
+            "uwsgi",
+            "--ini",
+            "uwsgi.ini",
+            "--processes",
+            str(processes),
+            "--socket",
+            "127.0.0.1:0",
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        workers = []
+        while len(workers) < processes:
+            if time.perf_counter() - start > timeout or master.poll() is not None:
+                raise RuntimeError("uWSGI workers did not start.")
+            time.sleep(0.05)
+            workers = children(master.pid)
+        startup = time.perf_counter() - start
+        # Let the workers finish their initialization before measuring
+        time.sleep(1)
+        return {
+            "processes": processes,
+            "startup_ms": startup * 1000,
+            "master": smaps_rollup(master.pid),
+            "workers": [smaps_rollup(pid) for pid in children(master.pid)],
+        }
+    finally:
+        master.send_signal(signal.SIGTERM)
+        master.wait(timeout)
+
+
+def main():
+    """Run benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--module",
+        action="append",
+        help="Module to import, e.g. api or sm2t.database (default: api)",
+    )
+    parser.add_argument("--repeat", "-n", type=int, default=5)
+    parser.add_argument("--uwsgi", action="store_true", help="Start uWSGI workers")
+    parser.add_argument("--processes", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    results = {"imports": []}
+    for module in args.module or ["api"]:
+        result = measure_import(module, args.repeat)
+        results["imports"].append(result)
+        print(
+            f"{module:>16}: {result['import_ms']:7.0f} ms, {result['rss_mib']:6.1f} MiB RSS, "
+            f"loaded: {', '.join(result['modules'])}"
+        )
+    if args.uwsgi:
+        result = measure_uwsgi(args.processes, args.timeout)
+        results["uwsgi"] = result
+        print(
+            f"uWSGI started {args.processes} workers in {result['startup_ms']:.0f} ms"
+        )
+        for name, memory in [("master", result["master"])] + [
+            (f"worker {i}", worker) for i, worker in enumerate(result["workers"], 1)
+        ]:
+            print(
+                f"{name:>16}: {memory['rss_mib']:6.1f} MiB RSS, {memory['pss_mib']:6.1f} MiB PSS, "
+                f"{memory['private_mib']:6.1f} MiB private"
+            )
+    if args.output:
+        with open(args.output, "w") as dst:
+            json.dump(results, dst, indent=2)
+
+
+if __name__ == "__main__":
+    main()
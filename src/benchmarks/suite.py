@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Reproducible benchmark of ingestion and bbox queries on synthetic cities.
+
+Generates synthetic city dumps, loads them with populate_database into a local
+PostGIS container (or the database configured by the environment with
+--no-container), replays a bbox workload against load_speed_by_bbox and,
+with --http, against a running API. The results are written as JSON, so runs
+of different versions can be compared:
+
+    python -m benchmarks.suite --cities 2 --edges 200000 --requests 500 \
+        --output results/$(git rev-parse --short HEAD).json
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.synthetic_city import write_dumps
+from benchmarks.workload import (
+    generate_workload,
+    read_request_log,
+    replay_function,
+    replay_http,
+)
+
+POSTGIS_IMAGE = "postgis/postgis:13-master"
+CONTAINER_PASSWORD = "sm2t-benchmark"
+
+
+def start_postgis(name: str, port: int, image: str = POSTGIS_IMAGE):
+    """
+    Start a PostGIS container and point the database settings of the environment to it
+    :param name: Name of the container
+    :param port: Port on the host
+    :param image: Docker image
+    :return:
+    """
+    subprocess.run(["docker", "rm", "-f", name], capture_output=True)
+    subprocess.run(
+        [
+            "docker",
+            "run",
+            "-d",
+            "--rm",
+            "--name",
+            name,
+            "-p",
+            f"{port}:5432",
+            "-e",
+            f"POSTGRES_PASSWORD={CONTAINER_PASSWORD}",
+            image,
+        ],
+        check=True,
+        capture_output=True,
+    )
+    os.environ.update(
+        {
+            "HOST": "localhost",
+            "POSTGRES_PORT": str(port),
+            "POSTGRES_DB": "postgres",
+            "POSTGRES_USER": "postgres",
+            "POSTGRES_PASSWORD": CONTAINER_PASSWORD,
+        }
+    )
+    wait_for_database()
+
+
+def stop_postgis(name: str):
+    """Stop and remove the PostGIS container"""
+    subprocess.run(["docker", "rm", "-f", name], capture_output=True)
+
+
+def wait_for_database(timeout: float = 60):
+    """Wait until the database accepts connections and PostGIS is installed"""
+    import psycopg2
+
+    from sm2t.database import connection_parameters
+
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            conn = psycopg2.connect(**connection_parameters())
+            cur = conn.cursor()
+            cur.execute("CREATE EXTENSION IF NOT EXISTS postgis;")
+            conn.commit()
+            conn.close()
+            return
+        except psycopg2.Error:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(1)
+
+
+def code_version():
+    """Git commit of the benchmarked code"""
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(args):
+    """
+    Run the benchmark
+    :param args: Parsed command line arguments
+    :return: Dictionary of results
+    """
+    from populate_database import populate_database
+    from sm2t.database import open_connection
+
+    results = {
+        "version": code_version(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "platform": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+        },
+        "parameters": {
+            key: value for key, value in vars(args).items() if key != "output"
+        },
+    }
+
+    dump_dir = Path(args.dumps or tempfile.mkdtemp(prefix="sm2t-dumps-"))
+    start = time.perf_counter()
+    cities = write_dumps(
+        dump_dir,
+        [f"city{i}" for i in range(args.cities)],
+        args.edges,
+        args.density,
+        args.seed,
+    )
+    results["generation"] = {
+        "seconds": time.perf_counter() - start,
+        "cities": cities,
+    }
+
+    ingestion = populate_database(str(dump_dir), args.workers)
+    ingestion["rows_per_second"] = ingestion["rows"] / max(ingestion["seconds"], 1e-9)
+    results["ingestion"] = ingestion
+
+    if args.request_log:
+        workload = read_request_log(args.request_log)
+    else:
+        workload = generate_workload(
+            cities["city0"]["extent"],
+            args.requests,
+            max_size=float(os.getenv("MAX_BBOX_DEGREE", 0.1)),
+            seed=args.seed,
+        )
+    results["queries"] = {}
+    conn, message = open_connection()
+    if conn is False:
+        raise ConnectionError(message)
+    try:
+        # Warm up the buffer cache and prepared statements
+        replay_function(workload[: args.warmup], conn, memory=False)
+        results["queries"]["load_speed_by_bbox"] = replay_function(workload, conn)
+    finally:
+        conn.close()
+    if args.http:
+        replay_http(workload[: args.warmup], args.http, args.concurrency)
+        results["queries"]["http"] = replay_http(workload, args.http, args.concurrency)
+    return results
+
+
+def main():
+    """Run benchmark suite"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--cities", type=int, default=1)
+    parser.add_argument("--edges", type=int, default=100000, help="Edges per city")
+    parser.add_argument(
+        "--density", type=float, default=1e6, help="Edges per square degree"
+    )
+    parser.add_argument("--dumps", type=str, help="Directory of the generated dumps")
+    parser.add_argument("--workers", type=int, default=None, help="Loader processes")
+    parser.add_argument("--requests", "-n", type=int, default=500)
+    parser.add_argument(
+        "--request-log", type=str, help="JSON lines with the requests to replay"
+    )
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--http", type=str, help="Base URL of a running API")
+    parser.add_argument("--concurrency", "-c", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--no-container",
+        action="store_true",
+        help="Use the database configured by the environment",
+    )
+    parser.add_argument("--port", type=int, default=55432, help="Port of the container")
+    parser.add_argument("--output", "-o", type=str, help="JSON file of the results")
+    args = parser.parse_args()
+
+    container = None if args.no_container else "sm2t-benchmark"
+    if container is not None:
+        start_postgis(container, args.port)
+    try:
+        results = run_suite(args)
+    finally:
+        if container is not None:
+            stop_postgis(container)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        Path(args.output).write_text(output)
+    else:
+        sys.stdout.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Generate synthetic city dumps as consumed by populate_database.py.
+
+Each city is written as edges_<city>.sql and speed_predicted_<city>.sql in the
+COPY format of pg_dump. Segments are short line strings, denser towards the city
+centre, with 24 hourly speeds of which some are missing as in the predicted data.
+
+    python -m benchmarks.synthetic_city --output /tmp/sm2t-dumps --city alpha \
+        --city beta --edges 200000 --density 2000000
+"""
+
+import argparse
+import json
+import math
+import random
+import struct
+from pathlib import Path
+
+# Centres of the generated cities, one after the other
+CITY_CENTRES = [
+    (13.4, 52.52),
+    (8.68, 49.41),
+    (2.35, 48.86),
+    (-0.13, 51.51),
+    (-73.99, 40.73),
+    (139.69, 35.69),
+]
+
+
+def ewkb_linestring(coords):
+    """
+    Hex encoded EWKB of a line string with SRID 4326, as written by pg_dump
+    :param coords: List of (lon, lat)
+    :return: str
+    """
+    data = struct.pack("<BII", 1, 0x20000002, 4326) + struct.pack("<I", len(coords))
+    for lon, lat in coords:
+        data += struct.pack("<dd", lon, lat)
+    return data.hex().upper()
+
+
+def city_extent(centre, n_edges: int, density: float):
+    """
+    Square extent of a city
+    :param centre: Centre (lon, lat)
+    :param n_edges: Number of segments
+    :param density: Segments per square degree
+    :return: Bounding box (min_lon, min_lat, max_lon, max_lat)
+    """
+    half = math.sqrt(n_edges / density) / 2
+    return centre[0] - half, centre[1] - half, centre[0] + half, centre[1] + half
+
+
+def random_segment(rng, extent, clustering: float):
+    """
+    Random line string of 2 to 4 points within an extent
+    :param rng: random.Random
+    :param extent: Bounding box (min_lon, min_lat, max_lon, max_lat)
+    :param clustering: Share of segments drawn around the centre instead of uniformly
+    :return: List of (lon, lat)
+    """
+    half = (extent[2] - extent[0]) / 2
+    centre = (extent[0] + half, extent[1] + half)
+    if rng.random() < clustering:
+        lon = min(extent[2], max(extent[0], rng.gauss(centre[0], half / 3)))
+        lat = min(extent[3], max(extent[1], rng.gauss(centre[1], half / 3)))
+    else:
+        lon = rng.uniform(extent[0], extent[2])
+        lat = rng.uniform(extent[1], extent[3])
+    coords = [(lon, lat)]
+    angle = rng.uniform(0, 2 * math.pi)
+    for _ in range(rng.randint(1, 3)):
+        angle += rng.uniform(-0.5, 0.5)
+        length = rng.uniform(0.0002, 0.001)
+        lon += length * math.cos(angle)
+        lat += length * math.sin(angle)
+        coords.append((lon, lat))
+    return coords
+
+
+def hourly_speeds(rng, missing: float):
+    """
+    Speeds of a segment for the 24 hours of day with slower traffic at rush hours
+    :param rng: random.Random
+    :param missing: Probability that the speed of an hour is missing
+    :return: List of (hour_of_day, speed_kph_p85)
+    """
+    free_flow = rng.choice([30, 50, 50, 50, 70, 100])
+    speeds = []
+    for hour in range(24):
+        if rng.random() < missing:
+            continue
+        rush_hour = (
+            1
+            - 0.3 * math.exp(-((hour - 8) ** 2) / 4)
+            - 0.3 * math.exp(-((hour - 17) ** 2) / 4)
+        )
+        speeds.append(
+            (hour, max(5, int(free_flow * rush_hour * rng.uniform(0.9, 1.1))))
+        )
+    return speeds
+
+
+def write_city_dumps(
+    output_dir,
+    city: str,
+    n_edges: int,
+    density: float,
+    centre=None,
+    clustering: float = 0.5,
+    missing: float = 0.1,
+    seed: int = 0,
+):
+    """
+    Write the edges and speed dumps of a synthetic city
+    :param output_dir: Directory of the dumps
+    :param city: Name of the city
+    :param n_edges: Number of segments
+    :param density: Segments per square degree, which sets the extent of the city
+    :param centre: Centre (lon, lat) of the city
+    :param clustering: Share of segments drawn around the centre instead of uniformly
+    :param missing: Probability that the speed of an hour is missing
+    :param seed: Seed of the random number generator
+    :return: Dictionary with the extent and the number of edges and speed rows
+    """
+    rng = random.Random(f"{seed}-{city}")
+    extent = city_extent(centre or CITY_CENTRES[0], n_edges, density)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    n_speed = 0
+    with open(output_dir / f"edges_{city}.sql", "w") as edges, open(
+        output_dir / f"speed_predicted_{city}.sql", "w"
+    ) as speed:
+        edges.write("SET client_encoding = 'UTF8';\n")
+        edges.write(
+            f"COPY public.edges_{city} (fid, osm_way_id, osm_start_node_id, osm_end_node_id, geometry) FROM stdin;\n"
+        )
+        speed.write("SET client_encoding = 'UTF8';\n")
+        speed.write(
+            f"COPY public.speed_predicted_{city} (fid, hour_of_day, speed_kph_p85) FROM stdin;\n"
+        )
+        for fid in range(1, n_edges + 1):
+            # Consecutive segments share OSM ways and nodes as in the real data
+            osm_way_id = 1000000 + fid // 4
+            start_node = 5000000 + fid
+            coords = random_segment(rng, extent, clustering)
+            edges.write(
+                f"{fid}\t{osm_way_id}\t{start_node}\t{start_node + 1}\t{ewkb_linestring(coords)}\n"
+            )
+            for hour, value in hourly_speeds(rng, missing):
+                speed.write(f"{fid}\t{hour}\t{value}\n")
+                n_speed += 1
+        edges.write("\\.\n")
+        speed.write("\\.\n")
+    return {"extent": list(extent), "edges": n_edges, "speed": n_speed}
+
+
+def write_dumps(output_dir, cities, n_edges: int, density: float, seed: int = 0):
+    """
+    Write the dumps of several synthetic cities with their centres taken from CITY_CENTRES
+    :param output_dir: Directory of the dumps
+    :param cities: Names of the cities
+    :param n_edges: Number of segments per city
+    :param density: Segments per square degree
+    :param seed: Seed of the random number generator
+    :return: Dictionary of city name and the result of write_city_dumps
+    """
+    return {
+        city: write_city_dumps(
+            output_dir,
+            city,
+            n_edges,
+            density,
+            centre=CITY_CENTRES[i % len(CITY_CENTRES)],
+            seed=seed,
+        )
+        for i, city in enumerate(cities)
+    }
+
+
+def main():
+    """Generate dumps"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--output", "-o", type=str, required=True)
+    parser.add_argument("--city", action="append", help="Name of a city")
+    parser.add_argument("--edges", type=int, default=100000, help="Edges per city")
+    parser.add_argument(
+        "--density", type=float, default=1e6, help="Edges per square degree"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    cities = write_dumps(
+        args.output, args.city or ["synthetic"], args.edges, args.density, args.seed
+    )
+    print(json.dumps(cities, indent=2))
+
+
+if __name__ == "__main__":
+    main()
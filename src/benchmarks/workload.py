@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Replay bounding box workloads against load_speed_by_bbox and the HTTP API.
+
+A workload is a list of requests, each a dictionary with the query parameters of
+/traffic/csv, e.g. {"bbox": "13.38,52.51,13.39,52.52", "hours": "7,8"}. It is either
+read from a request log with one JSON request per line or drawn from a distribution
+of bounding box sizes and locations.
+"""
+
+import json
+import math
+import random
+import statistics
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.loadtest import percentile
+
+
+def read_request_log(path):
+    """
+    Read a request log with one JSON request per line. Lines without bbox are skipped.
+    :param path: Path of the log
+    :return: List of requests
+    """
+    workload = []
+    with open(path) as src:
+        for line in src:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            if not isinstance(entry, dict) or "bbox" not in entry:
+                continue
+            for key in ("bbox", "hours"):
+                if isinstance(entry.get(key), list):
+                    entry[key] = ",".join(str(x) for x in entry[key])
+            workload.append(entry)
+    return workload
+
+
+def generate_workload(
+    extent,
+    n: int,
+    min_size: float = 0.002,
+    max_size: float = 0.1,
+    hotspot: float = 0.7,
+    seed: int = 0,
+):
+    """
+    Draw a workload of bounding boxes. Sizes are log-uniform, so small boxes as
+    requested by map clients are more frequent than large ones. Most boxes are
+    located around the centre of the extent, the others uniformly.
+    :param extent: Bounding box (min_lon, min_lat, max_lon, max_lat)
+    :param n: Number of requests
+    :param min_size: Smallest width and height of the boxes in degree
+    :param max_size: Largest width and height of the boxes in degree
+    :param hotspot: Share of boxes located around the centre
+    :param seed: Seed of the random number generator
+    :return: List of requests
+    """
+    rng = random.Random(seed)
+    centre = ((extent[0] + extent[2]) / 2, (extent[1] + extent[3]) / 2)
+    spread = min(extent[2] - extent[0], extent[3] - extent[1]) / 6
+    workload = []
+    for _ in range(n):
+        size = math.exp(rng.uniform(math.log(min_size), math.log(max_size)))
+        if rng.random() < hotspot:
+            lon, lat = rng.gauss(centre[0], spread), rng.gauss(centre[1], spread)
+        else:
+            lon, lat = rng.uniform(extent[0], extent[2]), rng.uniform(
+                extent[1], extent[3]
+            )
+        bbox = [lon - size / 2, lat - size / 2, lon + size / 2, lat + size / 2]
+        workload.append({"bbox": ",".join(f"{x:.6f}" for x in bbox)})
+    return workload
+
+
+def summarize(latencies, n_errors=0):
+    """
+    Percentiles of request latencies
+    :param latencies: List of latencies in seconds
+    :param n_errors: Number of failed requests
+    :return: Dictionary of p50/p95/p99/mean in milliseconds
+    """
+    if not latencies:
+        return {"requests": n_errors, "errors": n_errors}
+    return {
+        "requests": len(latencies) + n_errors,
+        "errors": n_errors,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "mean_ms": statistics.mean(latencies) * 1000,
+    }
+
+
+def replay_function(workload, conn, memory: bool = True):
+    """
+    Replay a workload against load_speed_by_bbox in this process
+    :param workload: List of requests
+    :param conn: psycopg2.connection object
+    :param memory: Also measure the peak memory allocated per request in a second pass
+    :return: Dictionary of latency percentiles, rows and memory per request
+    """
+    from sm2t.database import load_speed_by_bbox
+    from sm2t.utils import parse_hours
+
+    def run(request):
+        bbox = [float(x) for x in request["bbox"].split(",")]
+        hours, _ = parse_hours(
+            request.get("hours"), request.get("hour_from"), request.get("hour_to")
+        )
+        return load_speed_by_bbox(
+            bbox, conn, hours=hours, wide=request.get("layout") == "wide"
+        )
+
+    latencies = []
+    n_rows = 0
+    for request in workload:
+        start = time.perf_counter()
+        n_rows += len(run(request))
+        latencies.append(time.perf_counter() - start)
+    result = summarize(latencies)
+    result["rows"] = n_rows
+
+    if memory:
+        # tracemalloc slows down allocations, so memory is measured separately
+        peaks = []
+        for request in workload:
+            tracemalloc.start()
+            run(request)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        result["memory_p50_kb"] = percentile(peaks, 50) / 1024
+        result["memory_p95_kb"] = percentile(peaks, 95) / 1024
+        result["memory_max_kb"] = max(peaks) / 1024
+    return result
+
+
+def replay_http(workload, base_url: str, concurrency: int = 8):
+    """
+    Replay a workload against a running API
+    :param workload: List of requests
+    :param base_url: Base URL of the API, e.g. http://localhost:8080/api/v1/
+    :param concurrency: Number of concurrent clients
+    :return: Dictionary of latency percentiles, throughput and bytes per request
+    """
+    import requests
+
+    local = threading.local()
+
+    def fetch(request):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        start = time.perf_counter()
+        try:
+            response = local.session.get(base_url + "traffic/csv", params=request)
+            ok = response.status_code == 200 and not response.headers.get(
+                "Content-Type", ""
+            ).startswith("application/json")
+            n_bytes = len(response.content)
+        except requests.RequestException:
+            ok = False
+            n_bytes = 0
+        return time.perf_counter() - start, ok, n_bytes
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(fetch, workload))
+    duration = time.perf_counter() - start
+
+    result = summarize(
+        [latency for latency, ok, _ in results if ok],
+        sum(1 for _, ok, _ in results if not ok),
+    )
+    result["throughput_rps"] = len(results) / duration
+    result["bytes_mean"] = statistics.mean(n_bytes for _, _, n_bytes in results)
+    return result
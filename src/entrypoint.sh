@@ -1,3 +1,11 @@
 #!/usr/bin/env bash
 python ./populate_database.py
-uwsgi uwsgi.ini
+if [ -n "${PROMETHEUS_MULTIPROC_DIR}" ]; then
+    # Metrics of previous runs must not be aggregated
+    rm -rf "${PROMETHEUS_MULTIPROC_DIR}" && mkdir -p "${PROMETHEUS_MULTIPROC_DIR}"
+fi
+if [ "${SERVER_MODE}" = "asgi" ]; then
+    uvicorn asgi:app --host 0.0.0.0 --port 5000 --workers "${ASGI_WORKERS:-1}"
+else
+    uwsgi uwsgi.ini
+fi
@@ -1,11 +1,24 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 """Fill database with highway and speed data"""
+import argparse
+import hashlib
 import os
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 import geopandas as gpd
-from sm2t.database import execute_query, open_engine
+from sm2t.database import (
+    PRIMARY_SHARD,
+    database_address,
+    execute_query,
+    get_dataset_version,
+    open_engine,
+    open_connection,
+    live_schema,
+    packed_layout,
+    shard_addresses,
+)
 from geoalchemy2 import Geometry
 from sqlalchemy import inspect
 from sqlalchemy.sql import text
@@ -13,11 +26,32 @@ import re
 from dotenv import load_dotenv
 from sm2t.sql_utils import get_engine_from_environment
 from sm2t.utils import init_logger
+from sm2t.snapshots import (
+    export_city_snapshot,
+    read_snapshot_index,
+    snapshots_available,
+    write_snapshot_index,
+)
+from sm2t.memory_index import INDEX_FORMAT, export_index, read_current
+from sm2t.data_version import content_hash, write_version_file
+from render_tiles import render_archive
 
 load_dotenv("../.env", verbose=True)
 
 logger = init_logger("sm2t-api-populate-database")
 
+HIGHWAYS_COLUMNS = [
+    "fid",
+    "osm_way_id",
+    "osm_start_node_id",
+    "osm_end_node_id",
+    "geometry",
+]
+SPEED_TABLE_COLUMNS = ["fid", "hour_of_day", "speed_kph_p85"]
+FID_OFFSET_STEP = int(10e10)
+POPULATE_LOCK_KEY = 7281446
+COPY_HEADER = re.compile(r"^COPY\s+(\S+)\s*\(([^)]*)\)\s+FROM\s+stdin\s*;", re.I)
+
 
 def import_table(table_file):
     """
@@ -26,14 +60,15 @@ def import_table(table_file):
     :return:
     """
     os.environ["PGPASSWORD"] = os.environ["POSTGRES_PASSWORD"]
+    address = database_address()
     cmd = [
         "psql",
         "-d",
-        os.environ["POSTGRES_DB"],
+        address["dbname"],
         "-p",
-        os.environ["POSTGRES_PORT"],
+        address["port"],
         "-h",
-        os.environ["HOST"],
+        address["host"],
         "-U",
         os.environ["POSTGRES_USER"],
         "<",
@@ -71,10 +106,10 @@ def create_views(engine):
         print(edge_table)
         fid_offset = int(i * 10e10)
         with engine.connect() as con:
-            query = f"UPDATE {edge_table} SET fid = fid + {fid_offset};"
-            con.execute(text(query))
-            query = f"UPDATE {speed_table} SET fid = fid + {fid_offset};"
-            con.execute(text(query))
+            query = f"UPDATE {edge_table} SET fid = fid + :fid_offset;"
+            con.execute(text(query), fid_offset=fid_offset)
+            query = f"UPDATE {speed_table} SET fid = fid + :fid_offset;"
+            con.execute(text(query), fid_offset=fid_offset)
 
     with engine.connect() as con:
         con.execute(text("DROP TABLE IF EXISTS highways;"))
@@ -108,114 +143,341 @@ def create_views(engine):
             con.execute(text(query))
 
 
-def create_index(engine):
+def create_index(engine, schema):
     """
-    Creates spatial index for table
-    :param table_name:
+    Creates primary keys, spatial index and B-tree indexes on the OSM ids. Called once
+    after the bulk load, since maintaining the indexes while loading is much slower.
+    The primary keys also serve lookups by fid. The primary key of speed includes
+    the speed, so queries restricted to some hours of day are answered by an index-only scan.
+    The indexes on osm_way_id and the node pair serve lookups of segments by OSM ids.
+    :param engine:
+    :param schema: Name of the schema holding the tables
     :return:
     """
     with engine.connect() as con:
-        query = "DROP INDEX IF EXISTS highways_geometry_idx;"
+        query = f"DROP INDEX IF EXISTS {schema}.highways_geometry_idx;"
+        con.execute(text(query))
+        query = f"DROP INDEX IF EXISTS {schema}.highways_fid_idx;"
+        con.execute(text(query))
+        query = f"DROP INDEX IF EXISTS {schema}.speed_fid_idx;"
+        con.execute(text(query))
+        query = f"DROP INDEX IF EXISTS {schema}.highways_osm_way_id_idx;"
+        con.execute(text(query))
+        query = f"DROP INDEX IF EXISTS {schema}.highways_osm_nodes_idx;"
         con.execute(text(query))
-        query = "DROP INDEX IF EXISTS highways_fid_idx;"
+        query = f"ALTER TABLE {schema}.highways DROP CONSTRAINT IF EXISTS fid_pk;"
         con.execute(text(query))
-        query = "DROP INDEX IF EXISTS speed_fid_idx;"
+        query = f"ALTER TABLE {schema}.speed DROP CONSTRAINT IF EXISTS fid_hour_pk;"
         con.execute(text(query))
 
         index_query = (
-            "CREATE INDEX highways_geometry_idx ON highways USING GIST(geometry);"
+            f"ALTER TABLE {schema}.highways ADD CONSTRAINT fid_pk PRIMARY KEY (fid);"
         )
         con.execute(text(index_query))
-        index_query = "CREATE INDEX highways_fid_idx ON highways(fid);"
+        index_query = f"ALTER TABLE {schema}.speed ADD CONSTRAINT fid_hour_pk PRIMARY KEY (fid, hour_of_day) INCLUDE (speed_kph_p85);"
         con.execute(text(index_query))
-        index_query = "CREATE INDEX speed_fid_idx ON speed(fid);"
+        index_query = f"CREATE INDEX highways_geometry_idx ON {schema}.highways USING GIST(geometry);"
         con.execute(text(index_query))
+        index_query = (
+            f"CREATE INDEX highways_osm_way_id_idx ON {schema}.highways (osm_way_id);"
+        )
+        con.execute(text(index_query))
+        index_query = f"CREATE INDEX highways_osm_nodes_idx ON {schema}.highways (osm_start_node_id, osm_end_node_id);"
+        con.execute(text(index_query))
+
+
+def hourly_speed_array():
+    """
+    Aggregate expression of the 24 hourly speeds of a segment as smallint array
+    (index = hour_of_day + 1, NULL if there is no prediction)
+    :return: SQL expression
+    """
+    hourly_speeds = ", ".join(
+        f"max(speed_kph_p85) FILTER (WHERE hour_of_day = {hour})" for hour in range(24)
+    )
+    return f"ARRAY[{hourly_speeds}]::smallint[]"
+
+
+def hour_mask():
+    """
+    Aggregate expression of the hours of day with a row in the speed table as bitmask
+    (bit hour_of_day is set), including rows whose speed is NULL
+    :return: SQL expression
+    """
+    return "bit_or(1 << hour_of_day) FILTER (WHERE hour_of_day BETWEEN 0 AND 23)"
 
 
-def create_highways_table(engine):
+def create_packed_table(engine, schema):
+    """
+    Create the table highways_packed, which holds the 24 hourly speeds of each segment
+    as smallint array (index = hour_of_day + 1, NULL if there is no prediction) and
+    the hours with a row in the speed table as bitmask hour_mask, which tells rows
+    whose speed is NULL from missing rows. It is clustered on the spatial index, so segments within a bounding box are
+    stored on contiguous pages. Requires the indexed highways and speed tables.
+    :param engine:
+    :param schema: Name of the schema holding the tables
+    :return:
+    """
+    with engine.connect() as con:
+        query = f"DROP TABLE IF EXISTS {schema}.highways_packed;"
+        con.execute(text(query))
+        query = f"""
+        CREATE TABLE {schema}.highways_packed AS
+        SELECT highways.fid, highways.osm_way_id, highways.osm_start_node_id,
+        highways.osm_end_node_id, highways.geometry, hourly.speeds, hourly.hour_mask
+        FROM {schema}.highways AS highways
+        JOIN (
+          SELECT fid, {hourly_speed_array()} AS speeds, {hour_mask()} AS hour_mask
+          FROM {schema}.speed GROUP BY fid
+        ) AS hourly ON (hourly.fid = highways.fid);
+        """
+        con.execute(text(query))
+        query = f"ALTER TABLE {schema}.highways_packed ADD CONSTRAINT packed_fid_pk PRIMARY KEY (fid);"
+        con.execute(text(query))
+        query = f"CREATE INDEX highways_packed_geometry_idx ON {schema}.highways_packed USING GIST(geometry);"
+        con.execute(text(query))
+        query = f"CREATE INDEX highways_packed_osm_way_id_idx ON {schema}.highways_packed (osm_way_id);"
+        con.execute(text(query))
+        query = f"CREATE INDEX highways_packed_osm_nodes_idx ON {schema}.highways_packed (osm_start_node_id, osm_end_node_id);"
+        con.execute(text(query))
+        query = f"CLUSTER {schema}.highways_packed USING highways_packed_geometry_idx;"
+        con.execute(text(query))
+        query = f"ANALYZE {schema}.highways_packed;"
+        con.execute(text(query))
+
+
+def analyze_tables(engine, schema):
+    """
+    Update planner statistics and the visibility map after the bulk load.
+    Index-only scans skip the table only for pages marked as all-visible by VACUUM.
+    :param engine:
+    :param schema: Name of the schema holding the tables
+    :return:
+    """
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as con:
+        con.execute(text(f"VACUUM ANALYZE {schema}.highways;"))
+        con.execute(text(f"VACUUM ANALYZE {schema}.speed;"))
+
+
+def create_density_table(engine, schema, cell_size: float):
+    """
+    Count the segments and speed rows per cell of a regular grid. The API estimates
+    the cost of requests from these counts (see sm2t.admission). A segment is counted
+    in the cell of the center of its bounding box.
+    :param engine:
+    :param schema: Name of the schema holding the tables
+    :param cell_size: Width and height of a cell in degree
+    :return:
+    """
+    with engine.connect() as con:
+        con.execute(text(f"DROP TABLE IF EXISTS {schema}.segment_density;"))
+        query = f"""
+        CREATE TABLE {schema}.segment_density AS
+        SELECT CAST(:cell_size AS float8) AS cell_degree,
+        floor((ST_XMin(h.geometry) + ST_XMax(h.geometry)) / 2 / :cell_size)::int AS cell_x,
+        floor((ST_YMin(h.geometry) + ST_YMax(h.geometry)) / 2 / :cell_size)::int AS cell_y,
+        count(*) AS segments, sum(s.speed_rows)::bigint AS speed_rows
+        FROM {schema}.highways AS h
+        JOIN (SELECT fid, count(*) AS speed_rows FROM {schema}.speed GROUP BY fid) AS s
+        ON (s.fid = h.fid)
+        GROUP BY cell_x, cell_y;"""
+        con.execute(text(query), cell_size=cell_size)
+
+
+def create_coverage_table(engine, schema, cell_size: float):
+    """
+    List the cells of a regular grid overlapped by the bounding box of any segment.
+    The API answers requests outside these cells without queries and trims bounding
+    boxes to the cells they overlap (see sm2t.coverage).
+    :param engine:
+    :param schema: Name of the schema holding the tables
+    :param cell_size: Width and height of a cell in degree
+    :return:
+    """
+    with engine.connect() as con:
+        con.execute(text(f"DROP TABLE IF EXISTS {schema}.coverage_cells;"))
+        query = f"""
+        CREATE TABLE {schema}.coverage_cells AS
+        SELECT DISTINCT CAST(:cell_size AS float8) AS cell_degree, cell_x, cell_y
+        FROM {schema}.highways AS h,
+        LATERAL generate_series(
+            floor(ST_XMin(h.geometry) / :cell_size)::int,
+            floor(ST_XMax(h.geometry) / :cell_size)::int
+        ) AS cell_x,
+        LATERAL generate_series(
+            floor(ST_YMin(h.geometry) / :cell_size)::int,
+            floor(ST_YMax(h.geometry) / :cell_size)::int
+        ) AS cell_y;"""
+        con.execute(text(query), cell_size=cell_size)
+
+
+def create_highways_table(engine, schema):
     """
     Create the highways table. If it exists drop it.
     :param engine:
+    :param schema: Name of the schema of the table
     :return:
     """
     # Create table for highways
     with engine.connect() as con:
-        query = "DROP TABLE IF EXISTS highways"
+        query = f"DROP TABLE IF EXISTS {schema}.highways"
         con.execute(text(query))
 
-        query = """
-        CREATE TABLE highways (
+        query = f"""
+        CREATE TABLE {schema}.highways (
           fid bigint,
           osm_way_id bigint,
           osm_start_node_id bigint,
           osm_end_node_id bigint,
-          geometry geometry(LINESTRING, 4326),
-          CONSTRAINT fid_pk PRIMARY KEY (fid)
+          geometry geometry(LINESTRING, 4326)
         );"""
         con.execute(text(query))
 
 
-def create_speed_table(engine):
-    """Create tables"""
-
+def create_speed_table(engine, schema):
+    """
+    Create the speed table. If it exists drop it.
+    :param engine:
+    :param schema: Name of the schema of the table
+    :return:
+    """
     with engine.connect() as con:
-        query = "DROP TABLE IF EXISTS speed"
+        query = f"DROP TABLE IF EXISTS {schema}.speed"
         con.execute(text(query))
 
-        query = """
-        CREATE TABLE speed (
+        query = f"""
+        CREATE TABLE {schema}.speed (
           fid bigint,
           hour_of_day int,
-          speed_kph_p85 int,
-          CONSTRAINT fid_hour_pk PRIMARY KEY (fid, hour_of_day)
+          speed_kph_p85 int
         );
         """
         con.execute(text(query))
 
 
-def edit_fid(table_name, engine, fid_offset):
+def create_manifest_table(engine, schema):
     """
-    Offset fid of the table so that they are unique across cities
-    :param table_name:
-    :type table_name:
+    Create the table recording the imported city files, if it does not exist.
     :param engine:
-    :type engine:
+    :param schema: Name of the schema of the table
     :return:
-    :rtype:
     """
-    logger.info(f"Editing fid: {str(int(fid_offset))}")
     with engine.connect() as con:
-        logger.info(f"UPDATE {table_name} SET fid = fid + {int(fid_offset)};")
-        query = f"UPDATE {table_name} SET fid = fid + {str(int(fid_offset))};"
+        query = f"""
+        CREATE TABLE IF NOT EXISTS {schema}.import_manifest (
+          city text PRIMARY KEY,
+          edges_file text NOT NULL,
+          speed_file text NOT NULL,
+          checksum text NOT NULL,
+          size bigint NOT NULL,
+          fid_offset bigint NOT NULL UNIQUE,
+          imported_at timestamptz NOT NULL DEFAULT now()
+        );"""
         con.execute(text(query))
 
 
-def insert_highways(table_name, engine):
+def read_manifest(engine):
     """
-    insert_into_table
+    Read the imported city files
     :param engine:
-    :return:
+    :return: Dictionary of city name and manifest entry
     """
     with engine.connect() as con:
-        query = (
-            f"INSERT INTO highways(fid, osm_way_id, osm_start_node_id, osm_end_node_id, geometry) "
-            f"SELECT fid, osm_way_id, osm_start_node_id, osm_end_node_id, geometry FROM {table_name};"
+        rows = con.execute(
+            text(
+                "SELECT city, edges_file, speed_file, checksum, size, fid_offset, imported_at "
+                "FROM import_manifest;"
+            )
         )
-        con.execute(text(query))
+        return {row["city"]: dict(row) for row in rows}
 
 
-def insert_speed(table_name, engine):
+def table_exists(engine, table_name):
     """
-    insert_into_table
+    Check if a table or index exists
     :param engine:
-    :return:
+    :param table_name:
+    :return: bool
     """
     with engine.connect() as con:
-        query = (
-            f"INSERT INTO speed(fid, hour_of_day, speed_kph_p85) "
-            f"SELECT fid, hour_of_day, speed_kph_p85 FROM {table_name};"
-        )
-        con.execute(text(query))
+        query = "SELECT to_regclass(:name) IS NOT NULL;"
+        return con.execute(text(query), name=table_name).scalar()
+
+
+def packed_table_outdated(engine, schema):
+    """
+    Check if the packed table of a schema lacks the hour_mask column, which tells
+    rows whose speed is NULL from missing rows, and must be built again
+    :param engine:
+    :param schema: Name of the schema
+    :return: bool
+    """
+    if not packed_layout() or not table_exists(engine, f"{schema}.highways_packed"):
+        return False
+    columns = inspect(engine).get_columns("highways_packed", schema=schema)
+    return "hour_mask" not in {column["name"] for column in columns}
+
+
+def file_checksum(files):
+    """
+    SHA-256 checksum and total size of files
+    :param files: List of paths
+    :return: Hex digest, size in bytes
+    """
+    digest = hashlib.sha256()
+    size = 0
+    for path in files:
+        with open(path, "rb") as src:
+            for block in iter(lambda: src.read(2**20), b""):
+                digest.update(block)
+                size += len(block)
+    return digest.hexdigest(), size
+
+
+def find_city_files(input_dir):
+    """
+    Find edges and speed dumps of each city
+    :param input_dir: Path to directory containing data as .sql files
+    :return: List of (city name, edges file, speed file) sorted by city name
+    """
+    cities = []
+    for edges_file in sorted(Path(input_dir).glob("edges_*.sql")):
+        city_name = edges_file.stem.split("_")[1]
+        speed_file = list(Path(input_dir).glob(f"speed_predicted_{city_name}.sql"))
+        if len(speed_file) != 1:
+            logger.warning(f"speed_predicted_{city_name}.sql not found.")
+            continue
+        cities.append((city_name, edges_file, speed_file[0]))
+    return cities
+
+
+def plan_imports(cities, manifest):
+    """
+    Decide which cities need to be (re)imported. A city keeps its fid offset once it
+    has been assigned, so adding or removing cities does not change the ids of others.
+    :param cities: List of (city name, edges file, speed file)
+    :param manifest: Dictionary of city name and manifest entry
+    :return: List of import jobs (city name, edges file, speed file, fid offset, checksum, size),
+    list of cities to be removed
+    """
+    offsets = [entry["fid_offset"] for entry in manifest.values()]
+    next_offset = max(offsets) + FID_OFFSET_STEP if offsets else 0
+    jobs = []
+    for city_name, edges_file, speed_file in cities:
+        checksum, size = file_checksum([edges_file, speed_file])
+        entry = manifest.get(city_name)
+        if entry is not None and entry["checksum"] == checksum:
+            logger.info(f"{city_name} is up to date.")
+            continue
+        if entry is not None:
+            fid_offset = entry["fid_offset"]
+        else:
+            fid_offset = next_offset
+            next_offset += FID_OFFSET_STEP
+        jobs.append((city_name, edges_file, speed_file, fid_offset, checksum, size))
+    city_names = {city[0] for city in cities}
+    removed = sorted(city for city in manifest if city not in city_names)
+    return jobs, removed
 
 
 def drop_table(table_name, engine):
@@ -230,70 +492,856 @@ def drop_table(table_name, engine):
         con.execute(text(query))
 
 
-def populate_database(input_dir: str):
+def parse_copy_header(line: str):
+    """
+    Parse the columns of a COPY ... FROM stdin statement
+    :param line: Line of a SQL dump
+    :return: List of column names or None if the line is no COPY statement
+    """
+    match = COPY_HEADER.match(line)
+    if not match:
+        return None
+    return [column.strip().strip('"') for column in match.group(2).split(",")]
+
+
+def read_copy_columns(dump_file):
+    """
+    Find the COPY statement of a SQL dump as written by pg_dump or ogr2ogr (PGDump)
+    :param dump_file: Path to SQL dump
+    :return: List of column names or None if the dump contains no COPY data
+    """
+    with open(dump_file) as src:
+        for line in src:
+            columns = parse_copy_header(line)
+            if columns:
+                return columns
+    return None
+
+
+def copy_rows(dump_file, columns: list, fid_offset: int):
+    """
+    Read the rows of the COPY block of a SQL dump, keep the requested columns
+    and add the offset to the fid while streaming
+    :param dump_file: Path to SQL dump
+    :param columns: Columns to keep in this order. Must contain fid.
+    :param fid_offset: Offset added to the fid
+    :return: Generator of lines in COPY text format
+    """
+    with open(dump_file) as src:
+        for line in src:
+            dump_columns = parse_copy_header(line)
+            if dump_columns:
+                break
+        else:
+            return
+        indices = [dump_columns.index(column) for column in columns]
+        fid_position = columns.index("fid")
+        for line in src:
+            if line.startswith("\\."):
+                return
+            values = line.rstrip("\n").split("\t")
+            values = [values[i] for i in indices]
+            if values[fid_position] != "\\N":
+                values[fid_position] = str(int(values[fid_position]) + fid_offset)
+            yield "\t".join(values) + "\n"
+
+
+class LineStream:
+    """File-like object reading from an iterator of lines, as required by copy_expert"""
+
+    def __init__(self, lines):
+        self.lines = iter(lines)
+        self.buffer = ""
+        self.n_lines = 0
+
+    def read(self, size=-1):
+        """Read up to size characters"""
+        while size < 0 or len(self.buffer) < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            self.buffer += line
+            self.n_lines += 1
+        if size < 0:
+            size = len(self.buffer)
+        chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+        return chunk
+
+    def readline(self, size=-1):
+        """Read one line"""
+        if self.buffer:
+            chunk, self.buffer = self.buffer, ""
+            return chunk
+        line = next(self.lines, "")
+        if line:
+            self.n_lines += 1
+        return line
+
+
+def copy_table(conn, dump_file, table_name, columns, fid_offset):
+    """
+    Bulk load the data of a SQL dump into a table using COPY
+    :param conn: psycopg2.connection object
+    :param dump_file: Path to SQL dump
+    :param table_name: Target table
+    :param columns: Columns of the target table
+    :param fid_offset: Offset added to the fid
+    :return: Number of rows loaded
+    """
+    stream = LineStream(copy_rows(dump_file, columns, fid_offset))
+    cur = conn.cursor()
+    cur.copy_expert(
+        f"COPY {table_name} ({', '.join(columns)}) FROM STDIN;", stream, size=2**16
+    )
+    cur.close()
+    return stream.n_lines
+
+
+def insert_table(conn, dump_file, table_name, columns, fid_offset):
+    """
+    Fallback for dumps without COPY data: Import the dump into a staging table
+    with psql and insert it with the fid offset applied
+    :param conn: psycopg2.connection object
+    :param dump_file: Path to SQL dump
+    :param table_name: Target table
+    :param columns: Columns of the target table
+    :param fid_offset: Offset added to the fid
+    :return: Number of rows loaded
+    """
+    staging_table = Path(dump_file).stem
+    import_table(dump_file)
+    select_terms = ", ".join(
+        "fid + %(fid_offset)s" if column == "fid" else column for column in columns
+    )
+    cur = conn.cursor()
+    cur.execute(
+        f"INSERT INTO {table_name}({', '.join(columns)}) "
+        f"SELECT {select_terms} FROM {staging_table};",
+        {"fid_offset": int(fid_offset)},
+    )
+    n_rows = cur.rowcount
+    cur.execute(f"DROP TABLE IF EXISTS {staging_table};")
+    cur.close()
+    return n_rows
+
+
+def load_table(conn, dump_file, table_name, columns, fid_offset):
+    """
+    Load the data of a SQL dump into a table
+    :param conn: psycopg2.connection object
+    :param dump_file: Path to SQL dump
+    :param table_name: Target table
+    :param columns: Columns of the target table
+    :param fid_offset: Offset added to the fid
+    :return: Number of rows loaded
+    """
+    if read_copy_columns(dump_file) is None:
+        logger.warning(f"{dump_file} contains no COPY data. Importing it with psql.")
+        return insert_table(conn, dump_file, table_name, columns, fid_offset)
+    return copy_table(conn, dump_file, table_name, columns, fid_offset)
+
+
+def load_city(city_name, edges_file, speed_file, fid_offset, checksum, size, schema):
+    """
+    Load edges and speed data of a city. Runs in a worker process.
+    The manifest is updated in the same transaction.
+    :param city_name: Name of the city
+    :param edges_file: Path to SQL dump of the edges
+    :param speed_file: Path to SQL dump of the predicted speed
+    :param fid_offset: Offset added to the fid, so that they are unique across cities
+    :param checksum: Checksum of the files recorded in the manifest
+    :param size: Size of the files recorded in the manifest
+    :param schema: Schema the data is loaded into
+    :return: Dictionary with number of rows and duration
+    """
+    start = time.perf_counter()
+    conn, message = open_connection(schema)
+    if conn is False:
+        raise RuntimeError(message)
+    try:
+        n_highways = load_table(
+            conn, edges_file, f"{schema}.highways", HIGHWAYS_COLUMNS, fid_offset
+        )
+        n_speed = load_table(
+            conn, speed_file, f"{schema}.speed", SPEED_TABLE_COLUMNS, fid_offset
+        )
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            INSERT INTO {schema}.import_manifest (city, edges_file, speed_file, checksum, size, fid_offset, imported_at)
+            VALUES (%s, %s, %s, %s, %s, %s, now())
+            ON CONFLICT (city) DO UPDATE SET edges_file = EXCLUDED.edges_file,
+            speed_file = EXCLUDED.speed_file, checksum = EXCLUDED.checksum,
+            size = EXCLUDED.size, fid_offset = EXCLUDED.fid_offset, imported_at = now();
+            """,
+            (
+                city_name,
+                Path(edges_file).name,
+                Path(speed_file).name,
+                checksum,
+                size,
+                fid_offset,
+            ),
+        )
+        cur.close()
+        conn.commit()
+    finally:
+        conn.close()
+    return {
+        "city": city_name,
+        "highways": n_highways,
+        "speed": n_speed,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def log_timing(timing):
+    """
+    Log duration and rows/s of a loading step
+    :param timing: Dictionary returned by load_city
+    :return:
+    """
+    n_rows = timing["highways"] + timing["speed"]
+    logger.info(
+        f"{timing['city']}: {timing['highways']} highways, {timing['speed']} speed rows "
+        f"in {timing['seconds']:.1f} s ({n_rows / max(timing['seconds'], 1e-9):.0f} rows/s)"
+    )
+
+
+def bump_dataset_version(engine, schema):
+    """
+    Assign a new version to the data in the database. The API drops its cached
+    data when the version changes. Versions are drawn from a sequence in the public
+    schema, so they are never reused across schema swaps and rollbacks.
+    :param engine:
+    :param schema: Name of the schema holding the data
+    :return:
+    """
+    with engine.connect() as con:
+        query = "CREATE SEQUENCE IF NOT EXISTS public.dataset_version_seq;"
+        con.execute(text(query))
+        query = f"""
+        CREATE TABLE IF NOT EXISTS {schema}.dataset_version (
+          version bigint PRIMARY KEY DEFAULT nextval('public.dataset_version_seq'),
+          created_at timestamptz NOT NULL DEFAULT now()
+        );"""
+        con.execute(text(query))
+        query = f"INSERT INTO {schema}.dataset_version DEFAULT VALUES;"
+        con.execute(text(query))
+
+
+def create_changes_tables(engine):
+    """
+    Create the tables of the changesets between dataset versions. They are kept in the
+    public schema, so they survive schema swaps.
+    :param engine:
+    :return:
+    """
+    with engine.connect() as con:
+        query = """
+        CREATE TABLE IF NOT EXISTS public.dataset_changesets (
+          version bigint PRIMARY KEY,
+          previous_version bigint NOT NULL,
+          added integer NOT NULL,
+          removed integer NOT NULL,
+          changed integer NOT NULL,
+          created_at timestamptz NOT NULL DEFAULT now()
+        );"""
+        con.execute(text(query))
+        query = """
+        CREATE TABLE IF NOT EXISTS public.dataset_changes (
+          version bigint NOT NULL,
+          change text NOT NULL,
+          osm_way_id bigint,
+          osm_start_node_id bigint,
+          osm_end_node_id bigint,
+          speeds smallint[],
+          geometry geometry
+        );"""
+        con.execute(text(query))
+        query = """
+        CREATE INDEX IF NOT EXISTS dataset_changes_version_idx
+        ON public.dataset_changes (version);"""
+        con.execute(text(query))
+        query = """
+        CREATE INDEX IF NOT EXISTS dataset_changes_geometry_idx
+        ON public.dataset_changes USING GIST (geometry);"""
+        con.execute(text(query))
+
+
+def fid_ranges_condition(alias, offsets):
+    """
+    SQL condition selecting the fids of cities
+    :param alias: Alias of the table
+    :param offsets: fid offsets of the cities (see FID_OFFSET_STEP)
+    :return: SQL condition
     """
-    Populate database with edges and predicted speed data from files
+    ranges = [
+        f"({alias}.fid >= {int(offset)} AND {alias}.fid < {int(offset + FID_OFFSET_STEP)})"
+        for offset in sorted(offsets)
+    ]
+    return " OR ".join(ranges) or "false"
+
+
+def segment_speeds_query(schema, offsets):
+    """
+    SQL query of the hourly speeds and the bounding box of the segments of cities,
+    one row per segment
+    :param schema: Data schema
+    :param offsets: fid offsets of the cities
+    :return: SQL query string
+    """
+    return f"""
+        SELECT h.osm_way_id, h.osm_start_node_id, h.osm_end_node_id,
+        {hourly_speed_array()} AS speeds,
+        ST_SetSRID(ST_Extent(h.geometry)::geometry, 4326) AS geometry
+        FROM {schema}.highways AS h
+        JOIN {schema}.speed AS s ON (s.fid = h.fid)
+        WHERE {fid_ranges_condition("h", offsets)}
+        GROUP BY h.osm_way_id, h.osm_start_node_id, h.osm_end_node_id"""
+
+
+def record_changes(engine, live, shadow, old_offsets, new_offsets):
+    """
+    Store the segments whose speeds differ between the live and the shadow schema as
+    changeset of the new dataset version. Only the cities which have been imported or
+    removed are compared, the others are copied unchanged.
+    :param engine:
+    :param live: Name of the live schema
+    :param shadow: Name of the shadow schema holding the new version
+    :param old_offsets: fid offsets of the compared cities in the live schema
+    :param new_offsets: fid offsets of the compared cities in the shadow schema
+    :return: Dictionary with the number of added, removed and changed segments
+    """
+    previous_version = data_status(engine, live)["version"]
+    version = data_status(engine, shadow)["version"]
+    if previous_version is None or version is None:
+        return None
+    create_changes_tables(engine)
+    with engine.begin() as con:
+        query = f"""
+        INSERT INTO public.dataset_changes
+        (version, change, osm_way_id, osm_start_node_id, osm_end_node_id, speeds, geometry)
+        WITH old AS ({segment_speeds_query(live, old_offsets)}
+        ), new AS ({segment_speeds_query(shadow, new_offsets)}
+        )
+        SELECT :version,
+        CASE WHEN old.speeds IS NULL THEN 'added'
+             WHEN new.speeds IS NULL THEN 'removed'
+             ELSE 'changed' END,
+        osm_way_id, osm_start_node_id, osm_end_node_id,
+        new.speeds, coalesce(new.geometry, old.geometry)
+        FROM old FULL OUTER JOIN new
+        USING (osm_way_id, osm_start_node_id, osm_end_node_id)
+        WHERE old.speeds IS DISTINCT FROM new.speeds;"""
+        con.execute(text(query), version=version)
+        query = """
+        SELECT change, count(*) AS n FROM public.dataset_changes
+        WHERE version = :version GROUP BY change;"""
+        counts = {"added": 0, "removed": 0, "changed": 0}
+        for row in con.execute(text(query), version=version):
+            counts[row["change"]] = row["n"]
+        query = """
+        INSERT INTO public.dataset_changesets
+        (version, previous_version, added, removed, changed)
+        VALUES (:version, :previous_version, :added, :removed, :changed);"""
+        con.execute(
+            text(query), version=version, previous_version=previous_version, **counts
+        )
+    logger.info(
+        f"Changes from version {previous_version} to {version}: "
+        f"{counts['added']} added, {counts['removed']} removed, {counts['changed']} changed segments"
+    )
+    return counts
+
+
+def prune_changes(engine, keep: int):
+    """
+    Delete all but the latest changesets
+    :param engine:
+    :param keep: Number of changesets to keep
+    :return:
+    """
+    with engine.begin() as con:
+        query = """
+        SELECT version FROM public.dataset_changesets
+        ORDER BY version DESC OFFSET :keep LIMIT 1;"""
+        oldest_dropped = con.execute(text(query), keep=keep).scalar()
+        if oldest_dropped is None:
+            return
+        for table_name in ["dataset_changes", "dataset_changesets"]:
+            query = f"DELETE FROM public.{table_name} WHERE version <= :version;"
+            con.execute(text(query), version=oldest_dropped)
+
+
+def schema_exists(engine, schema):
+    """
+    Check if a schema exists
+    :param engine:
+    :param schema:
+    :return: bool
+    """
+    with engine.connect() as con:
+        query = "SELECT EXISTS (SELECT 1 FROM pg_namespace WHERE nspname = :schema);"
+        return con.execute(text(query), schema=schema).scalar()
+
+
+def prepare_shadow_schema(engine, shadow):
+    """
+    Create an empty schema the new data version is built in
+    :param engine:
+    :param shadow: Name of the shadow schema
+    :return:
+    """
+    with engine.connect() as con:
+        con.execute(text(f"DROP SCHEMA IF EXISTS {shadow} CASCADE;"))
+        con.execute(text(f"CREATE SCHEMA {shadow};"))
+
+
+def copy_unchanged_cities(engine, live, shadow, manifest):
+    """
+    Copy cities which do not need to be imported again from the live to the shadow schema
+    :param engine:
+    :param live: Name of the live schema
+    :param shadow: Name of the shadow schema
+    :param manifest: Manifest entries of the cities to be copied
+    :return:
+    """
+    tables = [("highways", HIGHWAYS_COLUMNS), ("speed", SPEED_TABLE_COLUMNS)]
+    with engine.connect() as con:
+        for city_name, entry in manifest.items():
+            logger.info(f"Keeping {city_name}.")
+            for table_name, columns in tables:
+                query = (
+                    f"INSERT INTO {shadow}.{table_name} ({', '.join(columns)}) "
+                    f"SELECT {', '.join(columns)} FROM {live}.{table_name} "
+                    f"WHERE fid >= :low AND fid < :high;"
+                )
+                con.execute(
+                    text(query),
+                    low=entry["fid_offset"],
+                    high=entry["fid_offset"] + FID_OFFSET_STEP,
+                )
+            query = (
+                f"INSERT INTO {shadow}.import_manifest "
+                f"SELECT * FROM {live}.import_manifest WHERE city = :city;"
+            )
+            con.execute(text(query), city=city_name)
+
+
+def swap_schemas(engine, live, shadow, previous):
+    """
+    Make the shadow schema live in one transaction. The live schema is kept as
+    previous version for rollbacks. Queries already running on the old version finish on it.
+    :param engine:
+    :param live: Name of the live schema
+    :param shadow: Name of the shadow schema
+    :param previous: Name of the schema the old version is kept in
+    :return:
+    """
+    live_exists = schema_exists(engine, live)
+    with engine.begin() as con:
+        con.execute(text(f"DROP SCHEMA IF EXISTS {previous} CASCADE;"))
+        if live_exists:
+            con.execute(text(f"ALTER SCHEMA {live} RENAME TO {previous};"))
+        con.execute(text(f"ALTER SCHEMA {shadow} RENAME TO {live};"))
+        # Tables of the layout before data schemas were introduced
+        for table_name in ["highways", "speed", "import_manifest", "dataset_version"]:
+            con.execute(text(f"DROP TABLE IF EXISTS public.{table_name};"))
+
+
+def rollback(engine, live, previous):
+    """
+    Swap the live and previous data version
+    :param engine:
+    :param live: Name of the live schema
+    :param previous: Name of the schema the old version is kept in
+    :return:
+    """
+    if not schema_exists(engine, previous):
+        raise RuntimeError(f"There is no previous data version in schema {previous}.")
+    with engine.begin() as con:
+        con.execute(text(f"ALTER SCHEMA {live} RENAME TO {live}_rollback;"))
+        con.execute(text(f"ALTER SCHEMA {previous} RENAME TO {live};"))
+        con.execute(text(f"ALTER SCHEMA {live}_rollback RENAME TO {previous};"))
+    logger.info("Rolled back to previous data version.")
+
+
+def data_status(engine, schema):
+    """
+    Version and cities of the data in a schema
+    :param engine:
+    :param schema: Data schema
+    :return: Dictionary or None if the schema does not exist
+    """
+    if not schema_exists(engine, schema):
+        return None
+    status = {"schema": schema, "version": None, "created_at": None, "cities": []}
+    with engine.connect() as con:
+        if table_exists(engine, f"{schema}.dataset_version"):
+            row = con.execute(
+                text(
+                    f"SELECT version, created_at FROM {schema}.dataset_version "
+                    f"ORDER BY version DESC LIMIT 1;"
+                )
+            ).first()
+            if row is not None:
+                status["version"] = row["version"]
+                status["created_at"] = row["created_at"].isoformat()
+        if table_exists(engine, f"{schema}.import_manifest"):
+            rows = con.execute(
+                text(f"SELECT city FROM {schema}.import_manifest ORDER BY city;")
+            )
+            status["cities"] = [row["city"] for row in rows]
+    return status
+
+
+def update_snapshots(directory):
+    """
+    Export a snapshot file of each city whose data has changed since its last
+    export and remove the snapshots of cities which are no longer imported.
+    :param directory: Snapshot directory
+    :return:
+    """
+    if not snapshots_available():
+        logger.warning("pyarrow is not installed. Snapshots are not exported.")
+        return
+    live = live_schema()
+    engine = get_engine_from_environment()
+    if not table_exists(engine, f"{live}.import_manifest"):
+        return
+    manifest = read_manifest(get_engine_from_environment(schema=live))
+    os.makedirs(directory, exist_ok=True)
+    index = read_snapshot_index(directory)
+
+    conn, message = open_connection()
+    if conn is False:
+        raise ConnectionError(message)
+    try:
+        version = get_dataset_version(conn)
+        for city, entry in sorted(manifest.items()):
+            snapshot = index.get(city)
+            if (
+                snapshot is not None
+                and snapshot["checksum"] == entry["checksum"]
+                and os.path.exists(os.path.join(directory, snapshot["file"]))
+            ):
+                continue
+            start = time.perf_counter()
+            snapshot = export_city_snapshot(
+                conn, directory, city, entry["fid_offset"], FID_OFFSET_STEP
+            )
+            snapshot.update(checksum=entry["checksum"], version=version)
+            index[city] = snapshot
+            write_snapshot_index(directory, index)
+            logger.info(
+                f"Exported snapshot of {city} ({snapshot['rows']} segments) in {time.perf_counter() - start:.1f} s"
+            )
+    finally:
+        conn.close()
+
+    removed = [city for city in index if city not in manifest]
+    removed_files = [index.pop(city)["file"] for city in removed]
+    write_snapshot_index(directory, index)
+    for file_name in removed_files:
+        os.remove(os.path.join(directory, file_name))
+        logger.info(f"Removed snapshot {file_name}")
+
+
+def update_registry(shard):
+    """
+    Record the extents of the cities of a shard in the shard registry of the primary
+    database, which the API uses to route requests to the shards. Cities are
+    registered with the shard which registered them last.
+    :param shard: Name of the shard (see sm2t.database.database_address)
+    :return:
+    """
+    live = live_schema()
+    engine = get_engine_from_environment(shard=shard)
+    cities = []
+    if table_exists(engine, f"{live}.import_manifest"):
+        with engine.connect() as con:
+            query = f"""
+            SELECT m.city, ST_XMin(e.extent) AS min_lon, ST_YMin(e.extent) AS min_lat,
+            ST_XMax(e.extent) AS max_lon, ST_YMax(e.extent) AS max_lat
+            FROM {live}.import_manifest AS m
+            CROSS JOIN LATERAL (
+              SELECT ST_Extent(h.geometry) AS extent FROM {live}.highways AS h
+              WHERE h.fid >= m.fid_offset AND h.fid < m.fid_offset + :step
+            ) AS e
+            WHERE e.extent IS NOT NULL;"""
+            cities = [
+                dict(row) for row in con.execute(text(query), step=FID_OFFSET_STEP)
+            ]
+
+    primary_engine = get_engine_from_environment(shard=PRIMARY_SHARD)
+    with primary_engine.begin() as con:
+        query = """
+        CREATE TABLE IF NOT EXISTS public.city_registry (
+          city text PRIMARY KEY,
+          shard text NOT NULL,
+          min_lon float8 NOT NULL,
+          min_lat float8 NOT NULL,
+          max_lon float8 NOT NULL,
+          max_lat float8 NOT NULL,
+          updated_at timestamptz NOT NULL DEFAULT now()
+        );"""
+        con.execute(text(query))
+        con.execute(
+            text("DELETE FROM public.city_registry WHERE shard = :shard;"),
+            shard=shard,
+        )
+        query = """
+        INSERT INTO public.city_registry (city, shard, min_lon, min_lat, max_lon, max_lat)
+        VALUES (:city, :shard, :min_lon, :min_lat, :max_lon, :max_lat)
+        ON CONFLICT (city) DO UPDATE SET shard = EXCLUDED.shard,
+        min_lon = EXCLUDED.min_lon, min_lat = EXCLUDED.min_lat,
+        max_lon = EXCLUDED.max_lon, max_lat = EXCLUDED.max_lat, updated_at = now();"""
+        for city in cities:
+            con.execute(text(query), shard=shard, **city)
+    logger.info(f"Registered {len(cities)} cities of shard {shard}.")
+
+
+def update_version_file(path):
+    """
+    Write the content hash and creation time of the live data version to the
+    file read by the API for ETag and Last-Modified headers
+    :param path: Path of the data version file
+    :return:
+    """
+    live = live_schema()
+    engine = get_engine_from_environment()
+    status = data_status(engine, live)
+    if status is None or status["version"] is None:
+        logger.warning("There is no live data. The data version file is not written.")
+        return
+    manifest = read_manifest(get_engine_from_environment(schema=live))
+    data_hash = content_hash(manifest)
+    write_version_file(path, status["version"], data_hash, status["created_at"])
+    logger.info(f"Wrote data version {status['version']} ({data_hash[:12]}) to {path}")
+
+
+def update_memory_index(directory):
+    """
+    Export the live data version to the memory index read by the API workers
+    if it is not up to date.
+    :param directory: Directory of the memory index
+    :return:
+    """
+    conn, message = open_connection()
+    if conn is False:
+        raise ConnectionError(message)
+    try:
+        version = get_dataset_version(conn)
+        current = read_current(directory)
+        if (
+            current is not None
+            and current["version"] == version
+            and current.get("format") == INDEX_FORMAT
+        ):
+            logger.info(f"Memory index of version {version} is up to date.")
+            return
+        os.makedirs(directory, exist_ok=True)
+        start = time.perf_counter()
+        current = export_index(
+            conn,
+            directory,
+            version,
+            float(os.getenv("MEMORY_INDEX_CELL_DEGREE", 0.01)),
+        )
+        logger.info(
+            f"Exported memory index of version {version} ({current['segments']} segments) in {time.perf_counter() - start:.1f} s"
+        )
+    finally:
+        conn.close()
+
+
+def populate_database(input_dir: str, workers: int = None):
+    """
+    Populate database with edges and predicted speed data from files. Only cities
+    whose files are new or have changed since the last run are imported. The new
+    data version is built in a shadow schema and swapped in atomically.
     :param input_dir: Path to directory containing data as .sql files. Each file should contain a table.
     The name of the file will be the table name.
-    :return:
+    :param workers: Number of cities loaded in parallel. Defaults to POPULATE_WORKERS or the number of CPUs.
+    :return: Dictionary with the number of imported cities and rows and the duration
     """
-    input_dir = Path(input_dir)
+    start = time.perf_counter()
+    live = live_schema()
+    shadow = f"{live}_next"
     engine = get_engine_from_environment()
+    if workers is None:
+        workers = int(os.getenv("POPULATE_WORKERS", os.cpu_count() or 1))
 
-    create_highways_table(engine)
-    create_speed_table(engine)
+    with engine.connect() as lock_con:
+        # Only one loader may build the shadow schema at a time
+        lock_con.execute(text("SELECT pg_advisory_lock(:key);"), key=POPULATE_LOCK_KEY)
+        try:
+            if table_exists(engine, f"{live}.import_manifest"):
+                manifest = read_manifest(get_engine_from_environment(schema=live))
+            else:
+                manifest = {}
 
-    # edges_tables = find_tables(engine, "edges_*")
-    # speed_tables = find_tables(engine, "speed_predicted_*")
+            jobs, removed = plan_imports(find_city_files(input_dir), manifest)
+            if not jobs and not removed and not packed_table_outdated(engine, live):
+                logger.info("Database is up to date.")
+                return {"cities": 0, "rows": 0, "seconds": time.perf_counter() - start}
+            imported = {job[0] for job in jobs}
+            unchanged = {
+                city: entry
+                for city, entry in manifest.items()
+                if city not in imported and city not in removed
+            }
 
-    # Offsets
-    edges_files = list(input_dir.glob("edges_*.sql"))
-    for i, edges_file in enumerate(edges_files):
+            # Build the new version in a shadow schema while the API keeps serving the live one
+            # All statements of the build name the shadow schema, so that nothing
+            # falls through to the tables of the same name in public
+            prepare_shadow_schema(engine, shadow)
+            create_highways_table(engine, shadow)
+            create_speed_table(engine, shadow)
+            create_manifest_table(engine, shadow)
+            copy_unchanged_cities(engine, live, shadow, unchanged)
 
-        city_name = edges_file.stem.split("_")[1]
-        speed_file = list(input_dir.glob(f"speed_predicted_{city_name}.sql"))
-        if len(speed_file) != 1:
-            logger.warning(f"speed_predicted_{city_name}.sql not found.")
-            continue
-        else:
-            speed_file = speed_file[0]
+            n_rows = 0
+            with ProcessPoolExecutor(
+                max_workers=max(1, min(workers, len(jobs) or 1))
+            ) as pool:
+                futures = []
+                for job in jobs:
+                    logger.info(f"Importing {job[1]} and {job[2]}...")
+                    futures.append(pool.submit(load_city, *job, shadow))
+                for future in as_completed(futures):
+                    timing = future.result()
+                    log_timing(timing)
+                    n_rows += timing["highways"] + timing["speed"]
 
-        fid_offset = int(i * 10e10)
+            index_start = time.perf_counter()
+            create_index(engine, shadow)
+            analyze_tables(engine, shadow)
+            if packed_layout():
+                create_packed_table(engine, shadow)
+            create_density_table(
+                engine, shadow, float(os.getenv("DENSITY_CELL_DEGREE", 0.01))
+            )
+            create_coverage_table(
+                engine, shadow, float(os.getenv("COVERAGE_CELL_DEGREE", 0.01))
+            )
+            logger.info(f"Created indexes in {time.perf_counter() - index_start:.1f} s")
+            bump_dataset_version(engine, shadow)
 
-        logger.info(f"Importing {edges_file}...")
-        import_table(edges_file)
-        edit_fid(edges_file.stem, engine, fid_offset)
-        insert_highways(edges_file.stem, engine)
-        drop_table(edges_file.stem, engine)
+            keep_changes = int(os.getenv("CHANGESET_RETENTION", 10))
+            if manifest and keep_changes > 0:
+                changes_start = time.perf_counter()
+                record_changes(
+                    engine,
+                    live,
+                    shadow,
+                    [
+                        entry["fid_offset"]
+                        for city, entry in manifest.items()
+                        if city in imported or city in removed
+                    ],
+                    [job[3] for job in jobs],
+                )
+                prune_changes(engine, keep_changes)
+                logger.info(
+                    f"Recorded changes in {time.perf_counter() - changes_start:.1f} s"
+                )
 
-        logger.info(f"Importing {speed_file}...")
-        import_table(speed_file)
-        edit_fid(speed_file.stem, engine, fid_offset)
-        insert_speed(speed_file.stem, engine)
-        drop_table(speed_file.stem, engine)
+            swap_schemas(engine, live, shadow, f"{live}_previous")
+        finally:
+            lock_con.execute(
+                text("SELECT pg_advisory_unlock(:key);"), key=POPULATE_LOCK_KEY
+            )
 
-    # Create views for edges and speed data of all cities
-    create_index(engine)
+    duration = time.perf_counter() - start
+    logger.info(
+        f"Loaded {len(jobs)} cities, {n_rows} rows in {duration:.1f} s ({n_rows / duration:.0f} rows/s)"
+    )
+    return {"cities": len(jobs), "rows": n_rows, "seconds": duration}
+
+
+def update_derived_data(shard=None):
+    """
+    Update the shard registry and the files derived from the live data version:
+    snapshots, memory index, tile archive and data version file. These are served
+    from the primary database, so they are only updated after it has been populated.
+    :param shard: Name of the populated shard. Defaults to the primary database.
+    :return:
+    """
+    shard = shard or PRIMARY_SHARD
+    if shard_addresses():
+        update_registry(shard)
+    if shard != PRIMARY_SHARD:
+        logger.info(
+            f"Populated shard {shard}. Files of the primary database are not updated."
+        )
+        return
+    if os.getenv("SNAPSHOT_DIR"):
+        update_snapshots(os.getenv("SNAPSHOT_DIR"))
+    if os.getenv("MEMORY_INDEX_DIR"):
+        update_memory_index(os.getenv("MEMORY_INDEX_DIR"))
+    if os.getenv("TILE_ARCHIVE"):
+        # Pre-render the tiles of the live version, skipped if they are up to date
+        render_archive(os.getenv("TILE_ARCHIVE"))
+    if os.getenv("DATA_VERSION_FILE"):
+        # Written last, so that no ETag of the new version is sent with data of the old one
+        update_version_file(os.getenv("DATA_VERSION_FILE"))
 
 
 if __name__ == "__main__":
 
-    # parser = argparse.ArgumentParser(
-    #    description="Populates database with edges and speed data"
-    # )
-    # parser.add_argument(
-    #    "--inputdir",
-    #    "-i",
-    #    required=True,
-    #    dest="input_dir",
-    #    type=str,
-    #    help="Path to output directory",
-    # )
-
-    # args = parser.parse_args()
-    # input_dir = args.input_dir
-
-    # time.sleep(60)
-    input_dir = os.environ["DB_DUMP_FILE"]
-
-    populate_database(input_dir)
+    parser = argparse.ArgumentParser(
+        description="Populates database with edges and speed data"
+    )
+    parser.add_argument(
+        "--inputdir",
+        "-i",
+        dest="input_dir",
+        type=str,
+        default=os.getenv("DB_DUMP_FILE"),
+        help="Path to directory containing the SQL dumps. Defaults to DB_DUMP_FILE.",
+    )
+    parser.add_argument(
+        "--status",
+        action="store_true",
+        help="Report which data version is live and which is kept for rollbacks",
+    )
+    parser.add_argument(
+        "--rollback",
+        action="store_true",
+        help="Make the previous data version live again",
+    )
+    parser.add_argument(
+        "--shard",
+        type=str,
+        default=os.getenv("DB_SHARD"),
+        help="Shard in DB_SHARDS to populate. Defaults to DB_SHARD or the primary database.",
+    )
+    args = parser.parse_args()
+    if args.shard:
+        # Read by all connections, including those of the loader processes
+        os.environ["DB_SHARD"] = args.shard
+
+    if args.rollback:
+        rollback(
+            get_engine_from_environment(), live_schema(), f"{live_schema()}_previous"
+        )
+    if args.status or args.rollback:
+        engine = get_engine_from_environment()
+        for name, schema in [
+            ("live", live_schema()),
+            ("previous", f"{live_schema()}_previous"),
+        ]:
+            status = data_status(engine, schema)
+            if status is None:
+                print(f"{name}: none")
+            else:
+                print(
+                    f"{name}: version {status['version']} in schema {status['schema']}, "
+                    f"created {status['created_at']}, cities: {', '.join(status['cities'])}"
+                )
+    else:
+        populate_database(args.input_dir)
+    if not args.status:
+        update_derived_data(args.shard)
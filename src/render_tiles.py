@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Pre-render vector tiles of hourly speeds into an MBTiles archive"""
+import argparse
+import json
+import os
+import time
+
+from dotenv import load_dotenv
+
+from sm2t.database import get_dataset_version, open_connection, wide_speed_columns
+from sm2t.tiles import (
+    TILE_LAYER,
+    TileArchive,
+    gzip_tile,
+    min_tile_zoom,
+    render_tile,
+    write_archive,
+)
+from sm2t.utils import init_logger
+
+load_dotenv("../.env", verbose=True)
+
+logger = init_logger("sm2t-api-render-tiles")
+
+
+def occupied_tiles(conn, z: int):
+    """
+    Tiles overlapped by the bounding box of at least one highway segment
+    :param conn: psycopg2.connection object
+    :param z: Zoom level
+    :return: Set of tile indices (x, y) in the XYZ scheme
+    """
+    lat_to_tile = "floor((1 - ln(tan(radians({lat})) + 1 / cos(radians({lat}))) / pi()) / 2 * 2 ^ %(z)s)::int"
+    query = f"""
+        SELECT DISTINCT x, y
+        FROM highways,
+        LATERAL generate_series(
+          floor((ST_XMin(highways.geometry) + 180) / 360 * 2 ^ %(z)s)::int,
+          floor((ST_XMax(highways.geometry) + 180) / 360 * 2 ^ %(z)s)::int
+        ) AS x,
+        LATERAL generate_series(
+          {lat_to_tile.format(lat="ST_YMax(highways.geometry)")},
+          {lat_to_tile.format(lat="ST_YMin(highways.geometry)")}
+        ) AS y;
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute(query, {"z": z})
+        tiles = {(x, y) for x, y in cur.fetchall()}
+    finally:
+        cur.close()
+    conn.commit()
+    return tiles
+
+
+def iter_rendered_tiles(conn, min_zoom: int, max_zoom: int):
+    """
+    Render all tiles holding highway segments. The occupied tiles are determined
+    at the highest zoom level, those of lower zoom levels are their parents.
+    :param conn: psycopg2.connection object
+    :param min_zoom: Lowest zoom level
+    :param max_zoom: Highest zoom level
+    :return: Generator of (z, x, y, gzipped tile)
+    """
+    tiles = occupied_tiles(conn, max_zoom)
+    for z in range(max_zoom, min_zoom - 1, -1):
+        shift = max_zoom - z
+        level_tiles = sorted({(x >> shift, y >> shift) for x, y in tiles})
+        start = time.perf_counter()
+        for x, y in level_tiles:
+            data = render_tile(conn, z, x, y)
+            if data:
+                yield z, x, y, gzip_tile(data)
+        logger.info(
+            f"Rendered {len(level_tiles)} tiles of zoom level {z} in {time.perf_counter() - start:.1f} s"
+        )
+
+
+def render_archive(path: str, min_zoom=None, max_zoom=None, force=False):
+    """
+    Pre-render the tiles of the live dataset version into an MBTiles archive.
+    Nothing is done if the archive already holds this version.
+    :param path: Path of the archive
+    :param min_zoom: Lowest zoom level. Defaults to the lowest level whose tiles
+    are not wider than MAX_BBOX_DEGREE.
+    :param max_zoom: Highest zoom level. Defaults to TILE_MAX_ZOOM or 14.
+    :param force: Render the archive even if it is up to date
+    :return:
+    """
+    if min_zoom is None:
+        min_zoom = min_tile_zoom()
+    if max_zoom is None:
+        max_zoom = int(os.getenv("TILE_MAX_ZOOM", 14))
+
+    conn, message = open_connection()
+    if conn is False:
+        raise ConnectionError(message)
+    try:
+        version = get_dataset_version(conn)
+        archive = TileArchive(path)
+        if (
+            not force
+            and archive.zoom_range() == (min_zoom, max_zoom)
+            and archive.metadata.get("version") == str(version)
+        ):
+            logger.info(f"Tile archive {path} is up to date.")
+            return
+
+        start = time.perf_counter()
+        fields = {column: "Number" for column in wide_speed_columns()}
+        n_tiles = write_archive(
+            path,
+            iter_rendered_tiles(conn, min_zoom, max_zoom),
+            {
+                "minzoom": min_zoom,
+                "maxzoom": max_zoom,
+                "version": version,
+                "json": json.dumps(
+                    {"vector_layers": [{"id": TILE_LAYER, "fields": fields}]}
+                ),
+            },
+        )
+    finally:
+        conn.close()
+    logger.info(
+        f"Wrote {n_tiles} tiles of version {version} to {path} in {time.perf_counter() - start:.1f} s"
+    )
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Pre-renders vector tiles of hourly speeds into an MBTiles archive"
+    )
+    parser.add_argument(
+        "--output",
+        "-o",
+        type=str,
+        default=os.getenv("TILE_ARCHIVE"),
+        help="Path of the MBTiles archive. Defaults to TILE_ARCHIVE.",
+    )
+    parser.add_argument("--minzoom", type=int, default=None, help="Lowest zoom level")
+    parser.add_argument("--maxzoom", type=int, default=None, help="Highest zoom level")
+    parser.add_argument(
+        "--force", action="store_true", help="Render even if the archive is up to date"
+    )
+    args = parser.parse_args()
+    render_archive(args.output, args.minzoom, args.maxzoom, args.force)
@@ -1,13 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-"""__init__"""
+"""__init__
 
-from dotenv import load_dotenv
-import logging.config
-
-load_dotenv("../.env", verbose=True)
-
-try:
-    logging.config.fileConfig("logging.conf", disable_existing_loggers=False)
-except KeyError:
-    print("logging could not be initialized.")
+Importing the package has no side effects. The entry points (api.py, asgi.py,
+populate_database.py, render_tiles.py) load ../.env and the logging configuration.
+"""
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Admission control of requests for speed data
+
+The number of rows of a request is estimated before it is run from the number of
+segments and speed rows per grid cell, which populate_database.py stores in the
+table segment_density. Requests estimated above HEAVY_QUERY_ROWS are heavy and
+must hold one of HEAVY_QUERY_SLOTS slots until their response has been sent, so
+that cheap requests always find a free worker. Each client has a token bucket
+refilled with RATE_LIMIT_RATE tokens per second. Requests take one token plus one
+per HEAVY_QUERY_ROWS estimated rows.
+
+Slots and token buckets are files in ADMISSION_DIR shared by all worker processes.
+Slots are locked with flock, so they are released if a worker dies.
+"""
+
+import fcntl
+import hashlib
+import logging
+import math
+import os
+import time
+
+import numpy as np
+import psycopg2
+
+from sm2t.database import get_dataset_version, pooled_connection
+
+_density_grid = None
+_heavy_slots = None
+_token_buckets = None
+
+
+def overlap_fraction(bbox, cell: tuple, cell_size: float):
+    """
+    Fraction of the area of a grid cell covered by a bounding box
+    :param bbox: Bounding box (min_lon, min_lat, max_lon, max_lat)
+    :param cell: Cell index (x, y)
+    :param cell_size: Width and height of a cell in degree
+    :return: float between 0 and 1
+    """
+    width = min(bbox[2], (cell[0] + 1) * cell_size) - max(bbox[0], cell[0] * cell_size)
+    height = min(bbox[3], (cell[1] + 1) * cell_size) - max(bbox[1], cell[1] * cell_size)
+    return max(width, 0) * max(height, 0) / cell_size**2
+
+
+class DensityGrid:
+    """
+    Number of segments and speed rows per cell of a regular grid, which is read
+    from the table segment_density again when the dataset version changes
+    """
+
+    def __init__(self, version_ttl=60.0):
+        """
+        :param version_ttl: Seconds between checks of the dataset version
+        """
+        self.version_ttl = version_ttl
+        self.version = None
+        self.cell_size = None
+        self.cells = {}
+        self._version_checked = None
+
+    def check_due(self):
+        """Whether the dataset version has not been checked for version_ttl seconds"""
+        return (
+            self._version_checked is None
+            or time.monotonic() - self._version_checked >= self.version_ttl
+        )
+
+    def check_version(self, conn):
+        """
+        Read the grid if the dataset version has changed
+        :param conn: psycopg2.connection object
+        """
+        version = get_dataset_version(conn)
+        self._version_checked = time.monotonic()
+        if version == self.version:
+            return
+        cur = conn.cursor()
+        try:
+            cur.execute(
+                "SELECT cell_degree, cell_x, cell_y, segments, speed_rows "
+                "FROM segment_density;"
+            )
+            rows = cur.fetchall()
+            conn.commit()
+        except psycopg2.errors.UndefinedTable:
+            conn.rollback()
+            rows = []
+        finally:
+            cur.close()
+        self.cell_size = rows[0][0] if rows else None
+        self.cells = {(row[1], row[2]): (row[3], row[4]) for row in rows}
+        self.version = version
+        logging.info(f"Read segment density of {len(rows)} cells of version {version}.")
+
+    def estimate_rows(self, bboxes, hours=None, wide=False):
+        """
+        Estimate the number of rows returned for bounding boxes, assuming that the
+        segments are evenly distributed within a cell. Overlapping boxes are counted twice.
+        :param bboxes: List of bounding boxes (min_lon, min_lat, max_lon, max_lat)
+        :param hours: List of hours of day. If None, all hours are selected.
+        :param wide: If True, one row per segment is returned
+        :return: Number of rows or None if there are no statistics
+        """
+        if self.cell_size is None:
+            return None
+        rows = 0.0
+        for bbox in bboxes:
+            min_x = math.floor(bbox[0] / self.cell_size)
+            min_y = math.floor(bbox[1] / self.cell_size)
+            max_x = math.floor(bbox[2] / self.cell_size)
+            max_y = math.floor(bbox[3] / self.cell_size)
+            for x in range(min_x, max_x + 1):
+                for y in range(min_y, max_y + 1):
+                    counts = self.cells.get((x, y))
+                    if counts is not None:
+                        fraction = overlap_fraction(bbox, (x, y), self.cell_size)
+                        rows += fraction * counts[0 if wide else 1]
+        if not wide and hours is not None:
+            rows *= len(hours) / 24
+        return int(rows)
+
+
+class HeavySlot:
+    """Slot held by a heavy request until its response has been sent"""
+
+    def __init__(self, lock_file):
+        """
+        :param lock_file: File object holding the lock
+        """
+        self.lock_file = lock_file
+
+    def release(self):
+        """Release the slot"""
+        if not self.lock_file.closed:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+            self.lock_file.close()
+
+
+class HeavySlots:
+    """Fixed number of slots for heavy requests shared by all worker processes"""
+
+    def __init__(self, directory, slots=1):
+        """
+        :param directory: Directory of the lock files
+        :param slots: Number of heavy requests served at the same time
+        """
+        self.directory = directory
+        self.slots = slots
+        os.makedirs(directory, exist_ok=True)
+
+    def acquire(self):
+        """
+        Take a free slot without waiting
+        :return: HeavySlot or None if all slots are taken
+        """
+        for i in range(self.slots):
+            lock_file = open(os.path.join(self.directory, f"slot-{i}.lock"), "a")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                continue
+            return HeavySlot(lock_file)
+        return None
+
+
+class TokenBuckets:
+    """
+    Token buckets of clients in a memory-mapped file shared by all worker processes.
+    Clients are hashed to a fixed number of buckets, so rarely two clients share one.
+    """
+
+    def __init__(self, directory, rate: float, burst: float, n_buckets=65536):
+        """
+        :param directory: Directory of the bucket file
+        :param rate: Tokens added to a bucket per second
+        :param burst: Capacity of a bucket
+        :param n_buckets: Number of buckets
+        """
+        self.rate = rate
+        self.burst = burst
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, "buckets")
+        # The file is created and extended under the lock, but never truncated, as
+        # other workers may have mapped it. Missing pages read as full buckets.
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._lock_file = os.fdopen(fd, "rb")
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size < n_buckets * 16:
+                os.ftruncate(fd, n_buckets * 16)
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        # tokens and time of the last update of each bucket. Time 0 is a full bucket.
+        self.buckets = np.memmap(
+            self.path, dtype=np.float64, mode="r+", shape=(n_buckets, 2)
+        )
+
+    def bucket(self, client: str):
+        """Index of the bucket of a client"""
+        digest = hashlib.blake2b(client.encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "little") % len(self.buckets)
+
+    def take(self, client: str, tokens: float = 1):
+        """
+        Take tokens from the bucket of a client
+        :param client: Client identifier, e.g. its address
+        :param tokens: Cost of the request
+        :return: 0 if the tokens have been taken, else the seconds until they are available
+        """
+        i = self.bucket(client)
+        tokens = min(tokens, self.burst)
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            now = time.time()
+            available, updated = self.buckets[i]
+            if updated == 0:
+                available = self.burst
+            available = min(self.burst, available + (now - updated) * self.rate)
+            if available < tokens:
+                return (tokens - available) / self.rate
+            self.buckets[i] = (available - tokens, now)
+            return 0
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+
+def admission_dir():
+    """
+    Directory of the files shared by the worker processes
+    :return: str or None if admission control is disabled
+    """
+    return os.getenv("ADMISSION_DIR") or None
+
+
+def heavy_query_rows():
+    """Estimated number of rows above which a request is heavy"""
+    return int(os.getenv("HEAVY_QUERY_ROWS", 200000))
+
+
+def estimate_rows(bboxes, hours=None, wide=False):
+    """
+    Estimate the number of rows of a request with the density grid of the current
+    process, which is configured by DENSITY_VERSION_TTL
+    :param bboxes: List of bounding boxes (min_lon, min_lat, max_lon, max_lat)
+    :param hours: List of hours of day. If None, all hours are selected.
+    :param wide: If True, one row per segment is returned
+    :return: Number of rows or None if it cannot be estimated
+    """
+    global _density_grid
+    if _density_grid is None:
+        _density_grid = DensityGrid(float(os.getenv("DENSITY_VERSION_TTL", 60)))
+    if _density_grid.check_due():
+        try:
+            with pooled_connection() as conn:
+                _density_grid.check_version(conn)
+        except psycopg2.Error as error:
+            logging.warning(f"Could not read segment density: {error}")
+    return _density_grid.estimate_rows(bboxes, hours, wide)
+
+
+def get_heavy_slots():
+    """
+    Returns the heavy request slots configured by ADMISSION_DIR and HEAVY_QUERY_SLOTS
+    :return: HeavySlots or None if admission control is disabled
+    """
+    global _heavy_slots
+    if admission_dir() is None:
+        return None
+    if _heavy_slots is None:
+        _heavy_slots = HeavySlots(
+            admission_dir(), int(os.getenv("HEAVY_QUERY_SLOTS", 1))
+        )
+    return _heavy_slots
+
+
+def get_token_buckets():
+    """
+    Returns the token buckets of clients configured by ADMISSION_DIR, RATE_LIMIT_RATE
+    and RATE_LIMIT_BURST
+    :return: TokenBuckets or None if rate limits are disabled
+    """
+    global _token_buckets
+    rate = float(os.getenv("RATE_LIMIT_RATE") or 0)
+    if admission_dir() is None or rate <= 0:
+        return None
+    if _token_buckets is None:
+        _token_buckets = TokenBuckets(
+            admission_dir(), rate, float(os.getenv("RATE_LIMIT_BURST") or 10 * rate)
+        )
+    return _token_buckets
@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Tile-aligned cache of speed data"""
+
+import logging
+import math
+import os
+import pickle
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from sm2t import queries
+from sm2t.database import (
+    bboxes_region,
+    get_dataset_version,
+    segments_query,
+)
+from sm2t.utils import boxes_overlap, env_flag, float32_box
+
+
+def tile_range(bbox, tile_size: float):
+    """
+    Tiles of a regular grid covering the bounding box
+    :param bbox: Bounding box (min_lon, min_lat, max_lon, max_lat)
+    :param tile_size: Width and height of a tile in degree
+    :return: List of tile indices (x, y)
+    """
+    min_x = math.floor(bbox[0] / tile_size)
+    min_y = math.floor(bbox[1] / tile_size)
+    max_x = math.floor(bbox[2] / tile_size)
+    max_y = math.floor(bbox[3] / tile_size)
+    return [(x, y) for x in range(min_x, max_x + 1) for y in range(min_y, max_y + 1)]
+
+
+def tile_bbox(tile: tuple, tile_size: float):
+    """
+    Bounding box of a tile
+    :param tile: Tile index (x, y)
+    :param tile_size: Width and height of a tile in degree
+    :return: Bounding box (min_lon, min_lat, max_lon, max_lat)
+    """
+    return (
+        tile[0] * tile_size,
+        tile[1] * tile_size,
+        (tile[0] + 1) * tile_size,
+        (tile[1] + 1) * tile_size,
+    )
+
+
+def group_segments(rows):
+    """
+    Group rows returned by segments_query by highway segment
+    :param rows: Rows ordered by fid
+    :return: List of segments (fid, bbox, osm ids, ((hour_of_day, speed_kph_p85), ...))
+    """
+    segments = []
+    current_fid = None
+    speeds = None
+    for row in rows:
+        if row[0] != current_fid:
+            current_fid = row[0]
+            speeds = []
+            segments.append((row[0], float32_box(row[1:5]), tuple(row[5:8]), speeds))
+        speeds.append((row[8], row[9]))
+    return [
+        (fid, box, osm_ids, tuple(speeds)) for fid, box, osm_ids, speeds in segments
+    ]
+
+
+class TileCache:
+    """
+    LRU cache of speed data stored per tile of a regular grid. Requests are answered
+    by combining the tiles covering the bounding box and clipping segments at its edges.
+    Cached tiles are dropped as soon as the dataset version in the database changes.
+    """
+
+    def __init__(
+        self, tile_size=0.05, max_bytes=64 * 2**20, cache_dir=None, version_ttl=60.0
+    ):
+        """
+        :param tile_size: Width and height of a tile in degree
+        :param max_bytes: Memory budget of the in-memory tier
+        :param cache_dir: Directory of the optional on-disk tier
+        :param version_ttl: Seconds between checks of the dataset version
+        """
+        self.tile_size = tile_size
+        self.max_bytes = max_bytes
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.version_ttl = version_ttl
+        self.version = None
+        self._version_checked = None
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.db_queries = 0
+
+    def stats(self):
+        """Cache counters"""
+        return {
+            "version": self.version,
+            "tiles": len(self._tiles),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "db_queries": self.db_queries,
+        }
+
+    def clear(self):
+        """Drop all tiles held in memory"""
+        with self._lock:
+            self._tiles.clear()
+            self.bytes = 0
+
+    def check_version(self, conn):
+        """
+        Drop cached tiles if the dataset version has changed. The database is
+        asked at most once per version_ttl seconds.
+        :param conn: psycopg2.connection object
+        """
+        now = time.monotonic()
+        if (
+            self._version_checked is not None
+            and now - self._version_checked < self.version_ttl
+        ):
+            return
+        version = get_dataset_version(conn)
+        self._version_checked = now
+        if version != self.version:
+            logging.info(f"Dataset version changed to {version}. Clearing tile cache.")
+            self.clear()
+            self.version = version
+            self._remove_outdated_files()
+
+    def _tile_file(self, tile):
+        """Path of a tile in the on-disk tier"""
+        return self.cache_dir / str(self.version) / f"{tile[0]}_{tile[1]}.pickle"
+
+    def _remove_outdated_files(self):
+        """Remove tiles of other dataset versions from the on-disk tier"""
+        if self.cache_dir is None or not self.cache_dir.exists():
+            return
+        for directory in self.cache_dir.iterdir():
+            if directory.name != str(self.version):
+                shutil.rmtree(directory, ignore_errors=True)
+
+    def _store(self, tile, segments, data=None):
+        """Add a tile to the in-memory tier and evict least recently used tiles"""
+        if data is None:
+            data = pickle.dumps(segments, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            if tile in self._tiles:
+                self.bytes -= self._tiles.pop(tile)[0]
+            self._tiles[tile] = (len(data), segments)
+            self.bytes += len(data)
+            while self.bytes > self.max_bytes and len(self._tiles) > 1:
+                _, (size, _) = self._tiles.popitem(last=False)
+                self.bytes -= size
+                self.evictions += 1
+        return data
+
+    def _load_from_memory(self, tile):
+        """Get a tile from the in-memory tier"""
+        with self._lock:
+            entry = self._tiles.get(tile)
+            if entry is None:
+                return None
+            self._tiles.move_to_end(tile)
+        self.hits += 1
+        return entry[1]
+
+    def _load_from_disk(self, tile):
+        """Get a tile from the on-disk tier"""
+        if self.cache_dir is None:
+            return None
+        try:
+            data = self._tile_file(tile).read_bytes()
+        except FileNotFoundError:
+            return None
+        segments = pickle.loads(data)
+        self._store(tile, segments, data)
+        self.disk_hits += 1
+        return segments
+
+    def _write_to_disk(self, tile, data):
+        """Write a tile to the on-disk tier"""
+        tile_file = self._tile_file(tile)
+        tile_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = tile_file.with_suffix(f".{os.getpid()}.tmp")
+        tmp_file.write_bytes(data)
+        os.replace(tmp_file, tile_file)
+
+    def _load_from_database(self, tiles, conn):
+        """Query the missing tiles from the database in one query"""
+        boxes = {tile: tile_bbox(tile, self.tile_size) for tile in tiles}
+        query, params = segments_query(bboxes_region(list(boxes.values())))
+        cur = conn.cursor()
+        try:
+            queries.execute(cur, query, params)
+            segments = group_segments(cur.fetchall())
+        finally:
+            cur.close()
+        conn.commit()
+        self.db_queries += 1
+
+        loaded = {}
+        for tile in tiles:
+            tile_box = float32_box(boxes[tile])
+            loaded[tile] = [
+                segment for segment in segments if boxes_overlap(segment[1], tile_box)
+            ]
+            data = self._store(tile, loaded[tile])
+            if self.cache_dir is not None:
+                self._write_to_disk(tile, data)
+            self.misses += 1
+        return loaded
+
+    def get_tiles(self, bboxes, conn):
+        """
+        Get the tiles covering one or several bounding boxes
+        :param bboxes: List of bounding boxes (min_lon, min_lat, max_lon, max_lat)
+        :param conn: psycopg2.connection object used for tiles which are not cached
+        :return: Dictionary of tile index and list of segments
+        """
+        self.check_version(conn)
+        tiles = {}
+        missing = []
+        for bbox in bboxes:
+            for tile in tile_range(bbox, self.tile_size):
+                if tile in tiles or tile in missing:
+                    continue
+                segments = self._load_from_memory(tile)
+                if segments is None:
+                    segments = self._load_from_disk(tile)
+                if segments is None:
+                    missing.append(tile)
+                else:
+                    tiles[tile] = segments
+        if missing:
+            tiles.update(self._load_from_database(missing, conn))
+        return tiles
+
+    def iter_speed_by_bboxes(
+        self, bboxes, conn, batch_size=5000, hours=None, wide=False
+    ):
+        """
+        Iterate over speed data within several bounding boxes in batches of rows.
+        Segments overlapping several boxes are returned once.
+        :param bboxes: List of bounding boxes (min_lon, min_lat, max_lon, max_lat)
+        :param conn: psycopg2.connection object used for tiles which are not cached
+        :param batch_size: Number of rows per batch
+        :param hours: List of hours of day to select. If None, all hours are selected.
+        :param wide: If True, one row per segment with one speed column per hour is returned
+        :return: Generator of lists of row tuples (see sm2t.database.SPEED_COLUMNS and
+        sm2t.database.wide_speed_columns)
+        """
+        tiles = self.get_tiles(bboxes, conn)
+        request_boxes = [float32_box(bbox) for bbox in bboxes]
+        selected = None if hours is None else set(hours)
+        seen = set()
+        batch = []
+        for segments in tiles.values():
+            for fid, box, osm_ids, speeds in segments:
+                if fid in seen or not any(
+                    boxes_overlap(box, request_box) for request_box in request_boxes
+                ):
+                    continue
+                seen.add(fid)
+                if selected is not None:
+                    speeds = [speed for speed in speeds if speed[0] in selected]
+                    if not speeds:
+                        continue
+                if wide:
+                    hourly = dict(speeds)
+                    batch.append(
+                        osm_ids
+                        + tuple(hourly.get(hour) for hour in (hours or range(24)))
+                    )
+                else:
+                    batch.extend(osm_ids + speed for speed in speeds)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+    def iter_speed_by_bbox(self, bbox, conn, batch_size=5000, hours=None, wide=False):
+        """
+        Iterate over speed data of specified bounding box in batches of rows
+        :param bbox: Bounding box (min_lon, min_lat, max_lon, max_lat)
+        :param conn: psycopg2.connection object used for tiles which are not cached
+        :param batch_size: Number of rows per batch
+        :param hours: List of hours of day to select. If None, all hours are selected.
+        :param wide: If True, one row per segment with one speed column per hour is returned
+        :return: Generator of lists of row tuples
+        """
+        return self.iter_speed_by_bboxes([bbox], conn, batch_size, hours, wide)
+
+
+_tile_cache = None
+
+
+def get_tile_cache():
+    """
+    Returns the tile cache of the current process configured by the environment variables
+    TILE_CACHE_DEGREE, TILE_CACHE_MAX_MB, TILE_CACHE_DIR and TILE_CACHE_VERSION_TTL.
+    :return: TileCache or None if TILE_CACHE is not enabled
+    """
+    global _tile_cache
+    if not env_flag("TILE_CACHE"):
+        return None
+    if _tile_cache is None:
+        _tile_cache = TileCache(
+            tile_size=float(os.getenv("TILE_CACHE_DEGREE", 0.05)),
+            max_bytes=int(float(os.getenv("TILE_CACHE_MAX_MB", 64)) * 2**20),
+            cache_dir=os.getenv("TILE_CACHE_DIR") or None,
+            version_ttl=float(os.getenv("TILE_CACHE_VERSION_TTL", 60)),
+        )
+    return _tile_cache
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Coverage index of the cities
+
+populate_database.py lists the cells of a regular grid overlapped by the bounding
+box of any segment in the table coverage_cells. Each worker process holds these
+cells in memory, so requests for bounding boxes outside all cities are answered
+without a database connection, and partially covered bounding boxes are trimmed to
+the cells they overlap before they are queried. Trimming keeps all segments of the
+request: a segment whose bounding box overlaps the request lies in occupied cells,
+and the trimmed box is widened by COVERAGE_MARGIN to account for the single
+precision boxes compared by PostGIS.
+"""
+
+import logging
+import math
+import os
+import time
+
+import psycopg2
+
+from sm2t.database import get_dataset_version, pooled_connection, shard_addresses
+from sm2t.utils import env_flag
+
+# Degree added around occupied cells, above the float32 precision of coordinates
+COVERAGE_MARGIN = 1e-4
+
+_coverage_index = None
+
+
+class CoverageIndex:
+    """
+    Cells of a regular grid holding segments, which are read from the table
+    coverage_cells again when the dataset version changes
+    """
+
+    def __init__(self, version_ttl=60.0):
+        """
+        :param version_ttl: Seconds between checks of the dataset version
+        """
+        self.version_ttl = version_ttl
+        self.version = None
+        self.cell_size = None
+        self.cells = frozenset()
+        self._version_checked = None
+
+    def check_due(self):
+        """Whether the dataset version has not been checked for version_ttl seconds"""
+        return (
+            self._version_checked is None
+            or time.monotonic() - self._version_checked >= self.version_ttl
+        )
+
+    def check_version(self, conn):
+        """
+        Read the cells if the dataset version has changed
+        :param conn: psycopg2.connection object
+        """
+        version = get_dataset_version(conn)
+        self._version_checked = time.monotonic()
+        if version == self.version:
+            return
+        cur = conn.cursor()
+        try:
+            cur.execute("SELECT cell_degree, cell_x, cell_y FROM coverage_cells;")
+            rows = cur.fetchall()
+            conn.commit()
+        except psycopg2.errors.UndefinedTable:
+            conn.rollback()
+            rows = []
+        finally:
+            cur.close()
+        self.cell_size = rows[0][0] if rows else None
+        self.cells = frozenset((row[1], row[2]) for row in rows)
+        self.version = version
+        logging.info(f"Read coverage of {len(rows)} cells of version {version}.")
+
+    def occupied_cells(self, bbox):
+        """
+        Occupied cells overlapping a bounding box widened by COVERAGE_MARGIN
+        :param bbox: Bounding box (min_lon, min_lat, max_lon, max_lat)
+        :return: List of cell indices (x, y)
+        """
+        min_x = math.floor((bbox[0] - COVERAGE_MARGIN) / self.cell_size)
+        min_y = math.floor((bbox[1] - COVERAGE_MARGIN) / self.cell_size)
+        max_x = math.floor((bbox[2] + COVERAGE_MARGIN) / self.cell_size)
+        max_y = math.floor((bbox[3] + COVERAGE_MARGIN) / self.cell_size)
+        if (max_x - min_x + 1) * (max_y - min_y + 1) > len(self.cells):
+            return [
+                (x, y)
+                for x, y in self.cells
+                if min_x <= x <= max_x and min_y <= y <= max_y
+            ]
+        return [
+            (x, y)
+            for x in range(min_x, max_x + 1)
+            for y in range(min_y, max_y + 1)
+            if (x, y) in self.cells
+        ]
+
+    def trim(self, bbox):
+        """
+        Trim a bounding box to the occupied cells it overlaps
+        :param bbox: Bounding box (min_lon, min_lat, max_lon, max_lat)
+        :return: Trimmed bounding box, the bounding box if there is no coverage data or
+        None if no segment is within the bounding box
+        """
+        if self.cell_size is None:
+            return bbox
+        cells = self.occupied_cells(bbox)
+        if not cells:
+            return None
+        xs = [cell[0] for cell in cells]
+        ys = [cell[1] for cell in cells]
+        return [
+            max(bbox[0], min(xs) * self.cell_size - COVERAGE_MARGIN),
+            max(bbox[1], min(ys) * self.cell_size - COVERAGE_MARGIN),
+            min(bbox[2], (max(xs) + 1) * self.cell_size + COVERAGE_MARGIN),
+            min(bbox[3], (max(ys) + 1) * self.cell_size + COVERAGE_MARGIN),
+        ]
+
+    def trim_bboxes(self, bboxes):
+        """
+        Trim bounding boxes to the occupied cells and drop those without segments
+        :param bboxes: List of bounding boxes (min_lon, min_lat, max_lon, max_lat)
+        :return: List of trimmed bounding boxes, empty if no segment is within them
+        """
+        trimmed = (self.trim(bbox) for bbox in bboxes)
+        return [bbox for bbox in trimmed if bbox is not None]
+
+    def to_dict(self):
+        """
+        Cells of the index as sent by the /coverage endpoint
+        :return: Dictionary of the dataset version, cell size, extent and cells
+        """
+        cells = sorted(self.cells)
+        extent = None
+        if cells:
+            xs = [cell[0] for cell in cells]
+            ys = [cell[1] for cell in cells]
+            extent = [
+                min(xs) * self.cell_size,
+                min(ys) * self.cell_size,
+                (max(xs) + 1) * self.cell_size,
+                (max(ys) + 1) * self.cell_size,
+            ]
+        return {
+            "data_version": self.version,
+            "cell_degree": self.cell_size,
+            "extent": extent,
+            "cells": [list(cell) for cell in cells],
+        }
+
+
+def get_coverage_index():
+    """
+    Returns the coverage index of the current process configured by COVERAGE_INDEX
+    and COVERAGE_VERSION_TTL. The dataset version is checked with a pooled connection
+    once the TTL has passed.
+    :return: CoverageIndex or None if it is disabled or the data is sharded
+    """
+    global _coverage_index
+    if not env_flag("COVERAGE_INDEX", default=True) or shard_addresses():
+        return None
+    if _coverage_index is None:
+        _coverage_index = CoverageIndex(float(os.getenv("COVERAGE_VERSION_TTL", 60)))
+    if _coverage_index.check_due():
+        try:
+            with pooled_connection() as conn:
+                _coverage_index.check_version(conn)
+        except psycopg2.Error as error:
+            logging.warning(f"Could not read coverage: {error}")
+    return _coverage_index
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Version file describing the live data
+
+populate_database.py writes a content hash of the imported city files and the
+creation time of the live data version to DATA_VERSION_FILE. The API uses it for
+ETag and Last-Modified headers, so conditional requests are answered without
+database queries.
+"""
+
+import datetime
+import hashlib
+import json
+import os
+
+_cached = (None, None)
+
+
+def version_file():
+    """
+    Path of the data version file
+    :return: str or None if DATA_VERSION_FILE is not set
+    """
+    return os.getenv("DATA_VERSION_FILE") or None
+
+
+def content_hash(manifest: dict):
+    """
+    Hash of the imported data, which only changes if the files of a city change
+    :param manifest: Dictionary of city name and manifest entry with checksum
+    :return: Hex encoded SHA-256 hash
+    """
+    digest = hashlib.sha256()
+    for city, entry in sorted(manifest.items()):
+        digest.update(f"{city}\t{entry['checksum']}\n".encode())
+    return digest.hexdigest()
+
+
+def write_version_file(path, version: int, data_hash: str, created_at: str):
+    """
+    Replace the data version file
+    :param path: Path of the file
+    :param version: Dataset version in the database
+    :param data_hash: Content hash of the data (see content_hash)
+    :param created_at: Creation time of the dataset version in ISO format
+    """
+    tmp_file = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_file, "w") as dst:
+        json.dump(
+            {"version": version, "hash": data_hash, "created_at": created_at},
+            dst,
+            indent=2,
+        )
+    os.replace(tmp_file, path)
+
+
+def current_data_version():
+    """
+    Read the data version file. It is parsed again only if it has been replaced.
+    :return: Dictionary (version, hash, created_at) or None if there is no version file
+    """
+    global _cached
+    path = version_file()
+    if path is None:
+        return None
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    key = (path, stat.st_mtime_ns, stat.st_ino)
+    if _cached[0] != key:
+        with open(path) as src:
+            _cached = (key, json.load(src))
+    return _cached[1]
+
+
+def last_modified():
+    """
+    Creation time of the live data version
+    :return: datetime.datetime or None if there is no version file
+    """
+    data_version = current_data_version()
+    if data_version is None:
+        return None
+    return datetime.datetime.fromisoformat(data_version["created_at"])
@@ -1,35 +1,116 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-"""Database management functions"""
+"""Database management functions
+
+geopandas, pandas and sqlalchemy are only needed by ingestion and scripts. They
+are imported by the functions using them, so the API workers do not load them.
+"""
 
 import os
+import time
 import psycopg2
-import geopandas as gpd
-import pandas as pd
 import logging
-from sqlalchemy import create_engine
+from contextlib import contextmanager
+from psycopg2 import pool as pg_pool
+
+from sm2t import queries
+from sm2t.metrics import timed
+
+
+PRIMARY_SHARD = "primary"
+
+
+def shard_addresses():
+    """
+    Database backends holding cities besides the primary database, configured by
+    DB_SHARDS as comma separated name=host:port[/dbname], e.g.
+    shard1=db-shard1:5432,shard2=db-shard2:5432
+    :return: Dictionary of shard name and dictionary of host, port and dbname
+    """
+    addresses = {}
+    for entry in filter(None, os.getenv("DB_SHARDS", "").split(",")):
+        name, address = entry.strip().split("=", 1)
+        host, _, port = address.rpartition(":")
+        port, _, dbname = port.partition("/")
+        addresses[name] = {
+            "host": host,
+            "port": port,
+            "dbname": dbname or os.environ["POSTGRES_DB"],
+        }
+    return addresses
+
+
+def database_address(shard=None):
+    """
+    Host, port and database name of a database backend
+    :param shard: Name of a shard in DB_SHARDS. Defaults to DB_SHARD, which is set while
+    a shard is populated. The primary database at HOST holds the shard registry.
+    :return: Dictionary of host, port and dbname
+    """
+    shard = shard or os.getenv("DB_SHARD") or PRIMARY_SHARD
+    if shard == PRIMARY_SHARD:
+        return {
+            "host": os.environ["HOST"],
+            "port": os.environ["POSTGRES_PORT"],
+            "dbname": os.environ["POSTGRES_DB"],
+        }
+    addresses = shard_addresses()
+    if shard not in addresses:
+        raise ValueError(f"Shard {shard} is not configured in DB_SHARDS.")
+    return addresses[shard]
 
 
-def open_engine():
+def open_engine(schema=None, shard=None):
     """Opens a sqlalchemy engine"""
+    from sqlalchemy import create_engine
+
+    address = database_address(shard)
     return create_engine(
-        f"postgresql://{os.environ['POSTGRES_USER']}:{os.environ['POSTGRES_PASSWORD']}@{os.environ['HOST']}:{os.environ['POSTGRES_PORT']}/{os.environ['POSTGRES_DB']}"
+        f"postgresql://{os.environ['POSTGRES_USER']}:{os.environ['POSTGRES_PASSWORD']}@{address['host']}:{address['port']}/{address['dbname']}",
+        connect_args={"options": search_path_option(schema)},
     )
 
 
-def open_connection():
-    """Connect to the PostgreSQL database server"""
+def live_schema():
+    """Name of the schema holding the data served by the API"""
+    return os.getenv("DB_SCHEMA", "sm2t")
+
+
+def search_path_option(schema=None):
+    """
+    Connection option resolving unqualified table names in the data schema
+    :param schema: Data schema. Defaults to the live schema.
+    :return: Value of the libpq options parameter
+    """
+    return f"-c search_path={schema or live_schema()},public"
+
+
+def connection_parameters(schema=None, shard=None):
+    """
+    Connection parameters of the PostgreSQL database server from the environment
+    :param schema: Data schema. Defaults to the live schema.
+    :param shard: Database backend (see database_address)
+    :return: Dictionary of parameters passed to psycopg2.connect
+    """
+    return {
+        **database_address(shard),
+        "user": os.environ["POSTGRES_USER"],
+        "password": os.environ["POSTGRES_PASSWORD"],
+        "options": search_path_option(schema),
+    }
+
+
+def open_connection(schema=None, shard=None):
+    """
+    Connect to the PostgreSQL database server
+    :param schema: Data schema. Defaults to the live schema.
+    :param shard: Database backend (see database_address)
+    """
     conn = None
     try:
         # connect to the PostgreSQL server
         logging.info("Connecting to the PostgreSQL database...")
-        conn = psycopg2.connect(
-            host=os.environ["HOST"],
-            port=os.environ["POSTGRES_PORT"],
-            dbname=os.environ["POSTGRES_DB"],
-            user=os.environ["POSTGRES_USER"],
-            password=os.environ["POSTGRES_PASSWORD"],
-        )
+        conn = psycopg2.connect(**connection_parameters(schema, shard))
 
         # create a cursor
         cur = conn.cursor()
@@ -49,6 +130,145 @@ def open_connection():
     return conn, "Database connection working."
 
 
+class ConnectionPool(pg_pool.ThreadedConnectionPool):
+    """
+    Connection pool which checks the health of connections when they are checked out.
+    Broken connections are closed and replaced by new ones.
+    """
+
+    def __init__(self, minconn, maxconn, check_interval=30.0, **kwargs):
+        """
+        :param minconn: Number of connections opened on creation of the pool
+        :param maxconn: Maximum number of connections held by the pool
+        :param check_interval: Connections idle for longer than this (seconds) are pinged before use
+        :param kwargs: Connection parameters passed to psycopg2.connect
+        """
+        self.check_interval = check_interval
+        self._last_used = {}
+        super().__init__(minconn, maxconn, **kwargs)
+
+    def is_healthy(self, conn):
+        """
+        Check whether a connection can be used. Only connections which have been idle
+        for longer than check_interval are pinged, so the check usually costs no round trip.
+        :param conn: psycopg2.connection object
+        :return: True if the connection is usable
+        """
+        if conn.closed:
+            return False
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return False
+        last_used = self._last_used.get(id(conn), 0)
+        if time.monotonic() - last_used < self.check_interval:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+        except psycopg2.Error as error:
+            logging.warning(f"Discarding broken database connection: {error}")
+            return False
+        return True
+
+    def getconn(self, key=None):
+        """Check out a healthy connection, recycling broken ones"""
+        # Each attempt either returns a connection or closes one, so the loop terminates.
+        for _ in range(self.maxconn + 1):
+            conn = super().getconn(key)
+            if self.is_healthy(conn):
+                return conn
+            self.putconn(conn, key=key, close=True)
+        raise pg_pool.PoolError("no healthy database connection available")
+
+    def putconn(self, conn, key=None, close=False):
+        """Return a connection to the pool"""
+        if not close and not conn.closed:
+            if (
+                conn.get_transaction_status()
+                != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+            ):
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    close = True
+        if close or conn.closed:
+            self._last_used.pop(id(conn), None)
+        else:
+            self._last_used[id(conn)] = time.monotonic()
+        super().putconn(conn, key=key, close=close)
+
+    def stats(self):
+        """Number of connections in use and idle"""
+        return {"in_use": len(self._used), "idle": len(self._pool)}
+
+
+_pools = {}
+_pool_pid = None
+
+
+def open_pool(shard=None):
+    """
+    Create a connection pool. Its size is set by the environment variables
+    DB_POOL_MIN and DB_POOL_MAX, the health check interval by DB_POOL_CHECK_INTERVAL.
+    :param shard: Database backend (see database_address)
+    :return: ConnectionPool
+    """
+    return ConnectionPool(
+        int(os.getenv("DB_POOL_MIN", 1)),
+        int(os.getenv("DB_POOL_MAX", 4)),
+        check_interval=float(os.getenv("DB_POOL_CHECK_INTERVAL", 30)),
+        **connection_parameters(shard=shard),
+    )
+
+
+def get_pool(shard=None):
+    """
+    Returns the connection pool of a database backend in the current process. Connections
+    must not be shared between forked uWSGI workers, so new pools are created after a fork.
+    :param shard: Database backend (see database_address)
+    :return: ConnectionPool
+    """
+    global _pools, _pool_pid
+    if _pool_pid != os.getpid():
+        _pools = {}
+        _pool_pid = os.getpid()
+    shard = shard or os.getenv("DB_SHARD") or PRIMARY_SHARD
+    if shard not in _pools:
+        _pools[shard] = open_pool(shard)
+    return _pools[shard]
+
+
+def pool_stats():
+    """
+    Connections of the pools of the current process
+    :return: Dictionary of number of connections in use and idle, empty if there is no pool
+    """
+    if not _pools or _pool_pid != os.getpid():
+        return {}
+    stats = {"in_use": 0, "idle": 0}
+    for pool in list(_pools.values()):
+        for state, count in pool.stats().items():
+            stats[state] += count
+    return stats
+
+
+@contextmanager
+def pooled_connection(shard=None):
+    """
+    Borrow a connection from the connection pool of the current process
+    :param shard: Database backend (see database_address). Defaults to the primary database.
+    :return: psycopg2.connection object
+    """
+    pool = get_pool(shard)
+    with timed("connect"):
+        conn = pool.getconn()
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
+
+
 def execute_query(connection, query: str):
     """
     Execute sql query
@@ -76,27 +296,544 @@ def load_highways(bbox: tuple, conn):
     :param conn: psycopg2.connection object
     :return: geopandas.GeoDataFrame
     """
-    bbox_str = ", ".join([str(x) for x in bbox])
-    sql = f"SELECT * FROM highways WHERE highways.geom && ST_MakeEnvelope({bbox_str}, 4326);"
-    highways = gpd.read_postgis(sql, con=conn)
+    import geopandas as gpd
+
+    condition, params = bbox_region(bbox)
+    sql = f"SELECT * FROM highways WHERE {condition.format(alias='highways', table='highways')};"
+    highways = gpd.read_postgis(sql, con=conn, geom_col="geometry", params=params)
     return highways
 
 
-def load_speed_by_bbox(bbox: str, conn):
-    """Load speed data of specified bounding box
+SPEED_COLUMNS = [
+    "osm_way_id",
+    "osm_start_node_id",
+    "osm_end_node_id",
+    "hour_of_day",
+    "speed_kph_p85",
+]
+
+
+def packed_layout():
+    """
+    Whether speed data is read from the packed table highways_packed, which holds
+    the 24 hourly speeds of each segment as array, instead of joining highways and speed
+    """
+    return os.getenv("SPEED_LAYOUT", "long") == "packed"
+
+
+def wide_speed_columns(hours=None):
+    """
+    Columns of the wide layout, which holds one row per segment and one speed column per hour
+    :param hours: Hours of day. Defaults to all 24 hours.
+    :return: List of column names
+    """
+    if hours is None:
+        hours = range(24)
+    return SPEED_COLUMNS[:3] + [f"speed_kph_p85_{hour:02d}" for hour in hours]
+
+
+def bbox_region(bbox, exact=False):
+    """
+    Region of highway segments whose bounding box overlaps a bounding box
     :param bbox: Bounding box (min_lon, min_lat, max_lon, max_lat)
-    :param conn: psycopg2.connection object
-    :return: pandas.DataFrame
+    :param exact: If True, only segments whose geometry intersects the bounding box are
+    selected. The segments found by the spatial index are refined with ST_Intersects.
+    :return: SQL condition with the fields {alias} and {table}, dictionary of query parameters
     """
-    bbox_str = ", ".join([str(x) for x in bbox])
-    query = f"""
-        WITH selection AS (SELECT fid, osm_way_id, osm_start_node_id, osm_end_node_id
+    envelope = (
+        "ST_MakeEnvelope(%(min_lon)s, %(min_lat)s, %(max_lon)s, %(max_lat)s, 4326)"
+    )
+    condition = f"{{alias}}.geometry && {envelope}"
+    if exact:
+        condition += f" AND ST_Intersects({{alias}}.geometry, {envelope})"
+    return condition, {
+        name: float(x)
+        for name, x in zip(["min_lon", "min_lat", "max_lon", "max_lat"], bbox)
+    }
+
+
+def bboxes_region(bboxes, exact=False):
+    """
+    Region of highway segments whose bounding box overlaps any of several bounding boxes.
+    The boxes are joined against the spatial index as one set, and segments
+    overlapping several boxes are selected once.
+    :param bboxes: List of bounding boxes (min_lon, min_lat, max_lon, max_lat)
+    :param exact: If True, only segments whose geometry intersects a bounding box are selected
+    :return: SQL condition with the fields {alias} and {table}, dictionary of query parameters
+    """
+    params = {
+        name: [float(bbox[i]) for bbox in bboxes]
+        for i, name in enumerate(["min_lon", "min_lat", "max_lon", "max_lat"])
+    }
+    envelope = "ST_MakeEnvelope(boxes.min_lon, boxes.min_lat, boxes.max_lon, boxes.max_lat, 4326)"
+    join_condition = f"region.geometry && {envelope}"
+    if exact:
+        join_condition += f" AND ST_Intersects(region.geometry, {envelope})"
+    condition = f"""{{alias}}.fid IN (
+        SELECT region.fid
+        FROM unnest(%(min_lon)s::float8[], %(min_lat)s::float8[], %(max_lon)s::float8[], %(max_lat)s::float8[])
+        AS boxes(min_lon, min_lat, max_lon, max_lat)
+        JOIN {{table}} AS region ON ({join_condition}))"""
+    return condition, params
+
+
+def geometry_region(geometry: str, buffer: float = 0):
+    """
+    Region of highway segments intersecting a geometry
+    :param geometry: GeoJSON geometry in geographic coordinates
+    :param buffer: Buffer around the geometry in degree
+    :return: SQL condition with the fields {alias} and {table}, dictionary of query parameters
+    """
+    shape = "ST_SetSRID(ST_GeomFromGeoJSON(%(geometry)s::text), 4326)"
+    if buffer > 0:
+        shape = f"ST_Buffer({shape}, %(buffer)s)"
+    return f"ST_Intersects({{alias}}.geometry, {shape})", {
+        "geometry": geometry,
+        "buffer": float(buffer),
+    }
+
+
+def fid_range_region(first_fid: int, end_fid: int):
+    """
+    Region of highway segments within a range of fids, e.g. those of one city
+    :param first_fid: First fid of the range
+    :param end_fid: First fid after the range
+    :return: SQL condition with the fields {alias} and {table}, dictionary of query parameters
+    """
+    return "{alias}.fid >= %(first_fid)s AND {alias}.fid < %(end_fid)s", {
+        "first_fid": int(first_fid),
+        "end_fid": int(end_fid),
+    }
+
+
+def osm_way_ids_region(osm_way_ids: list):
+    """
+    Region of highway segments belonging to OSM ways
+    :param osm_way_ids: List of osm_way_ids
+    :return: SQL condition with the fields {alias} and {table}, dictionary of query parameters
+    """
+    return "{alias}.osm_way_id = ANY(%(osm_way_ids)s::bigint[])", {
+        "osm_way_ids": [int(x) for x in osm_way_ids]
+    }
+
+
+def node_pairs_region(node_pairs: list):
+    """
+    Region of highway segments between pairs of OSM nodes
+    :param node_pairs: List of (osm_start_node_id, osm_end_node_id)
+    :return: SQL condition with the fields {alias} and {table}, dictionary of query parameters
+    """
+    condition = """({alias}.osm_start_node_id, {alias}.osm_end_node_id) IN (
+        SELECT * FROM unnest(%(start_node_ids)s::bigint[], %(end_node_ids)s::bigint[]))"""
+    return condition, {
+        "start_node_ids": [int(start) for start, _ in node_pairs],
+        "end_node_ids": [int(end) for _, end in node_pairs],
+    }
+
+
+GEOMETRY_FORMATS = {
+    "wkb": "encode(ST_AsBinary({geometry}), 'hex')",
+    "geojson": "ST_AsGeoJSON({geometry})",
+}
+
+
+def geometry_column(alias: str, geometry: str, simplify: float = 0):
+    """
+    Select expression of the geometry of segments
+    :param alias: Alias of the table holding the geometry
+    :param geometry: Output format of the geometry (see GEOMETRY_FORMATS): hex encoded WKB or GeoJSON
+    :param simplify: Tolerance in degree of the simplification of the geometry, 0 to send it as is
+    :return: SQL expression
+    """
+    column = f"{alias}.geometry"
+    if simplify > 0:
+        column = f"ST_Simplify({column}, %(simplify)s, true)"
+    return GEOMETRY_FORMATS[geometry].format(geometry=column) + " AS geometry"
+
+
+def output_columns(hours=None, wide=False, geometry=None):
+    """
+    Columns of speed data
+    :param hours: List of hours of day to select. If None, all hours are selected.
+    :param wide: If True, the columns of the wide layout (see wide_speed_columns),
+    otherwise those of the long layout (see SPEED_COLUMNS)
+    :param geometry: Output format of the geometry. If set, a column geometry is appended.
+    :return: List of column names
+    """
+    columns = wide_speed_columns(hours) if wide else list(SPEED_COLUMNS)
+    if geometry is not None:
+        columns.append("geometry")
+    return columns
+
+
+def speed_query(region, hours=None, wide=False, geometry=None, simplify=0):
+    """SQL query selecting speed data of highway segments within a region
+    :param region: SQL condition and query parameters (see bbox_region)
+    :param hours: List of hours of day to select. If None, all hours are selected.
+    :param wide: If True, one row per segment with one speed column per hour is selected
+    (see wide_speed_columns), otherwise one row per segment and hour (see SPEED_COLUMNS).
+    :param geometry: Output format of the geometry of the segments (see GEOMETRY_FORMATS).
+    If set, it is selected as last column. In the long layout it is repeated for each hour.
+    :param simplify: Tolerance in degree of the simplification of the geometry
+    :return: SQL query string, dictionary of query parameters
+    """
+    condition, params = region
+    params = dict(params)
+    if hours is not None:
+        params["hours"] = [int(hour) for hour in hours]
+    if geometry is not None and simplify > 0:
+        params["simplify"] = float(simplify)
+    columns = wide_speed_columns(params.get("hours"))[3:]
+    if packed_layout():
+        in_region = condition.format(alias="packed", table="highways_packed")
+        geometry_select = (
+            f", {geometry_column('packed', geometry, simplify)}"
+            if geometry is not None
+            else ""
+        )
+        if wide:
+            hourly_speeds = [
+                f"packed.speeds[{hour + 1}]" for hour in params.get("hours", range(24))
+            ]
+            speed_columns = ", ".join(
+                f"{speed}::int AS {column}"
+                for speed, column in zip(hourly_speeds, columns)
+            )
+            # Segments with a row in the speed table for any of the hours
+            mask = sum(1 << hour for hour in params.get("hours", range(24)))
+            return (
+                f"""
+            SELECT packed.osm_way_id, packed.osm_start_node_id, packed.osm_end_node_id,
+            {speed_columns}{geometry_select}
+            FROM highways_packed AS packed
+            WHERE {in_region}
+            AND packed.hour_mask & {mask} <> 0;
+            """,
+                params,
+            )
+        hour_filter = (
+            "AND hourly.hour - 1 = ANY(%(hours)s)" if hours is not None else ""
+        )
+        # Hours with a row in the speed table, including those whose speed is NULL
+        has_row = "{alias}.hour_mask & (1 << (hourly.hour - 1)::int) <> 0"
+        if geometry is not None:
+            # The geometry is converted once per segment, not once per hour
+            return (
+                f"""
+            WITH selection AS MATERIALIZED (
+              SELECT packed.osm_way_id, packed.osm_start_node_id, packed.osm_end_node_id,
+              packed.speeds, packed.hour_mask{geometry_select}
+              FROM highways_packed AS packed
+              WHERE {in_region})
+            SELECT selection.osm_way_id, selection.osm_start_node_id, selection.osm_end_node_id,
+            (hourly.hour - 1)::int AS hour_of_day, hourly.speed_kph_p85::int AS speed_kph_p85,
+            selection.geometry
+            FROM selection
+            CROSS JOIN LATERAL unnest(selection.speeds) WITH ORDINALITY AS hourly(speed_kph_p85, hour)
+            WHERE {has_row.format(alias="selection")}
+            {hour_filter};
+            """,
+                params,
+            )
+        return (
+            f"""
+        SELECT packed.osm_way_id, packed.osm_start_node_id, packed.osm_end_node_id,
+        (hourly.hour - 1)::int AS hour_of_day, hourly.speed_kph_p85::int AS speed_kph_p85
+        FROM highways_packed AS packed
+        CROSS JOIN LATERAL unnest(packed.speeds) WITH ORDINALITY AS hourly(speed_kph_p85, hour)
+        WHERE {in_region}
+        AND {has_row.format(alias="packed")}
+        {hour_filter};
+        """,
+            params,
+        )
+    in_region = condition.format(alias="highways", table="highways")
+    hour_filter = "AND speed.hour_of_day = ANY(%(hours)s)" if hours is not None else ""
+    if wide:
+        geometry_select = (
+            f", {geometry_column('highways', geometry, simplify)}"
+            if geometry is not None
+            else ""
+        )
+        hourly_speeds = ", ".join(
+            f"max(speed.speed_kph_p85) FILTER (WHERE speed.hour_of_day = {hour}) AS {column}"
+            for hour, column in zip(params.get("hours", range(24)), columns)
+        )
+        return (
+            f"""
+        SELECT highways.osm_way_id, highways.osm_start_node_id, highways.osm_end_node_id,
+        {hourly_speeds}{geometry_select}
+        FROM highways
+        JOIN speed ON (speed.fid = highways.fid)
+        WHERE {in_region}
+        {hour_filter}
+        GROUP BY highways.fid;
+        """,
+            params,
+        )
+    if geometry is not None:
+        # The geometry is converted once per segment, not once per hour
+        geometry_cte = f", {geometry_column('highways', geometry, simplify)}"
+        geometry_select = ", selection.geometry"
+    else:
+        geometry_cte = geometry_select = ""
+    return (
+        f"""
+        WITH selection AS (SELECT fid, osm_way_id, osm_start_node_id, osm_end_node_id{geometry_cte}
         FROM highways
-        WHERE highways.geometry && ST_MakeEnvelope({bbox_str}, 4326))
-        SELECT selection.osm_way_id, selection.osm_start_node_id, selection.osm_end_node_id, speed.hour_of_day, speed.speed_kph_p85
+        WHERE {in_region})
+        SELECT selection.osm_way_id, selection.osm_start_node_id, selection.osm_end_node_id, speed.hour_of_day, speed.speed_kph_p85{geometry_select}
         FROM speed
         LEFT OUTER JOIN selection ON (speed.fid = selection.fid)
-        WHERE speed.fid IN (SELECT fid FROM selection);
+        WHERE speed.fid IN (SELECT fid FROM selection)
+        {hour_filter};
+    """,
+        params,
+    )
+
+
+def speed_by_bbox_query(
+    bbox, hours=None, wide=False, exact=False, geometry=None, simplify=0
+):
+    """SQL query selecting speed data of specified bounding box
+    :param bbox: Bounding box (min_lon, min_lat, max_lon, max_lat)
+    :param hours: List of hours of day to select. If None, all hours are selected.
+    :param wide: If True, one row per segment with one speed column per hour is selected
+    (see wide_speed_columns), otherwise one row per segment and hour (see SPEED_COLUMNS).
+    :param exact: If True, only segments intersecting the bounding box are selected
+    (see bbox_region), otherwise those whose bounding box overlaps it.
+    :param geometry: Output format of the geometry of the segments (see GEOMETRY_FORMATS)
+    :param simplify: Tolerance in degree of the simplification of the geometry
+    :return: SQL query string, dictionary of query parameters
     """
-    df = pd.read_sql_query(query, con=conn)
+    return speed_query(bbox_region(bbox, exact), hours, wide, geometry, simplify)
+
+
+def load_speed_by_bbox(
+    bbox: str, conn=None, hours=None, wide=False, exact=False, geometry=None, simplify=0
+):
+    """Load speed data of specified bounding box
+    :param bbox: Bounding box (min_lon, min_lat, max_lon, max_lat)
+    :param conn: psycopg2.connection object. If None, a connection is borrowed from the pool.
+    :param hours: List of hours of day to select. If None, all hours are selected.
+    :param wide: If True, one row per segment with one speed column per hour is loaded
+    :param exact: If True, only segments intersecting the bounding box are loaded
+    :param geometry: Output format of the geometry of the segments (see GEOMETRY_FORMATS)
+    :param simplify: Tolerance in degree of the simplification of the geometry
+    :return: pandas.DataFrame
+    """
+    import pandas as pd
+
+    if conn is None:
+        with pooled_connection() as conn:
+            return load_speed_by_bbox(
+                bbox, conn, hours, wide, exact, geometry, simplify
+            )
+
+    query, params = speed_by_bbox_query(bbox, hours, wide, exact, geometry, simplify)
+    cur = conn.cursor()
+    try:
+        with timed("query"):
+            queries.execute(cur, query, params)
+            rows = cur.fetchall()
+        with timed("serialize"):
+            columns = [column[0] for column in cur.description]
+            df = pd.DataFrame(rows, columns=columns)
+    finally:
+        cur.close()
+    conn.commit()
     return df
+
+
+def iter_speed(
+    region, conn, batch_size=None, hours=None, wide=False, geometry=None, simplify=0
+):
+    """Iterate over speed data of highway segments within a region in batches of rows.
+    The query is run as prepared statement and the rows are converted to tuples one
+    batch at a time. If prepared statements are disabled, a server-side cursor is used,
+    so only one batch is transferred at a time.
+    :param region: SQL condition and query parameters (see bbox_region)
+    :param conn: psycopg2.connection object
+    :param batch_size: Number of rows per batch. Defaults to STREAM_BATCH_SIZE or 5000.
+    :param hours: List of hours of day to select. If None, all hours are selected.
+    :param wide: If True, one row per segment with one speed column per hour is selected
+    :param geometry: Output format of the geometry of the segments (see GEOMETRY_FORMATS)
+    :param simplify: Tolerance in degree of the simplification of the geometry
+    :return: Generator of lists of row tuples (see output_columns)
+    """
+    if batch_size is None:
+        batch_size = int(os.getenv("STREAM_BATCH_SIZE", 5000))
+    query, params = speed_query(region, hours, wide, geometry, simplify)
+    if queries.prepared_statements_enabled():
+        cur = conn.cursor()
+    else:
+        cur = conn.cursor(name="speed_by_bbox")
+    try:
+        queries.execute(cur, query, params)
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        cur.close()
+
+
+def iter_speed_by_bbox(bbox, conn, batch_size=None, hours=None, wide=False):
+    """Iterate over speed data of specified bounding box in batches of rows.
+    :param bbox: Bounding box (min_lon, min_lat, max_lon, max_lat)
+    :param conn: psycopg2.connection object
+    :param batch_size: Number of rows per batch. Defaults to STREAM_BATCH_SIZE or 5000.
+    :param hours: List of hours of day to select. If None, all hours are selected.
+    :param wide: If True, one row per segment with one speed column per hour is selected
+    :return: Generator of lists of row tuples (see SPEED_COLUMNS and wide_speed_columns)
+    """
+    return iter_speed(bbox_region(bbox), conn, batch_size, hours, wide)
+
+
+def segments_query(region):
+    """SQL query selecting speed data of highway segments within a region together with
+    the fid and the bounding box of each segment, ordered by fid and hour of day
+    :param region: SQL condition and query parameters (see bbox_region)
+    :return: SQL query string, dictionary of query parameters
+    """
+    condition, params = region
+    if packed_layout():
+        return (
+            f"""
+        SELECT packed.fid, ST_XMin(packed.geometry), ST_YMin(packed.geometry),
+        ST_XMax(packed.geometry), ST_YMax(packed.geometry),
+        packed.osm_way_id, packed.osm_start_node_id, packed.osm_end_node_id,
+        (hourly.hour - 1)::int, hourly.speed_kph_p85::int
+        FROM highways_packed AS packed
+        CROSS JOIN LATERAL unnest(packed.speeds) WITH ORDINALITY AS hourly(speed_kph_p85, hour)
+        WHERE {condition.format(alias="packed", table="highways_packed")}
+        AND packed.hour_mask & (1 << (hourly.hour - 1)::int) <> 0
+        ORDER BY packed.fid, hourly.hour;
+        """,
+            params,
+        )
+    return (
+        f"""
+        SELECT highways.fid, ST_XMin(highways.geometry), ST_YMin(highways.geometry),
+        ST_XMax(highways.geometry), ST_YMax(highways.geometry),
+        highways.osm_way_id, highways.osm_start_node_id, highways.osm_end_node_id,
+        speed.hour_of_day, speed.speed_kph_p85
+        FROM highways
+        JOIN speed ON (speed.fid = highways.fid)
+        WHERE {condition.format(alias="highways", table="highways")}
+        ORDER BY highways.fid, speed.hour_of_day;
+    """,
+        params,
+    )
+
+
+def get_dataset_version(conn):
+    """
+    Version of the data in the database. It is increased each time the database is populated.
+    :param conn: psycopg2.connection object
+    :return: Version number, 0 if the database has not been populated yet
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT max(version) FROM dataset_version;")
+        version = cur.fetchone()[0]
+        conn.commit()
+    except psycopg2.errors.UndefinedTable:
+        conn.rollback()
+        version = None
+    finally:
+        cur.close()
+    return version or 0
+
+
+CHANGE_COLUMNS = ["change"] + wide_speed_columns()
+
+
+def changeset_chain(changesets: dict, since: int, version: int):
+    """
+    Versions of the changesets leading from a dataset version to another one
+    :param changesets: Dictionary of version and previous version of each changeset
+    :param since: Dataset version of the client
+    :param version: Live dataset version
+    :return: List of versions, newest first, or None if version cannot be reached from since
+    """
+    chain = []
+    while version != since:
+        if version not in changesets:
+            return None
+        chain.append(version)
+        version = changesets[version]
+    return chain
+
+
+def get_changeset_chain(conn, since: int):
+    """
+    Versions of the changesets between a dataset version and the live one. The chain
+    is broken if changesets have been pruned or the live version has been rolled back.
+    :param conn: psycopg2.connection object
+    :param since: Dataset version of the client
+    :return: List of versions or None if there is no chain, live version
+    """
+    version = get_dataset_version(conn)
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT version, previous_version FROM dataset_changesets;")
+        changesets = dict(cur.fetchall())
+        conn.commit()
+    except psycopg2.errors.UndefinedTable:
+        conn.rollback()
+        changesets = {}
+    finally:
+        cur.close()
+    return changeset_chain(changesets, since, version), version
+
+
+def changes_query(versions: list, region=None):
+    """
+    SQL query selecting the latest change of each segment in changesets. Changes are
+    absolute, so the speeds replace the ones of the client and removed segments have
+    no speeds.
+    :param versions: Versions of the changesets
+    :param region: SQL condition and query parameters (see bbox_region). Defaults to all segments.
+    :return: SQL query string, dictionary of query parameters (see CHANGE_COLUMNS)
+    """
+    condition, params = region if region is not None else ("true", {})
+    speed_columns = ", ".join(
+        f"changes.speeds[{hour + 1}]::int AS speed_kph_p85_{hour:02d}"
+        for hour in range(24)
+    )
+    query = f"""
+        SELECT DISTINCT ON (changes.osm_way_id, changes.osm_start_node_id, changes.osm_end_node_id)
+        changes.change, changes.osm_way_id, changes.osm_start_node_id, changes.osm_end_node_id,
+        {speed_columns}
+        FROM dataset_changes AS changes
+        WHERE changes.version = ANY(%(versions)s)
+        AND {condition.format(alias="changes", table="dataset_changes")}
+        ORDER BY changes.osm_way_id, changes.osm_start_node_id, changes.osm_end_node_id,
+        changes.version DESC;
+    """
+    return query, dict(params, versions=list(versions))
+
+
+def iter_changes(versions: list, conn, region=None, batch_size=None):
+    """Iterate over the changes of segments in changesets in batches of rows
+    :param versions: Versions of the changesets (see get_changeset_chain)
+    :param conn: psycopg2.connection object
+    :param region: SQL condition and query parameters (see bbox_region)
+    :param batch_size: Number of rows per batch. Defaults to STREAM_BATCH_SIZE or 5000.
+    :return: Generator of lists of row tuples (see CHANGE_COLUMNS)
+    """
+    if batch_size is None:
+        batch_size = int(os.getenv("STREAM_BATCH_SIZE", 5000))
+    query, params = changes_query(versions, region)
+    cur = conn.cursor(name="changes")
+    try:
+        cur.execute(query, params)
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        cur.close()
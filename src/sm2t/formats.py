@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Output formats and content encodings of speed data
+
+pyarrow and zstandard are optional. They are imported by the functions producing
+Arrow, Parquet or zstd, so CSV responses are served without loading them.
+"""
+
+import functools
+import importlib.util
+import os
+import zlib
+
+from sm2t.utils import csv_chunks
+
+OUTPUT_FORMATS = {
+    "csv": {"mimetype": "text/csv", "suffix": ".csv"},
+    "arrow": {"mimetype": "application/vnd.apache.arrow.stream", "suffix": ".arrows"},
+    "parquet": {"mimetype": "application/vnd.apache.parquet", "suffix": ".parquet"},
+}
+
+
+@functools.lru_cache(maxsize=None)
+def module_available(name: str):
+    """
+    Check if an optional module is installed without importing it
+    :param name: Name of the module, e.g. pyarrow
+    :return: bool
+    """
+    return importlib.util.find_spec(name) is not None
+
+
+def speed_schema(columns=None):
+    """
+    Arrow schema of speed data with compact integer types. Geometries are strings
+    (hex encoded WKB or GeoJSON).
+    :param columns: Column names. Defaults to the long layout (sm2t.database.SPEED_COLUMNS).
+    :return: pyarrow.Schema
+    """
+    import pyarrow as pa
+
+    if columns is None:
+        columns = [
+            "osm_way_id",
+            "osm_start_node_id",
+            "osm_end_node_id",
+            "hour_of_day",
+            "speed_kph_p85",
+        ]
+    types = {
+        "osm_way_id": pa.int64(),
+        "osm_start_node_id": pa.int64(),
+        "osm_end_node_id": pa.int64(),
+        "hour_of_day": pa.int8(),
+        "geometry": pa.string(),
+        "change": pa.string(),
+    }
+    return pa.schema([(column, types.get(column, pa.int16())) for column in columns])
+
+
+def format_available(output_format: str):
+    """
+    Check if an output format can be produced
+    :param output_format: Name of the format (csv, arrow, parquet)
+    :return: bool
+    """
+    if output_format not in OUTPUT_FORMATS:
+        return False
+    return output_format == "csv" or module_available("pyarrow")
+
+
+def record_batch(rows, schema):
+    """
+    Build an Arrow record batch directly from fetched rows
+    :param rows: List of row tuples
+    :param schema: pyarrow.Schema
+    :return: pyarrow.RecordBatch
+    """
+    import pyarrow as pa
+
+    columns = list(zip(*rows))
+    return pa.RecordBatch.from_arrays(
+        [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+        schema=schema,
+    )
+
+
+class DrainingSink:
+    """
+    Write-only file object whose content is collected by drain(). It keeps
+    track of the position, so that writers relying on tell() work while streaming.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        """Append data"""
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        """Number of bytes written so far"""
+        return self.position
+
+    def flush(self):
+        """Nothing to flush"""
+
+    def close(self):
+        """Mark as closed"""
+        self.closed = True
+
+    def drain(self):
+        """Return and forget the data written since the last call"""
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def arrow_chunks(batches, columns=None):
+    """
+    Encode batches of rows as Arrow IPC stream
+    :param batches: Iterable of lists of row tuples
+    :param columns: Column names of the rows
+    :return: Generator of bytes
+    """
+    import pyarrow as pa
+
+    schema = speed_schema(columns)
+    sink = DrainingSink()
+    options = pa.ipc.IpcWriteOptions(
+        compression=os.getenv("ARROW_COMPRESSION", "zstd") or None
+    )
+    with pa.ipc.new_stream(
+        pa.PythonFile(sink, mode="w"), schema, options=options
+    ) as writer:
+        yield sink.drain()
+        for rows in batches:
+            writer.write_batch(record_batch(rows, schema))
+            yield sink.drain()
+    yield sink.drain()
+
+
+def parquet_chunks(batches, columns=None):
+    """
+    Encode batches of rows as Parquet file with dictionary and RLE encoding.
+    Each batch becomes a row group, which is sent as soon as it is written.
+    :param batches: Iterable of lists of row tuples
+    :param columns: Column names of the rows
+    :return: Generator of bytes
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = speed_schema(columns)
+    sink = DrainingSink()
+    with pq.ParquetWriter(
+        pa.PythonFile(sink, mode="w"),
+        schema,
+        compression=os.getenv("PARQUET_COMPRESSION", "zstd"),
+        use_dictionary=True,
+    ) as writer:
+        for rows in batches:
+            writer.write_batch(record_batch(rows, schema))
+            yield sink.drain()
+    yield sink.drain()
+
+
+def encode_chunks(batches, output_format: str, columns: list):
+    """
+    Encode batches of rows in an output format
+    :param batches: Iterable of lists of row tuples
+    :param output_format: Name of the format (csv, arrow, parquet)
+    :param columns: Column names of the rows
+    :return: Generator of bytes
+    """
+    if output_format == "arrow":
+        return arrow_chunks(batches, columns)
+    if output_format == "parquet":
+        return parquet_chunks(batches, columns)
+    return csv_chunks(batches, columns)
+
+
+def encoding_weights(accept_encoding: str):
+    """
+    Quality values of the content encodings listed by the client (RFC 9110, 12.5.3)
+    :param accept_encoding: Value of the Accept-Encoding request header
+    :return: Dictionary of encoding name (or "*") and quality value
+    """
+    weights = {}
+    for item in (accept_encoding or "").split(","):
+        parts = item.strip().split(";")
+        name = parts[0].strip().lower()
+        if not name:
+            continue
+        weight = 1.0
+        for part in parts[1:]:
+            key, _, value = part.strip().partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    weight = float(value.strip())
+                except ValueError:
+                    weight = None
+        if weight is not None:
+            weights[name] = weight
+    return weights
+
+
+def accepts_encoding(accept_encoding: str, encoding: str):
+    """
+    Whether the client accepts a content encoding, listed by name or by "*".
+    An encoding with quality value 0 is refused.
+    :param accept_encoding: Value of the Accept-Encoding request header
+    :param encoding: Name of the encoding, e.g. gzip
+    :return: bool
+    """
+    weights = encoding_weights(accept_encoding)
+    return weights.get(encoding, weights.get("*", 0)) > 0
+
+
+def negotiate_encoding(accept_encoding: str):
+    """
+    Select the content encoding of a compressible response
+    :param accept_encoding: Value of the Accept-Encoding request header
+    :return: "zstd", "gzip" or None
+    """
+    if module_available("zstandard") and accepts_encoding(accept_encoding, "zstd"):
+        return "zstd"
+    if accepts_encoding(accept_encoding, "gzip"):
+        return "gzip"
+    return None
+
+
+def compress_chunks(chunks, encoding: str):
+    """
+    Compress a stream of CSV chunks. Arrow and Parquet are compressed internally.
+    :param chunks: Iterable of bytes
+    :param encoding: "zstd", "gzip" or None
+    :return: Generator of bytes
+    """
+    if encoding is None:
+        yield from chunks
+        return
+    if encoding == "zstd":
+        import zstandard
+
+        compressor = zstandard.ZstdCompressor().compressobj()
+        flush_mode = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+    else:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        flush_mode = zlib.Z_SYNC_FLUSH
+    for chunk in chunks:
+        # Flush after each chunk, so that clients receive data while the query is running
+        data = compressor.compress(chunk) + compressor.flush(flush_mode)
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""In-memory index of highway segments and speeds
+
+The segments and their 24 hourly speeds are exported by populate_database.py to
+NumPy files, which the worker processes map into memory. The pages are shared by
+all processes on the host through the page cache. A grid over the bounding boxes
+of the segments selects candidates, which are filtered by the same comparison of
+single precision boxes as the && operator of PostGIS, so requests are answered
+with the same rows as by the database.
+"""
+
+import datetime
+import json
+import logging
+import os
+import shutil
+import time
+
+import numpy as np
+
+from sm2t.utils import float32_box
+
+CURRENT_FILE = "current.json"
+ARRAYS = ["fid", "box", "osm_ids", "speeds", "cell_keys", "cell_offsets", "cell_items"]
+# Speeds are stored as smallint as in highways_packed, missing hours as -1 and
+# hours with a row in the speed table whose speed is NULL as -2
+MISSING_SPEED = -1
+NULL_SPEED = -2
+# Increased when the arrays change, so that populate_database.py exports them again
+INDEX_FORMAT = 2
+
+
+def float32_boxes(boxes):
+    """
+    Round bounding boxes outwards to single precision (see sm2t.utils.float32_box)
+    :param boxes: Array of bounding boxes (min_lon, min_lat, max_lon, max_lat)
+    :return: numpy.ndarray of float32
+    """
+    boxes = np.asarray(boxes, dtype=np.float64)
+    rounded = boxes.astype(np.float32)
+    lower = rounded[:, :2].astype(np.float64) > boxes[:, :2]
+    rounded[:, :2][lower] = np.nextafter(rounded[:, :2][lower], np.float32(-np.inf))
+    upper = rounded[:, 2:].astype(np.float64) < boxes[:, 2:]
+    rounded[:, 2:][upper] = np.nextafter(rounded[:, 2:][upper], np.float32(np.inf))
+    return rounded
+
+
+def cell_index(values, cell_size: float):
+    """Column or row of the grid cells containing coordinates"""
+    return np.floor(np.asarray(values, dtype=np.float64) / cell_size).astype(np.int64)
+
+
+def cell_key(x, y):
+    """Key of grid cells ordered by column and row"""
+    return np.asarray(x, dtype=np.int64) * 2**32 + (
+        np.asarray(y, dtype=np.int64) + 2**31
+    )
+
+
+def build_grid(boxes, cell_size: float):
+    """
+    Grid index over bounding boxes. Each box is listed in all cells it overlaps.
+    :param boxes: Array of bounding boxes (min_lon, min_lat, max_lon, max_lat)
+    :param cell_size: Width and height of a cell in degree
+    :return: Sorted keys of the occupied cells, offsets of their items, items
+    (indices of the boxes)
+    """
+    min_x = cell_index(boxes[:, 0], cell_size)
+    min_y = cell_index(boxes[:, 1], cell_size)
+    max_x = cell_index(boxes[:, 2], cell_size)
+    max_y = cell_index(boxes[:, 3], cell_size)
+    rows = max_y - min_y + 1
+    counts = (max_x - min_x + 1) * rows
+    items = np.repeat(np.arange(len(boxes), dtype=np.int64), counts)
+    position = np.arange(len(items), dtype=np.int64) - np.repeat(
+        np.cumsum(counts) - counts, counts
+    )
+    keys = cell_key(
+        min_x[items] + position // rows[items], min_y[items] + position % rows[items]
+    )
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    cell_keys, starts = np.unique(keys, return_index=True)
+    cell_offsets = np.append(starts, len(keys)).astype(np.int64)
+    return cell_keys, cell_offsets, items[order]
+
+
+def write_index(
+    directory, fid, boxes, osm_ids, speeds, version: int, cell_size: float = 0.01
+):
+    """
+    Write the arrays of a dataset version and make it the current one. The files of
+    older versions except the previous one are removed, since workers may still map it.
+    :param directory: Directory of the index
+    :param fid: Array of fids, sorted
+    :param boxes: Array of bounding boxes (min_lon, min_lat, max_lon, max_lat) of the segments
+    :param osm_ids: Array of osm_way_id, osm_start_node_id, osm_end_node_id of the segments
+    :param speeds: Array of 24 hourly speeds of the segments, MISSING_SPEED if there is
+    no row and NULL_SPEED if the speed of the row is NULL
+    :param version: Dataset version
+    :param cell_size: Width and height of a grid cell in degree
+    :return: Dictionary describing the index
+    """
+    boxes = float32_boxes(boxes)
+    cell_keys, cell_offsets, cell_items = build_grid(boxes, cell_size)
+    arrays = {
+        "fid": np.asarray(fid, dtype=np.int64),
+        "box": boxes,
+        "osm_ids": np.asarray(osm_ids, dtype=np.int64).reshape(-1, 3),
+        "speeds": np.asarray(speeds, dtype=np.int16).reshape(-1, 24),
+        "cell_keys": cell_keys,
+        "cell_offsets": cell_offsets,
+        "cell_items": cell_items,
+    }
+    name = f"v{version}"
+    tmp_dir = os.path.join(directory, f"{name}.{os.getpid()}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for array_name, array in arrays.items():
+        np.save(os.path.join(tmp_dir, f"{array_name}.npy"), array)
+    shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+    os.replace(tmp_dir, os.path.join(directory, name))
+
+    previous = read_current(directory)
+    current = {
+        "version": version,
+        "format": INDEX_FORMAT,
+        "directory": name,
+        "cell_size": cell_size,
+        "segments": len(arrays["fid"]),
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }
+    tmp_file = os.path.join(directory, f"{CURRENT_FILE}.{os.getpid()}.tmp")
+    with open(tmp_file, "w") as dst:
+        json.dump(current, dst, indent=2)
+    os.replace(tmp_file, os.path.join(directory, CURRENT_FILE))
+
+    keep = {name, previous["directory"] if previous else None}
+    for entry in os.listdir(directory):
+        path = os.path.join(directory, entry)
+        if os.path.isdir(path) and entry.startswith("v") and entry not in keep:
+            shutil.rmtree(path, ignore_errors=True)
+    return current
+
+
+def read_current(directory):
+    """
+    Read the description of the current index
+    :param directory: Directory of the index
+    :return: Dictionary (version, format, directory, cell_size, segments, created_at) or None
+    """
+    try:
+        with open(os.path.join(directory, CURRENT_FILE)) as src:
+            return json.load(src)
+    except FileNotFoundError:
+        return None
+
+
+def export_index(conn, directory, version: int, cell_size: float = 0.01):
+    """
+    Export the highways and speed tables of the live schema to the index
+    :param conn: psycopg2.connection object
+    :param directory: Directory of the index
+    :param version: Dataset version
+    :param cell_size: Width and height of a grid cell in degree
+    :return: Dictionary describing the index
+    """
+    ids = []
+    boxes = []
+    cur = conn.cursor(name="memory_index_highways")
+    try:
+        cur.execute(
+            """
+            SELECT fid, osm_way_id, osm_start_node_id, osm_end_node_id,
+            ST_XMin(geometry), ST_YMin(geometry), ST_XMax(geometry), ST_YMax(geometry)
+            FROM highways
+            WHERE geometry IS NOT NULL AND NOT ST_IsEmpty(geometry)
+            ORDER BY fid;
+            """
+        )
+        while True:
+            rows = cur.fetchmany(100000)
+            if not rows:
+                break
+            ids.append(np.array([row[:4] for row in rows], dtype=np.int64))
+            boxes.append(np.array([row[4:] for row in rows], dtype=np.float64))
+    finally:
+        cur.close()
+    ids = np.concatenate(ids) if ids else np.empty((0, 4), dtype=np.int64)
+    boxes = np.concatenate(boxes) if boxes else np.empty((0, 4), dtype=np.float64)
+
+    fid = ids[:, 0]
+    speeds = np.full((len(fid), 24), MISSING_SPEED, dtype=np.int16)
+    cur = conn.cursor(name="memory_index_speed")
+    try:
+        # Rows whose speed is NULL are returned by the SQL queries as well
+        cur.execute(
+            "SELECT fid, hour_of_day, COALESCE(speed_kph_p85, %(null_speed)s) FROM speed;",
+            {"null_speed": NULL_SPEED},
+        )
+        while True:
+            rows = cur.fetchmany(500000)
+            if not rows:
+                break
+            rows = np.array(rows, dtype=np.int64)
+            position = np.searchsorted(fid, rows[:, 0]).clip(max=max(len(fid) - 1, 0))
+            # Speeds of segments missing in highways are not joined by the SQL queries either
+            found = (fid[position] == rows[:, 0]) if len(fid) else position < 0
+            speeds[position[found], rows[found, 1]] = rows[found, 2]
+    finally:
+        cur.close()
+    conn.commit()
+    return write_index(directory, fid, boxes, ids[:, 1:], speeds, version, cell_size)
+
+
+class MemoryIndex:
+    """
+    Speed data of all segments held in memory-mapped arrays. Requests for bounding
+    boxes are answered without database queries. A new index written by
+    populate_database.py is picked up within version_ttl seconds.
+    """
+
+    def __init__(self, directory, version_ttl=10.0):
+        """
+        :param directory: Directory of the index
+        :param version_ttl: Seconds between checks for a new index
+        """
+        self.directory = directory
+        self.version_ttl = version_ttl
+        self.current = None
+        self.arrays = None
+        self._checked = None
+        self.requests = 0
+
+    def stats(self):
+        """Description of the loaded index and request counter"""
+        return {
+            "version": self.current["version"] if self.current else None,
+            "segments": self.current["segments"] if self.current else 0,
+            "requests": self.requests,
+        }
+
+    def check_version(self):
+        """
+        Map the arrays of the current index if it has changed. The index file is
+        read at most once per version_ttl seconds.
+        :return: True if an index is loaded
+        """
+        now = time.monotonic()
+        if self._checked is not None and now - self._checked < self.version_ttl:
+            return self.arrays is not None
+        self._checked = now
+        current = read_current(self.directory)
+        if current is None or current == self.current:
+            return self.arrays is not None
+        path = os.path.join(self.directory, current["directory"])
+        arrays = {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+            for name in ARRAYS
+        }
+        arrays["cell_size"] = current["cell_size"]
+        logging.info(
+            f"Loaded memory index version {current['version']} ({current['segments']} segments)."
+        )
+        # Requests in progress keep the arrays they started with
+        self.arrays, self.current = arrays, current
+        return True
+
+    def select(self, bboxes, arrays=None):
+        """
+        Segments whose bounding box overlaps any of several bounding boxes
+        :param bboxes: List of bounding boxes (min_lon, min_lat, max_lon, max_lat)
+        :param arrays: Arrays of the index. Defaults to the loaded ones.
+        :return: Sorted array of segment indices
+        """
+        arrays = arrays or self.arrays
+        cell_size = arrays["cell_size"]
+        keys = arrays["cell_keys"]
+        offsets = arrays["cell_offsets"]
+        selected = []
+        for bbox in bboxes:
+            box = float32_box(bbox)
+            columns = np.arange(
+                cell_index(box[0], cell_size), cell_index(box[2], cell_size) + 1
+            )
+            first = np.searchsorted(
+                keys, cell_key(columns, cell_index(box[1], cell_size)), side="left"
+            )
+            last = np.searchsorted(
+                keys, cell_key(columns, cell_index(box[3], cell_size)), side="right"
+            )
+            # The cells of a column are contiguous in the sorted keys
+            parts = [
+                arrays["cell_items"][offsets[start] : offsets[end]]
+                for start, end in zip(first, last)
+                if end > start
+            ]
+            if not parts:
+                continue
+            candidates = np.unique(np.concatenate(parts))
+            boxes = arrays["box"][candidates]
+            overlaps = (
+                (boxes[:, 0] <= np.float32(box[2]))
+                & (boxes[:, 2] >= np.float32(box[0]))
+                & (boxes[:, 1] <= np.float32(box[3]))
+                & (boxes[:, 3] >= np.float32(box[1]))
+            )
+            selected.append(candidates[overlaps])
+        if not selected:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate(selected))
+
+    def iter_speed_by_bboxes(self, bboxes, batch_size=None, hours=None, wide=False):
+        """
+        Iterate over speed data within several bounding boxes in batches of rows.
+        Segments overlapping several boxes are returned once.
+        :param bboxes: List of bounding boxes (min_lon, min_lat, max_lon, max_lat)
+        :param batch_size: Number of rows per batch. Defaults to STREAM_BATCH_SIZE or 5000.
+        :param hours: List of hours of day to select. If None, all hours are selected.
+        :param wide: If True, one row per segment with one speed column per hour is returned
+        :return: Generator of lists of row tuples (see sm2t.database.SPEED_COLUMNS and
+        sm2t.database.wide_speed_columns)
+        """
+        if batch_size is None:
+            batch_size = int(os.getenv("STREAM_BATCH_SIZE", 5000))
+        self.requests += 1
+        arrays = self.arrays
+        hours = np.arange(24) if hours is None else np.asarray(hours, dtype=np.int64)
+        selected = self.select(bboxes, arrays)
+        step = batch_size if wide else max(1, batch_size // len(hours))
+        for start in range(0, len(selected), step):
+            segments = selected[start : start + step]
+            speeds = arrays["speeds"][segments][:, hours]
+            osm_ids = arrays["osm_ids"][segments]
+            present = speeds != MISSING_SPEED
+            null = speeds == NULL_SPEED
+            if wide:
+                keep = present.any(axis=1)
+                rows = np.concatenate([osm_ids[keep], speeds[keep]], axis=1).astype(
+                    object
+                )
+                rows[:, 3:][~present[keep] | null[keep]] = None
+            else:
+                segment, hour = np.nonzero(present)
+                rows = np.column_stack(
+                    [osm_ids[segment], hours[hour], speeds[segment, hour]]
+                )
+                is_null = null[segment, hour]
+                if is_null.any():
+                    rows = rows.astype(object)
+                    rows[is_null, 4] = None
+            batch = list(map(tuple, rows.tolist()))
+            if batch:
+                yield batch
+
+
+_memory_index = None
+
+
+def get_memory_index():
+    """
+    Returns the memory index of the current process configured by the environment
+    variables MEMORY_INDEX_DIR and MEMORY_INDEX_VERSION_TTL.
+    :return: MemoryIndex or None if MEMORY_INDEX_DIR is not set or no index has been written
+    """
+    global _memory_index
+    directory = os.getenv("MEMORY_INDEX_DIR")
+    if not directory:
+        return None
+    if _memory_index is None or _memory_index.directory != directory:
+        _memory_index = MemoryIndex(
+            directory, float(os.getenv("MEMORY_INDEX_VERSION_TTL", 10))
+        )
+    if not _memory_index.check_version():
+        return None
+    return _memory_index
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Request timings and Prometheus metrics
+
+Timings of the stages of a request (connect, query, serialize) are collected
+in the request context and observed once the response has been sent, which is
+after the last chunk for streamed responses. If PROMETHEUS_MULTIPROC_DIR is set,
+the metrics of all uWSGI worker processes are aggregated in this directory.
+
+Neither flask nor prometheus_client is imported on import of this module, so the
+loader, which times queries through sm2t.database, does not load them.
+"""
+
+import atexit
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+STAGES = ["connect", "query", "serialize"]
+
+_metrics = None
+
+
+def prometheus_metrics():
+    """
+    Create the Prometheus metrics of the current process on first use. prometheus_client
+    is imported here, since it chooses the multiprocess mode on import from
+    PROMETHEUS_MULTIPROC_DIR, which the entry points load from ../.env after their imports.
+    :return: Dictionary of name and metric, None if prometheus_client is not installed
+    """
+    global _metrics
+    if _metrics is not None:
+        return _metrics or None
+    try:
+        from prometheus_client import Counter, Gauge, Histogram
+    except ImportError:
+        _metrics = {}
+        return None
+    _metrics = {
+        "request_seconds": Histogram(
+            "sm2t_request_seconds",
+            "Duration of requests until the last byte was sent",
+            ["endpoint", "status"],
+            buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+        ),
+        "stage_seconds": Histogram(
+            "sm2t_stage_seconds",
+            "Time spent in a stage of a request: connect (borrowing a database connection), "
+            "query (SQL execution and fetching rows), serialize (encoding rows)",
+            ["endpoint", "stage"],
+            buckets=(
+                0.001,
+                0.005,
+                0.01,
+                0.025,
+                0.05,
+                0.1,
+                0.25,
+                0.5,
+                1,
+                2.5,
+                5,
+                10,
+                30,
+            ),
+        ),
+        "response_bytes": Histogram(
+            "sm2t_response_bytes",
+            "Size of response bodies",
+            ["endpoint"],
+            buckets=(1e3, 1e4, 1e5, 1e6, 1e7, 5e7, 1e8, 5e8),
+        ),
+        "response_rows": Histogram(
+            "sm2t_response_rows",
+            "Number of rows of speed data sent",
+            ["endpoint"],
+            buckets=(0, 100, 1e3, 1e4, 1e5, 1e6, 1e7),
+        ),
+        "request_area": Histogram(
+            "sm2t_request_area_square_degrees",
+            "Area of the requested bounding boxes or geometries",
+            ["endpoint"],
+            buckets=(1e-5, 1e-4, 1e-3, 0.01, 0.05, 0.1, 0.25, 0.5, 1),
+        ),
+        "errors": Counter(
+            "sm2t_errors",
+            "Requests failed with a server error or while streaming",
+            ["endpoint", "error"],
+        ),
+        "rejected": Counter(
+            "sm2t_rejected_requests",
+            "Requests rejected by admission control: heavy (no free slot for heavy "
+            "requests) or rate_limit (token bucket of the client empty)",
+            ["endpoint", "reason"],
+        ),
+        "uncovered": Counter(
+            "sm2t_uncovered_requests",
+            "Requests outside the coverage index answered without database queries",
+            ["endpoint"],
+        ),
+        "pool_connections": Gauge(
+            "sm2t_pool_connections",
+            "Database connections held by the connection pools",
+            ["state"],
+            multiprocess_mode="livesum",
+        ),
+        "tile_cache": Gauge(
+            "sm2t_tile_cache",
+            "Counters of the tile caches since the start of the worker processes",
+            ["counter"],
+            multiprocess_mode="livesum",
+        ),
+    }
+    return _metrics
+
+
+def metrics_available():
+    """Check if metrics are collected, which requires prometheus_client"""
+    return prometheus_metrics() is not None
+
+
+def request_timings():
+    """
+    Timings of the current request
+    :return: Dictionary of stage and seconds, None outside of a request
+    """
+    # Requests are served by the API, which has imported flask
+    flask = sys.modules.get("flask")
+    if flask is None or not flask.has_request_context():
+        return None
+    if "timings" not in flask.g:
+        flask.g.timings = {"start": time.perf_counter()}
+    return flask.g.timings
+
+
+def record(name: str, value: float):
+    """
+    Add a value to a timing or counter of the current request
+    :param name: Name of the stage or counter, e.g. connect or rows
+    :param value: Seconds or count
+    """
+    timings = request_timings()
+    if timings is not None:
+        timings[name] = timings.get(name, 0) + value
+
+
+def record_rejection(reason: str):
+    """
+    Mark the current request as rejected by admission control
+    :param reason: heavy or rate_limit
+    """
+    timings = request_timings()
+    if timings is not None:
+        timings["rejected"] = reason
+
+
+def record_uncovered():
+    """Mark the current request as outside the coverage index"""
+    timings = request_timings()
+    if timings is not None:
+        timings["uncovered"] = True
+
+
+def nested_time(timings: dict, nested: tuple):
+    """Total time of the stages measured within another stage"""
+    return sum(timings.get(stage, 0) for stage in nested)
+
+
+@contextmanager
+def timed(stage: str, nested: tuple = ()):
+    """
+    Measure the time spent in a stage of the current request
+    :param stage: Name of the stage
+    :param nested: Stages measured within this one, whose time is not counted twice
+    """
+    timings = request_timings() or {}
+    nested_before = nested_time(timings, nested)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        record(stage, elapsed - (nested_time(timings, nested) - nested_before))
+
+
+def timed_iter(iterable, stage: str, nested: tuple = (), count: str = None):
+    """
+    Measure the time spent producing the items of a generator
+    :param iterable: Iterable, e.g. a generator of batches or encoded chunks
+    :param stage: Name of the stage
+    :param nested: Stages measured within this one, whose time is not counted twice
+    :param count: If set, the lengths of the items are added to this counter
+    :return: Generator of the items
+    """
+    iterator = iter(iterable)
+    while True:
+        try:
+            with timed(stage, nested):
+                item = next(iterator)
+        except StopIteration:
+            return
+        except Exception as error:
+            timings = request_timings()
+            if timings is not None:
+                timings["error_type"] = type(error).__name__
+            raise
+        if count is not None:
+            record(count, len(item))
+        yield item
+
+
+def server_timing(timings: dict):
+    """
+    Value of the Server-Timing header
+    :param timings: Timings of a request
+    :return: str, e.g. connect;dur=1.2, query;dur=15.3
+    """
+    entries = [
+        f"{stage};dur={timings[stage] * 1000:.1f}"
+        for stage in STAGES
+        if stage in timings
+    ]
+    entries.append(f"total;dur={(time.perf_counter() - timings['start']) * 1000:.1f}")
+    return ", ".join(entries)
+
+
+def observe_request(endpoint: str, status: int, timings: dict, n_bytes: int):
+    """
+    Observe the metrics of a finished request
+    :param endpoint: Name of the endpoint
+    :param status: HTTP status code
+    :param timings: Timings of the request
+    :param n_bytes: Size of the response body
+    """
+    metrics = prometheus_metrics()
+    if metrics is None:
+        return
+    metrics["request_seconds"].labels(endpoint, str(status)).observe(
+        time.perf_counter() - timings["start"]
+    )
+    for stage in STAGES:
+        if stage in timings:
+            metrics["stage_seconds"].labels(endpoint, stage).observe(timings[stage])
+    if n_bytes is not None:
+        metrics["response_bytes"].labels(endpoint).observe(n_bytes)
+    if "rows" in timings:
+        metrics["response_rows"].labels(endpoint).observe(timings["rows"])
+    if "area" in timings:
+        metrics["request_area"].labels(endpoint).observe(timings["area"])
+    if "rejected" in timings:
+        metrics["rejected"].labels(endpoint, timings["rejected"]).inc()
+    if "uncovered" in timings:
+        metrics["uncovered"].labels(endpoint).inc()
+    if "error_type" in timings:
+        metrics["errors"].labels(endpoint, timings["error_type"]).inc()
+    elif status >= 500:
+        metrics["errors"].labels(endpoint, str(status)).inc()
+
+
+_gauge_pid = None
+
+
+def set_gauges(pool_stats: dict = None, cache_stats: dict = None):
+    """
+    Update the gauges of the current worker process
+    :param pool_stats: Number of connections by state (see ConnectionPool.stats)
+    :param cache_stats: Counters of the tile cache (see TileCache.stats)
+    """
+    metrics = prometheus_metrics()
+    if metrics is None:
+        return
+    global _gauge_pid
+    if _gauge_pid != os.getpid():
+        _gauge_pid = os.getpid()
+        atexit.register(mark_process_dead, _gauge_pid)
+    for state, n_connections in (pool_stats or {}).items():
+        metrics["pool_connections"].labels(state).set(n_connections)
+    for counter in ("tiles", "bytes", "hits", "disk_hits", "misses", "evictions"):
+        if cache_stats is not None and counter in cache_stats:
+            metrics["tile_cache"].labels(counter).set(cache_stats[counter])
+
+
+def generate_metrics():
+    """
+    Metrics in the Prometheus text format. If PROMETHEUS_MULTIPROC_DIR is set,
+    the metrics of all worker processes are aggregated, otherwise those of the
+    current process are returned.
+    :return: bytes, content type
+    """
+    import prometheus_client
+    from prometheus_client import multiprocess
+
+    multiproc_dir = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if multiproc_dir:
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry, path=multiproc_dir)
+    else:
+        registry = prometheus_client.REGISTRY
+    return (
+        prometheus_client.generate_latest(registry),
+        prometheus_client.CONTENT_TYPE_LATEST,
+    )
+
+
+def mark_process_dead(pid: int):
+    """Remove the live gauges of a terminated worker process"""
+    multiproc_dir = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if multiproc_dir:
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(pid, multiproc_dir)
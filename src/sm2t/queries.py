@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Named server-side prepared statements of parameterized queries"""
+
+import hashlib
+import re
+import weakref
+
+from sm2t.utils import env_flag
+
+PARAMETER_PATTERN = re.compile(r"%\((\w+)\)s")
+# Queries differ e.g. by the selected hours, so the statements of a connection are limited
+MAX_PREPARED_STATEMENTS = 64
+
+# Names of the statements prepared on each connection
+_prepared = weakref.WeakKeyDictionary()
+
+
+def prepared_statements_enabled():
+    """
+    Check if queries are run as prepared statements. They can be disabled with
+    PREPARED_STATEMENTS=false, e.g. behind a pooler in transaction mode.
+    """
+    return env_flag("PREPARED_STATEMENTS", default=True)
+
+
+def positional_query(query: str):
+    """
+    Replace the named parameters of a query by positional parameters
+    :param query: SQL query with named parameters, e.g. %(min_lon)s
+    :return: SQL query with positional parameters ($1, $2, ...), list of parameter names
+    """
+    names = []
+
+    def replace(match):
+        if match.group(1) not in names:
+            names.append(match.group(1))
+        return f"${names.index(match.group(1)) + 1}"
+
+    return PARAMETER_PATTERN.sub(replace, query).strip().rstrip(";"), names
+
+
+def statement_name(query: str):
+    """Name of the prepared statement of a query, derived from the query text"""
+    return "sm2t_" + hashlib.sha1(query.encode()).hexdigest()[:16]
+
+
+def prepare(cur, query: str):
+    """
+    Prepare a query on the connection of a cursor unless it has been prepared before.
+    Prepared statements last as long as the connection. After some executions,
+    PostgreSQL reuses a generic plan instead of planning the query again.
+    :param cur: psycopg2.cursor object
+    :param query: SQL query with named parameters
+    :return: Name of the prepared statement, list of parameter names
+    """
+    name = statement_name(query)
+    positional, names = positional_query(query)
+    prepared = _prepared.setdefault(cur.connection, set())
+    if name not in prepared:
+        if len(prepared) >= MAX_PREPARED_STATEMENTS:
+            cur.execute("DEALLOCATE ALL;")
+            prepared.clear()
+        cur.execute(f"PREPARE {name} AS {positional};")
+        prepared.add(name)
+    return name, names
+
+
+def execute(cur, query: str, params: dict = None):
+    """
+    Execute a query as prepared statement
+    :param cur: psycopg2.cursor object. Named (server-side) cursors cannot execute
+    prepared statements and run the query directly.
+    :param query: SQL query with named parameters
+    :param params: Dictionary of query parameters
+    """
+    params = params or {}
+    if cur.name is not None or not prepared_statements_enabled():
+        cur.execute(query, params)
+        return
+    name, names = prepare(cur, query)
+    if names:
+        arguments = ", ".join(f"%({parameter})s" for parameter in names)
+        cur.execute(f"EXECUTE {name}({arguments});", params)
+    else:
+        cur.execute(f"EXECUTE {name};")
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Cities sharded across database backends
+
+Each shard configured in DB_SHARDS is populated with its own cities by
+populate_database.py --shard <name>, which records the extent of the cities and the
+shard holding them in the table city_registry of the primary database. Requests are
+routed to the shards whose cities overlap their bounding boxes. Shards are queried
+concurrently and their batches of rows are merged as they arrive.
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+
+from sm2t.database import PRIMARY_SHARD, iter_speed, pooled_connection, shard_addresses
+from sm2t.utils import boxes_overlap
+
+_shard_registry = None
+
+# Marks the end of the rows of a shard in the queue of batches
+_DONE = object()
+
+REGISTRY_QUERY = (
+    "SELECT city, shard, min_lon, min_lat, max_lon, max_lat "
+    "FROM public.city_registry ORDER BY city;"
+)
+
+
+class ShardRegistry:
+    """
+    Extents of the cities and their shards, read from the primary database again
+    after registry_ttl seconds
+    """
+
+    def __init__(self, registry_ttl=60.0):
+        """
+        :param registry_ttl: Seconds after which the registry is read again
+        """
+        self.registry_ttl = registry_ttl
+        self.cities = []
+        self._read = None
+        self._lock = threading.Lock()
+
+    def refresh_due(self):
+        """Whether the registry has not been read for registry_ttl seconds"""
+        return self._read is None or time.monotonic() - self._read >= self.registry_ttl
+
+    def update(self, rows):
+        """
+        Replace the cities by rows of the registry
+        :param rows: Rows of REGISTRY_QUERY
+        """
+        self.cities = [
+            {"city": row[0], "shard": row[1], "bbox": tuple(row[2:6])} for row in rows
+        ]
+        self._read = time.monotonic()
+
+    def refresh(self):
+        """Read the registry if it is older than registry_ttl seconds"""
+        with self._lock:
+            if not self.refresh_due():
+                return
+            with pooled_connection(PRIMARY_SHARD) as conn:
+                self.update(read_registry(conn))
+
+    def shards(self, refresh=True):
+        """
+        Shards holding cities
+        :param refresh: If False, the registry is not read again, e.g. if it is read
+        asynchronously by the caller
+        :return: Sorted list of shard names
+        """
+        if refresh:
+            self.refresh()
+        return sorted({city["shard"] for city in self.cities})
+
+    def shards_for_bboxes(self, bboxes, refresh=True):
+        """
+        Shards holding cities which overlap bounding boxes
+        :param bboxes: List of bounding boxes (min_lon, min_lat, max_lon, max_lat)
+        :param refresh: If False, the registry is not read again
+        :return: Sorted list of shard names
+        """
+        if refresh:
+            self.refresh()
+        return sorted(
+            {
+                city["shard"]
+                for city in self.cities
+                if any(boxes_overlap(city["bbox"], bbox) for bbox in bboxes)
+            }
+        )
+
+
+def read_registry(conn):
+    """
+    Rows of the shard registry
+    :param conn: psycopg2.connection object of the primary database
+    :return: List of row tuples (see REGISTRY_QUERY)
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute(REGISTRY_QUERY)
+        rows = cur.fetchall()
+        conn.commit()
+    finally:
+        cur.close()
+    return rows
+
+
+def produce_batches(shard, region, batches, stop, kwargs):
+    """
+    Put the batches of rows of a shard into a queue
+    :param shard: Name of the shard
+    :param region: SQL condition and query parameters (see sm2t.database.bbox_region)
+    :param batches: Queue of batches shared by the shards
+    :param stop: Event set when the consumer does not take further batches
+    :param kwargs: Keyword arguments of sm2t.database.iter_speed
+    """
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    try:
+        with pooled_connection(shard) as conn:
+            for rows in iter_speed(region, conn, **kwargs):
+                if not put(rows):
+                    return
+    except Exception as error:
+        logging.error(f"Query on shard {shard} failed: {error}")
+        put(error)
+        return
+    put(_DONE)
+
+
+def iter_speed_shards(region, shards, **kwargs):
+    """
+    Iterate over speed data of highway segments within a region on several shards.
+    Each shard is queried in its own thread with a connection of its pool. The
+    batches are yielded in the order they arrive, so rows of shards are interleaved.
+    :param region: SQL condition and query parameters (see sm2t.database.bbox_region)
+    :param shards: Names of the shards
+    :param kwargs: Keyword arguments of sm2t.database.iter_speed
+    :return: Generator of lists of row tuples
+    """
+    if len(shards) == 1:
+        with pooled_connection(shards[0]) as conn:
+            yield from iter_speed(region, conn, **kwargs)
+        return
+    batches = queue.Queue(maxsize=2 * len(shards))
+    stop = threading.Event()
+    threads = [
+        threading.Thread(
+            target=produce_batches,
+            args=(shard, region, batches, stop, kwargs),
+            name=f"shard-{shard}",
+            daemon=True,
+        )
+        for shard in shards
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        running = len(threads)
+        while running:
+            item = batches.get()
+            if item is _DONE:
+                running -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        # Let the other shards stop if the client has gone or a shard failed
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def get_shard_registry():
+    """
+    Returns the shard registry of the current process configured by DB_SHARDS and
+    SHARD_REGISTRY_TTL
+    :return: ShardRegistry or None if DB_SHARDS is not set
+    """
+    global _shard_registry
+    if not shard_addresses():
+        return None
+    if _shard_registry is None:
+        _shard_registry = ShardRegistry(float(os.getenv("SHARD_REGISTRY_TTL", 60)))
+    return _shard_registry
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Snapshot files holding the complete speed data of a city"""
+
+import datetime
+import hashlib
+import json
+import os
+
+from sm2t.database import fid_range_region, iter_speed, wide_speed_columns
+from sm2t.formats import module_available, record_batch, speed_schema
+
+SNAPSHOT_SUFFIX = ".arrow"
+SNAPSHOT_MIMETYPE = "application/vnd.apache.arrow.file"
+INDEX_FILE = "index.json"
+
+
+def snapshots_available():
+    """Check if snapshots can be written, which requires pyarrow"""
+    return module_available("pyarrow")
+
+
+def snapshot_dir():
+    """
+    Directory of the snapshot files
+    :return: Path or None if SNAPSHOT_DIR is not set
+    """
+    return os.getenv("SNAPSHOT_DIR") or None
+
+
+def read_snapshot_index(directory):
+    """
+    Read the index of the snapshot files
+    :param directory: Snapshot directory
+    :return: Dictionary of city name and snapshot entry (file, size, sha256, checksum, created_at)
+    """
+    try:
+        with open(os.path.join(directory, INDEX_FILE)) as src:
+            return json.load(src)
+    except FileNotFoundError:
+        return {}
+
+
+def write_snapshot_index(directory, index: dict):
+    """
+    Replace the index of the snapshot files
+    :param directory: Snapshot directory
+    :param index: Dictionary of city name and snapshot entry
+    """
+    tmp_file = os.path.join(directory, f"{INDEX_FILE}.{os.getpid()}.tmp")
+    with open(tmp_file, "w") as dst:
+        json.dump(index, dst, indent=2, sort_keys=True)
+    os.replace(tmp_file, os.path.join(directory, INDEX_FILE))
+
+
+def file_sha256(path):
+    """SHA-256 hash of a file"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as src:
+        for block in iter(lambda: src.read(2**20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def write_snapshot(path, batches):
+    """
+    Write speed data in the wide layout as Arrow IPC file sorted by osm_way_id.
+    The file is not compressed by default (SNAPSHOT_COMPRESSION), so clients can
+    memory-map it and read the columns without copying.
+    :param path: Path of the snapshot file
+    :param batches: Iterable of lists of row tuples (see sm2t.database.wide_speed_columns)
+    :return: Number of rows
+    """
+    import pyarrow as pa
+
+    schema = speed_schema(wide_speed_columns())
+    table = pa.Table.from_batches(
+        [record_batch(rows, schema) for rows in batches], schema=schema
+    )
+    table = table.sort_by(
+        [
+            ("osm_way_id", "ascending"),
+            ("osm_start_node_id", "ascending"),
+            ("osm_end_node_id", "ascending"),
+        ]
+    )
+    options = pa.ipc.IpcWriteOptions(
+        compression=os.getenv("SNAPSHOT_COMPRESSION") or None
+    )
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with pa.OSFile(tmp_path, "wb") as sink:
+        with pa.ipc.new_file(sink, schema, options=options) as writer:
+            writer.write_table(table, max_chunksize=64 * 1024)
+    os.replace(tmp_path, path)
+    return table.num_rows
+
+
+def export_city_snapshot(conn, directory, city: str, fid_offset: int, fid_step: int):
+    """
+    Export the speed data of a city to a snapshot file
+    :param conn: psycopg2.connection object
+    :param directory: Snapshot directory
+    :param city: Name of the city
+    :param fid_offset: First fid of the city
+    :param fid_step: Number of fids reserved for each city
+    :return: Snapshot entry (file, size, sha256, rows)
+    """
+    file_name = f"{city}{SNAPSHOT_SUFFIX}"
+    path = os.path.join(directory, file_name)
+    batches = iter_speed(
+        fid_range_region(fid_offset, fid_offset + fid_step), conn, wide=True
+    )
+    n_rows = write_snapshot(path, batches)
+    conn.commit()
+    return {
+        "file": file_name,
+        "size": os.path.getsize(path),
+        "sha256": file_sha256(path),
+        "rows": n_rows,
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }
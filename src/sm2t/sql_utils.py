@@ -10,8 +10,10 @@ from sqlalchemy.orm import sessionmaker
 from sqlalchemy_utils import database_exists, create_database
 import os
 
+from sm2t.database import database_address
 
-def get_engine(user, passwd, host, port, db):
+
+def get_engine(user, passwd, host, port, db, schema=None):
     """
     Create SQLalchemy engine
     :param user: Username
@@ -19,26 +21,35 @@ def get_engine(user, passwd, host, port, db):
     :param host: Host
     :param port: Port
     :param db: Database name
+    :param schema: Schema searched for unqualified table names before public
     :return:
     """
     url = f"postgresql://{user}:{passwd}@{host}:{port}/{db}"
     if not database_exists(url):
         create_database(url)
-    engine = create_engine(url, pool_size=50, echo=False)
+    connect_args = {}
+    if schema:
+        connect_args["options"] = f"-c search_path={schema},public"
+    engine = create_engine(url, pool_size=50, echo=False, connect_args=connect_args)
     return engine
 
 
-def get_engine_from_environment():
+def get_engine_from_environment(schema=None, shard=None):
     """
     Create an engine from the settings in the environment variables
+    :param schema: Schema searched for unqualified table names before public
+    :param shard: Database backend. Defaults to DB_SHARD or the primary database
+    (see sm2t.database.database_address).
     :return:
     """
+    address = database_address(shard)
     return get_engine(
         os.environ["POSTGRES_USER"],
         os.environ["POSTGRES_PASSWORD"],
-        os.environ["HOST"],
-        os.environ["POSTGRES_PORT"],
-        os.environ["POSTGRES_DB"],
+        address["host"],
+        address["port"],
+        address["dbname"],
+        schema=schema,
     )
 
 
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test admission control"""
+
+from sm2t.admission import DensityGrid, HeavySlots, TokenBuckets
+
+
+def test_estimate_rows_from_density():
+    """Test if rows are estimated from the covered fraction of the grid cells"""
+    grid = DensityGrid()
+    grid.cell_size = 0.01
+    grid.cells = {(0, 0): (100, 2400), (1, 0): (10, 240)}
+    assert grid.estimate_rows([[0, 0, 0.01, 0.01]]) == 2400
+    assert grid.estimate_rows([[0.005, 0, 0.015, 0.01]]) == 1200 + 120
+    assert grid.estimate_rows([[0, 0, 0.01, 0.01]], wide=True) == 100
+    assert grid.estimate_rows([[0, 0, 0.01, 0.01]], hours=[7, 8]) == 200
+    assert grid.estimate_rows([[5, 5, 5.1, 5.1]]) == 0
+
+
+def test_heavy_slots_are_shared(tmp_path):
+    """Test if a slot can only be taken once until it is released"""
+    slots = HeavySlots(tmp_path, slots=1)
+    other_process = HeavySlots(tmp_path, slots=1)
+    slot = slots.acquire()
+    assert slot is not None
+    assert other_process.acquire() is None
+    slot.release()
+    assert other_process.acquire() is not None
+
+
+def test_token_buckets(tmp_path, monkeypatch):
+    """Test if buckets of clients are emptied and refilled independently"""
+    now = [1000.0]
+    monkeypatch.setattr("sm2t.admission.time.time", lambda: now[0])
+    buckets = TokenBuckets(tmp_path, rate=2, burst=4)
+    assert buckets.take("10.0.0.1", 3) == 0
+    assert buckets.take("10.0.0.1", 3) == 1
+    assert TokenBuckets(tmp_path, rate=2, burst=4).take("10.0.0.1", 3) == 1
+    assert buckets.take("10.0.0.2", 3) == 0
+    now[0] += 1
+    assert buckets.take("10.0.0.1", 3) == 0
+
+
+def test_token_bucket_file_is_never_truncated(tmp_path):
+    """Test if workers configured with other numbers of buckets keep the file mapped by others"""
+    buckets = TokenBuckets(tmp_path, rate=2, burst=4, n_buckets=1024)
+    assert buckets.take("10.0.0.1", 3) == 0
+    TokenBuckets(tmp_path, rate=2, burst=4, n_buckets=16)
+    assert (tmp_path / "buckets").stat().st_size == 1024 * 16
+    assert buckets.take("10.0.0.1", 3) > 0
+    larger = TokenBuckets(tmp_path, rate=2, burst=4, n_buckets=4096)
+    assert (tmp_path / "buckets").stat().st_size == 4096 * 16
+    assert larger.take("10.0.0.2", 3) == 0
+    assert buckets.take("10.0.0.1", 3) > 0
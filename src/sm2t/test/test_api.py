@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test the endpoints of the API with fake data sources"""
+
+import gzip
+import importlib
+from contextlib import contextmanager
+
+import numpy as np
+import pytest
+
+from sm2t.admission import HeavySlots, TokenBuckets
+from sm2t.data_version import write_version_file
+from sm2t.memory_index import MISSING_SPEED, MemoryIndex, write_index
+from sm2t.tiles import TileArchive, gzip_tile, write_archive
+
+BBOX = "8.67,49.39,8.69,49.41"
+
+
+def write_segments(directory, version=1):
+    """
+    Memory index of two segments near Heidelberg and one far from them, whose only
+    speed is at 7 o'clock
+    """
+    boxes = [
+        (8.676, 49.396, 8.677, 49.397),
+        (8.685, 49.405, 8.686, 49.406),
+        (8.9, 49.9, 8.91, 49.91),
+    ]
+    osm_ids = [(11, 1, 2), (12, 2, 3), (13, 3, 4)]
+    speeds = np.full((3, 24), MISSING_SPEED, dtype=np.int16)
+    speeds[:, 7] = [30, 40, 50]
+    write_index(directory, np.arange(1, 4), boxes, osm_ids, speeds, version, 0.01)
+
+
+@pytest.fixture
+def api(monkeypatch, tmp_path):
+    """API module whose data of version 1 is read from a memory index"""
+    monkeypatch.setenv("SECRET_KEY", "test")
+    monkeypatch.setenv("MAX_BBOX_DEGREE", "0.2")
+    monkeypatch.setenv("DATA_VERSION_FILE", str(tmp_path / "data_version.json"))
+    monkeypatch.delenv("SPEED_LAYOUT", raising=False)
+    write_version_file(
+        tmp_path / "data_version.json", 1, "abc", "2022-03-01T10:00:00+00:00"
+    )
+    write_segments(tmp_path)
+    memory_index = MemoryIndex(tmp_path)
+    memory_index.check_version()
+    module = importlib.import_module("api")
+    monkeypatch.setattr(module, "get_memory_index", lambda: memory_index)
+    for name in (
+        "get_coverage_index",
+        "get_shard_registry",
+        "get_tile_cache",
+        "get_tile_archive",
+        "get_heavy_slots",
+        "get_token_buckets",
+    ):
+        monkeypatch.setattr(module, name, lambda: None)
+    return module
+
+
+@pytest.fixture
+def regions(api, monkeypatch):
+    """
+    Fake database holding the segments of write_segments, which looks up segments by
+    osm_way_id or node pair
+    :return: List of the queried regions
+    """
+    segments = [(11, 1, 2, 30), (12, 2, 3, 40), (13, 3, 4, 50)]
+    queried = []
+
+    @contextmanager
+    def fake_connection():
+        yield "connection"
+
+    def fake_iter_speed(region, conn, hours=None, wide=False, **kwargs):
+        assert conn == "connection"
+        queried.append(region)
+        params = region[1]
+        if "osm_way_ids" in params:
+            selected = [s for s in segments if s[0] in params["osm_way_ids"]]
+        else:
+            pairs = list(zip(params["start_node_ids"], params["end_node_ids"]))
+            selected = [s for s in segments if (s[1], s[2]) in pairs]
+        if wide:
+            yield selected
+        else:
+            yield [segment[:3] + (7, segment[3]) for segment in selected]
+
+    monkeypatch.setattr(api, "pooled_connection", fake_connection)
+    monkeypatch.setattr(api, "iter_speed", fake_iter_speed)
+    return queried
+
+
+@pytest.fixture
+def client(api):
+    """
+    Test client of the API. Requests are sent with buffered=True, which reads streamed
+    responses completely and thereby pops their request context.
+    """
+    return api.app.test_client()
+
+
+def test_validators_of_current_data(client, monkeypatch):
+    """Test if responses of the live version carry validators depending on the layout"""
+    response = client.get(f"/api/v1/traffic/csv?bbox={BBOX}", buffered=True)
+    assert response.status_code == 200
+    assert response.headers["X-Data-Version"] == "1"
+    assert response.headers["Cache-Control"].startswith("public")
+    etag = response.headers["ETag"]
+
+    monkeypatch.setenv("SPEED_LAYOUT", "packed")
+    response = client.get(f"/api/v1/traffic/csv?bbox={BBOX}", buffered=True)
+    assert response.headers["ETag"] != etag
+
+
+def test_no_validators_of_outdated_copies(client, tmp_path):
+    """Test if data read from a copy of an older version is sent without validators"""
+    write_version_file(
+        tmp_path / "data_version.json", 2, "def", "2022-04-01T10:00:00+00:00"
+    )
+    response = client.get(f"/api/v1/traffic/csv?bbox={BBOX}", buffered=True)
+    assert response.status_code == 200
+    assert b"11,1,2,7,30" in response.data
+    assert "ETag" not in response.headers
+    assert "Cache-Control" not in response.headers
+
+
+def test_conditional_requests(client):
+    """Test if requests for a current copy are answered with 304 per content encoding"""
+    url = f"/api/v1/traffic/csv?bbox={BBOX}"
+    gzip_headers = {"Accept-Encoding": "gzip"}
+    response = client.get(url, headers=gzip_headers, buffered=True)
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert gzip.decompress(response.data).decode().splitlines() == [
+        "osm_way_id,osm_start_node_id,osm_end_node_id,hour_of_day,speed_kph_p85",
+        "11,1,2,7,30",
+        "12,2,3,7,40",
+    ]
+    etag = response.headers["ETag"]
+
+    response = client.get(
+        url, headers={**gzip_headers, "If-None-Match": etag}, buffered=True
+    )
+    assert response.status_code == 304
+    assert response.data == b""
+    assert response.headers["ETag"] == etag
+    assert response.headers["Vary"] == "Accept-Encoding"
+
+    # The uncompressed representation has another ETag
+    response = client.get(url, headers={"If-None-Match": etag}, buffered=True)
+    assert response.status_code == 200
+    assert "Content-Encoding" not in response.headers
+    assert response.headers["ETag"] != etag
+
+    response = client.get(
+        url,
+        headers={"If-Modified-Since": "Tue, 01 Mar 2022 10:00:00 GMT"},
+        buffered=True,
+    )
+    assert response.status_code == 304
+    response = client.get(
+        url,
+        headers={"If-Modified-Since": "Mon, 28 Feb 2022 10:00:00 GMT"},
+        buffered=True,
+    )
+    assert response.status_code == 200
+
+
+def test_batch_returns_segments_of_overlapping_bboxes_once(client, monkeypatch):
+    """Test if segments within several bounding boxes of a batch are sent once and the
+    total area is limited by MAX_BATCH_AREA"""
+    body = {
+        "bboxes": [[8.67, 49.39, 8.68, 49.40], [8.675, 49.395, 8.69, 49.41]],
+        "layout": "wide",
+        "hours": [7],
+    }
+    response = client.post("/api/v1/traffic/batch", json=body, buffered=True)
+    assert response.status_code == 200
+    assert response.data.decode().splitlines() == [
+        "osm_way_id,osm_start_node_id,osm_end_node_id,speed_kph_p85_07",
+        "11,1,2,30",
+        "12,2,3,40",
+    ]
+
+    monkeypatch.setenv("MAX_BATCH_AREA", "0.0002")
+    response = client.post("/api/v1/traffic/batch", json=body, buffered=True)
+    assert response.json["success"] == "False"
+    assert response.json["message"].startswith("Requested area is too big.")
+    # The union of the boxes is measured, not the sum of their areas
+    body["bboxes"].append([8.67, 49.39, 8.68, 49.40])
+    monkeypatch.setenv("MAX_BATCH_AREA", "0.00031")
+    response = client.post("/api/v1/traffic/batch", json=body, buffered=True)
+    assert response.status_code == 200
+    assert len(response.data.decode().splitlines()) == 3
+
+
+def test_lookup_by_osm_way_ids_and_node_pairs(client, regions, monkeypatch):
+    """Test if segments are looked up by OSM way ids or node pairs in one query"""
+    response = client.post(
+        "/api/v1/traffic/ways", json={"osm_way_ids": [13, 11, 99]}, buffered=True
+    )
+    assert response.status_code == 200
+    assert response.headers["Content-Disposition"].endswith("osm_ways.csv")
+    assert response.data.decode().splitlines()[1:] == ["11,1,2,7,30", "13,3,4,7,50"]
+    assert regions[-1][1] == {"osm_way_ids": [13, 11, 99]}
+
+    response = client.post(
+        "/api/v1/traffic/ways",
+        json={"node_pairs": [[2, 3], [4, 3]], "layout": "wide", "hours": [7]},
+        buffered=True,
+    )
+    assert response.data.decode().splitlines() == [
+        "osm_way_id,osm_start_node_id,osm_end_node_id,speed_kph_p85_07",
+        "12,2,3,40",
+    ]
+    assert len(regions) == 2
+
+    response = client.post(
+        "/api/v1/traffic/ways", json={"node_pairs": [[2, 3, 4]]}, buffered=True
+    )
+    assert response.json["success"] is False
+    monkeypatch.setenv("MAX_LOOKUP_IDS", "2")
+    response = client.post(
+        "/api/v1/traffic/ways", json={"osm_way_ids": [11, 12, 13]}, buffered=True
+    )
+    assert response.json["message"] == "At most 2 ids can be requested at once."
+    assert len(regions) == 2
+
+
+def test_heavy_requests_hold_a_slot_until_sent(api, client, monkeypatch, tmp_path):
+    """Test if a heavy request is rejected with 429 while another one is being sent
+    and the slot is released once the response has been closed"""
+    heavy_slots = HeavySlots(tmp_path / "admission", slots=1)
+    monkeypatch.setattr(api, "get_heavy_slots", lambda: heavy_slots)
+    monkeypatch.setattr(api, "estimate_rows", lambda *args: 10**6)
+    monkeypatch.setenv("HEAVY_QUERY_RETRY_AFTER", "2.5")
+    url = f"/api/v1/traffic/csv?bbox={BBOX}"
+
+    streaming = client.get(url)
+    assert streaming.status_code == 200
+    response = client.get(url, buffered=True)
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "3"
+    assert response.json["success"] is False
+
+    assert b"11,1,2,7,30" in b"".join(streaming.response)
+    streaming.close()
+    assert client.get(url, buffered=True).status_code == 200
+
+
+def test_rate_limit(api, client, monkeypatch, tmp_path):
+    """Test if requests beyond the token bucket of the client are rejected with 429"""
+    token_buckets = TokenBuckets(tmp_path / "admission", rate=0.1, burst=2)
+    monkeypatch.setattr(api, "get_token_buckets", lambda: token_buckets)
+    monkeypatch.setattr(api, "estimate_rows", lambda *args: 0)
+    url = f"/api/v1/traffic/csv?bbox={BBOX}"
+    assert client.get(url, buffered=True).status_code == 200
+    assert client.get(url, buffered=True).status_code == 200
+    response = client.get(url, buffered=True)
+    assert response.status_code == 429
+    assert 1 <= int(response.headers["Retry-After"]) <= 10
+    assert response.json["message"] == "Rate limit exceeded. Retry later."
+
+
+def test_tiles_are_passed_through_gzipped(api, client, monkeypatch, tmp_path):
+    """Test if archived tiles are sent as stored to clients accepting gzip, decompressed
+    to others and empty tiles with status 204"""
+    path = tmp_path / "tiles.mbtiles"
+    tile = gzip_tile(b"tile data")
+    write_archive(
+        path,
+        [(14, 8581, 5610, tile), (14, 8581, 5611, b"")],
+        {"minzoom": 14, "maxzoom": 14, "version": 1},
+    )
+    monkeypatch.setattr(api, "get_tile_archive", lambda: TileArchive(path))
+
+    response = client.get(
+        "/api/v1/traffic/tiles/14/8581/5610", headers={"Accept-Encoding": "gzip"}
+    )
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert response.data == tile
+    assert "ETag" in response.headers
+
+    response = client.get("/api/v1/traffic/tiles/14/8581/5610")
+    assert "Content-Encoding" not in response.headers
+    assert response.data == b"tile data"
+    assert response.mimetype == "application/vnd.mapbox-vector-tile"
+
+    for y in (5611, 5612):
+        response = client.get(f"/api/v1/traffic/tiles/14/8581/{y}")
+        assert response.status_code == 204
+        assert response.data == b""
+
+    # Tiles rendered from an older version are sent without validators
+    write_archive(path, [], {"minzoom": 14, "maxzoom": 14, "version": 0})
+    response = client.get("/api/v1/traffic/tiles/14/8581/5610")
+    assert response.status_code == 204
+    assert "ETag" not in response.headers
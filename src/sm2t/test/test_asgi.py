@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test the ASGI application with fake connection pools"""
+
+import asyncio
+
+import pytest
+
+pytest.importorskip("starlette")
+pytest.importorskip("asyncpg")
+
+from starlette.testclient import TestClient  # noqa: E402
+
+import asgi  # noqa: E402
+from sm2t.shards import ShardRegistry  # noqa: E402
+
+BBOX = "8.6,49.4,13.1,52.4"
+
+
+@pytest.fixture
+def client(monkeypatch):
+    """Client of the application with two shards, whose pools are their names"""
+    monkeypatch.setenv("MAX_BBOX_DEGREE", "5")
+    queries = []
+
+    async def fake_fetch_batches(pool, query, args):
+        queries.append((pool, query, args))
+        for i in range(3):
+            yield [(pool, i, 1, 7, 30)]
+
+    monkeypatch.setattr(asgi, "fetch_batches", fake_fetch_batches)
+    registry = ShardRegistry()
+    registry.update(
+        [
+            ("berlin", "shard2", 13.08, 52.33, 13.76, 52.67),
+            ("heidelberg", "shard1", 8.57, 49.35, 8.8, 49.46),
+        ]
+    )
+    asgi.app.state.pool = "primary"
+    asgi.app.state.pools = {"shard1": "shard1", "shard2": "shard2"}
+    asgi.app.state.shard_registry = registry
+    asgi.app.state.registry_lock = asyncio.Lock()
+    test_client = TestClient(asgi.app)
+    test_client.queries = queries
+    return test_client
+
+
+def test_batches_of_shards_are_merged(client):
+    """Test if the rows of all shards overlapping the bounding box are sent"""
+    response = client.get(f"/api/v1/traffic/csv?bbox={BBOX}")
+    assert response.status_code == 200
+    lines = response.text.splitlines()
+    assert (
+        lines[0]
+        == "osm_way_id,osm_start_node_id,osm_end_node_id,hour_of_day,speed_kph_p85"
+    )
+    assert sorted(lines[1:]) == [
+        f"{shard},{i},1,7,30" for shard in ("shard1", "shard2") for i in range(3)
+    ]
+
+    response = client.get("/api/v1/traffic/csv?bbox=8.6,49.4,8.7,49.45")
+    assert len(response.text.splitlines()) == 4
+    assert client.queries[-1][0] == "shard1"
+
+
+def test_hours_and_layout(client):
+    """Test if hours of day and the wide layout are passed to the query"""
+    response = client.get(
+        f"/api/v1/traffic/csv?bbox={BBOX}&hour_from=22&hour_to=1&layout=wide"
+    )
+    assert response.status_code == 200
+    assert response.text.splitlines()[0] == (
+        "osm_way_id,osm_start_node_id,osm_end_node_id,"
+        "speed_kph_p85_00,speed_kph_p85_01,speed_kph_p85_22,speed_kph_p85_23"
+    )
+    assert [0, 1, 22, 23] in client.queries[-1][2]
+
+
+def test_invalid_requests_are_rejected(client):
+    """Test if parameters not served by the ASGI application and invalid values are rejected"""
+    response = client.get(f"/api/v1/traffic/csv?bbox={BBOX}&exact=true&geometry=wkb")
+    assert response.status_code == 400
+    assert "exact, geometry" in response.json()["message"]
+    response = client.get(f"/api/v1/traffic/csv?bbox={BBOX}&format=arrow")
+    assert response.status_code == 400
+    assert response.json()["success"] is False
+    assert "format" in response.json()["message"]
+
+    response = client.get(f"/api/v1/traffic/csv?bbox={BBOX}&hours=7,25")
+    assert response.json()["success"] is False
+    response = client.get(f"/api/v1/traffic/csv?bbox={BBOX}&layout=tall")
+    assert response.json()["success"] is False
+    response = client.get("/api/v1/traffic/csv?bbox=0,0,6,1")
+    assert response.json()["success"] == "False"
+    assert client.queries == []
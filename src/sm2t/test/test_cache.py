@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test tile cache"""
+
+import time
+
+from sm2t.cache import group_segments, tile_bbox, tile_range, TileCache
+
+
+def test_tile_range():
+    """Test if tiles cover the bounding box including its edges"""
+    tiles = tile_range((13.34, 52.49, 13.41, 52.5), 0.05)
+    assert tiles == [
+        (266, 1049),
+        (266, 1050),
+        (267, 1049),
+        (267, 1050),
+        (268, 1049),
+        (268, 1050),
+    ]
+    for tile in tiles:
+        box = tile_bbox(tile, 0.05)
+        assert box[0] <= 13.41 and box[2] >= 13.34
+
+
+def test_group_segments():
+    """Test if rows are grouped by segment"""
+    rows = [
+        (1, 13.0, 52.0, 13.1, 52.1, 10, 11, 12, 0, 30),
+        (1, 13.0, 52.0, 13.1, 52.1, 10, 11, 12, 1, 35),
+        (2, 13.2, 52.2, 13.3, 52.3, 20, 21, 22, 0, 50),
+    ]
+    segments = group_segments(rows)
+    assert len(segments) == 2
+    assert segments[0][2] == (10, 11, 12)
+    assert segments[0][3] == ((0, 30), (1, 35))
+    assert segments[1][1][0] <= 13.2 <= segments[1][1][2]
+
+
+def test_tile_cache_eviction():
+    """Test if least recently used tiles are evicted when the memory budget is exceeded"""
+    cache = TileCache(tile_size=0.05, max_bytes=1000)
+    segments = group_segments([(1, 13.0, 52.0, 13.1, 52.1, 10, 11, 12, 0, 30)])
+    for x in range(20):
+        cache._store((x, 0), segments * 5)
+    stats = cache.stats()
+    assert stats["bytes"] <= 1000
+    assert stats["evictions"] > 0
+    assert cache._load_from_memory((19, 0)) is not None
+    assert cache._load_from_memory((0, 0)) is None
+
+
+def test_tile_cache_hours_and_wide_layout():
+    """Test if cached speed data is filtered by hour of day and pivoted to the wide layout"""
+    cache = TileCache(tile_size=0.05)
+    cache._version_checked = time.monotonic()
+    cache.version_ttl = 3600
+    rows = [
+        (1, 13.01, 52.01, 13.02, 52.02, 10, 11, 12, 7, 30),
+        (1, 13.01, 52.01, 13.02, 52.02, 10, 11, 12, 8, 35),
+        (2, 13.03, 52.03, 13.04, 52.04, 20, 21, 22, 9, 50),
+    ]
+    for tile in tile_range((13.0, 52.0, 13.04, 52.04), 0.05):
+        cache._store(tile, group_segments(rows))
+    bbox = (13.0, 52.0, 13.04, 52.04)
+
+    batches = list(cache.iter_speed_by_bbox(bbox, None, hours=[8, 9]))
+    assert sorted(batches[0]) == [(10, 11, 12, 8, 35), (20, 21, 22, 9, 50)]
+
+    batches = list(cache.iter_speed_by_bbox(bbox, None, hours=[7, 8], wide=True))
+    assert batches[0] == [(10, 11, 12, 30, 35)]
+
+    batches = list(cache.iter_speed_by_bbox(bbox, None, wide=True))
+    assert sorted(len(row) for row in batches[0]) == [27, 27]
+
+
+def test_tile_cache_several_bboxes():
+    """Test if segments within several bounding boxes are returned once"""
+    cache = TileCache(tile_size=0.05)
+    cache._version_checked = time.monotonic()
+    cache.version_ttl = 3600
+    rows = [
+        (1, 13.01, 52.01, 13.02, 52.02, 10, 11, 12, 7, 30),
+        (2, 13.06, 52.06, 13.07, 52.07, 20, 21, 22, 7, 50),
+        (3, 13.2, 52.2, 13.21, 52.21, 30, 31, 32, 7, 60),
+    ]
+    for tile in tile_range((13.0, 52.0, 13.1, 52.1), 0.05):
+        cache._store(tile, group_segments(rows))
+    bboxes = [(13.0, 52.0, 13.06, 52.06), (13.01, 52.01, 13.1, 52.1)]
+    batches = list(cache.iter_speed_by_bboxes(bboxes, None))
+    assert sorted(batches[0]) == [(10, 11, 12, 7, 30), (20, 21, 22, 7, 50)]
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test coverage index"""
+
+from sm2t.coverage import COVERAGE_MARGIN, CoverageIndex
+
+
+def coverage_index():
+    """Coverage index of two cities of 0.02 x 0.01 and 0.01 x 0.01 degree"""
+    coverage = CoverageIndex()
+    coverage.cell_size = 0.01
+    coverage.cells = frozenset({(0, 0), (1, 0), (10, 10)})
+    return coverage
+
+
+def test_bboxes_outside_coverage_are_dropped():
+    """Test if bounding boxes without occupied cells are dropped"""
+    coverage = coverage_index()
+    assert coverage.trim([0.05, 0.05, 0.06, 0.06]) is None
+    assert coverage.trim_bboxes([[0.05, 0.05, 0.06, 0.06], [-1, -1, -0.5, -0.5]]) == []
+    assert coverage.trim_bboxes([[0.05, 0.05, 0.06, 0.06], [0, 0, 0.005, 0.005]]) == [
+        [0, 0, 0.005, 0.005]
+    ]
+
+
+def test_bboxes_are_trimmed_to_occupied_cells():
+    """Test if bounding boxes are trimmed to the occupied cells with a margin"""
+    coverage = coverage_index()
+    trimmed = coverage.trim([-0.5, -0.5, 0.05, 0.05])
+    assert trimmed == [
+        -COVERAGE_MARGIN,
+        -COVERAGE_MARGIN,
+        0.02 + COVERAGE_MARGIN,
+        0.01 + COVERAGE_MARGIN,
+    ]
+    # Cells just outside the bounding box are considered within the margin
+    assert coverage.trim([0.1 - COVERAGE_MARGIN / 2, 0.1, 0.2, 0.2]) is not None
+    # Large bounding boxes are compared with the list of cells
+    assert coverage.trim([-10, -10, 10, 10]) == [
+        -COVERAGE_MARGIN,
+        -COVERAGE_MARGIN,
+        0.11 + COVERAGE_MARGIN,
+        0.11 + COVERAGE_MARGIN,
+    ]
+
+
+def test_bboxes_are_kept_without_coverage_data():
+    """Test if bounding boxes are not changed if the table has not been populated"""
+    coverage = CoverageIndex()
+    assert coverage.trim_bboxes([[5, 5, 5.1, 5.1]]) == [[5, 5, 5.1, 5.1]]
+    assert coverage_index().to_dict()["extent"] == [0, 0, 0.11, 0.11]
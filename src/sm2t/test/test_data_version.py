@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test data version file"""
+
+from sm2t.data_version import (
+    content_hash,
+    current_data_version,
+    last_modified,
+    write_version_file,
+)
+from sm2t.utils import output_filename
+
+
+def test_content_hash_depends_on_city_files_only():
+    """Test if the hash changes with the checksums of the cities, not their order"""
+    manifest = {
+        "berlin": {"checksum": "a1", "imported_at": "2022-01-01"},
+        "heidelberg": {"checksum": "b2", "imported_at": "2022-01-02"},
+    }
+    reimported = {
+        "heidelberg": {"checksum": "b2", "imported_at": "2022-02-01"},
+        "berlin": {"checksum": "a1", "imported_at": "2022-02-01"},
+    }
+    assert content_hash(manifest) == content_hash(reimported)
+    reimported["berlin"]["checksum"] = "a3"
+    assert content_hash(manifest) != content_hash(reimported)
+
+
+def test_version_file_is_reread_when_replaced(tmp_path, monkeypatch):
+    """Test if a replaced version file is picked up and sets the date of file names"""
+    path = tmp_path / "data_version.json"
+    monkeypatch.setenv("DATA_VERSION_FILE", str(path))
+    assert current_data_version() is None
+
+    write_version_file(path, 1, "abc", "2022-03-01T10:00:00+00:00")
+    assert current_data_version()["hash"] == "abc"
+    assert output_filename("label") == "sm2t-20220301-label.csv"
+
+    write_version_file(path, 2, "def", "2022-04-01T10:00:00+00:00")
+    assert current_data_version()["version"] == 2
+    assert last_modified().month == 4
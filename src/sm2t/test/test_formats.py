@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test output formats"""
+
+import gzip
+import io
+
+import pytest
+
+from sm2t.formats import (
+    accepts_encoding,
+    compress_chunks,
+    encode_chunks,
+    negotiate_encoding,
+)
+
+COLUMNS = [
+    "osm_way_id",
+    "osm_start_node_id",
+    "osm_end_node_id",
+    "hour_of_day",
+    "speed_kph_p85",
+]
+BATCHES = [[(4615004, 12614644, 29266235, 6, 41), (4615004, 12614644, 29266235, 7, 28)]]
+
+
+def test_negotiate_encoding():
+    """Test if the content encoding is selected from the Accept-Encoding header"""
+    assert negotiate_encoding("gzip, deflate") == "gzip"
+    assert negotiate_encoding("gzip;q=0") is None
+    assert negotiate_encoding(None) is None
+    assert negotiate_encoding("gzip;q=0.000") is None
+    assert negotiate_encoding("gzip; q=0.5, zstd;q=0") == "gzip"
+    assert negotiate_encoding("*;q=0") is None
+    assert accepts_encoding("*", "gzip")
+    assert accepts_encoding("br, *;q=0.1", "gzip")
+    assert not accepts_encoding("*, gzip;q=0", "gzip")
+    assert not accepts_encoding("br", "gzip")
+
+
+def test_gzip_csv():
+    """Test if compressed CSV decompresses to the plain CSV"""
+    plain = b"".join(encode_chunks(BATCHES, "csv", COLUMNS))
+    compressed = b"".join(
+        compress_chunks(encode_chunks(BATCHES, "csv", COLUMNS), "gzip")
+    )
+    assert gzip.decompress(compressed) == plain
+
+
+def test_arrow_stream():
+    """Test if Arrow IPC stream contains the rows with compact types"""
+    pa = pytest.importorskip("pyarrow")
+    table = pa.ipc.open_stream(
+        b"".join(encode_chunks(BATCHES, "arrow", COLUMNS))
+    ).read_all()
+    assert table.column_names == COLUMNS
+    assert table.schema.field("hour_of_day").type == pa.int8()
+    assert table.column("speed_kph_p85").to_pylist() == [41, 28]
+
+
+def test_parquet_file():
+    """Test if Parquet file contains the rows"""
+    pq = pytest.importorskip("pyarrow.parquet")
+    data = b"".join(encode_chunks(BATCHES, "parquet", COLUMNS))
+    table = pq.read_table(io.BytesIO(data))
+    assert table.column("osm_way_id").to_pylist() == [4615004, 4615004]
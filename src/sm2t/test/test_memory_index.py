@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test memory index"""
+
+import numpy as np
+
+from sm2t.memory_index import (
+    MISSING_SPEED,
+    NULL_SPEED,
+    MemoryIndex,
+    read_current,
+    write_index,
+)
+from sm2t.utils import boxes_overlap, float32_box
+
+
+def random_segments(n, seed=0):
+    """Segments with random boxes around Berlin and some missing and NULL speeds"""
+    rng = np.random.default_rng(seed)
+    corner = rng.uniform([13.3, 52.45], [13.5, 52.55], size=(n, 2))
+    size = rng.exponential(0.002, size=(n, 2))
+    boxes = np.concatenate([corner, corner + size], axis=1)
+    osm_ids = rng.integers(1, 10**10, size=(n, 3))
+    speeds = rng.integers(5, 120, size=(n, 24)).astype(np.int16)
+    speeds[rng.random((n, 24)) < 0.2] = MISSING_SPEED
+    speeds[rng.random((n, 24)) < 0.05] = NULL_SPEED
+    speeds[::17] = MISSING_SPEED
+    # Segments whose rows all have a NULL speed
+    speeds[3::23] = NULL_SPEED
+    return np.arange(1, n + 1), boxes, osm_ids, speeds
+
+
+def expected_rows(boxes, osm_ids, speeds, bboxes, hours, wide):
+    """Rows selected by comparing the single precision boxes of each segment"""
+    rows = []
+    request_boxes = [float32_box(bbox) for bbox in bboxes]
+    for box, ids, hourly in zip(boxes, osm_ids, speeds):
+        box = float32_box(box)
+        if not any(boxes_overlap(box, request_box) for request_box in request_boxes):
+            continue
+        selected = [(hour, int(hourly[hour])) for hour in hours]
+        present = [
+            (hour, None if speed == NULL_SPEED else speed)
+            for hour, speed in selected
+            if speed != MISSING_SPEED
+        ]
+        if wide and present:
+            rows.append(
+                tuple(ids.tolist())
+                + tuple(
+                    None if speed in (MISSING_SPEED, NULL_SPEED) else speed
+                    for _, speed in selected
+                )
+            )
+        elif not wide:
+            rows.extend(tuple(ids.tolist()) + speed for speed in present)
+    return sorted(rows, key=repr)
+
+
+def test_memory_index_matches_box_comparison(tmp_path):
+    """Test if the grid selects the same segments as a comparison of all boxes"""
+    fid, boxes, osm_ids, speeds = random_segments(2000)
+    write_index(tmp_path, fid, boxes, osm_ids, speeds, version=3, cell_size=0.005)
+    index = MemoryIndex(tmp_path)
+    assert index.check_version()
+    requests = [
+        ([(13.35, 52.48, 13.37, 52.49)], None, False),
+        ([(13.35, 52.48, 13.37, 52.49)], [7, 8, 17], True),
+        ([(13.4, 52.5, 13.45, 52.52), (13.44, 52.51, 13.46, 52.53)], [0, 23], False),
+        ([(13.2, 52.0, 13.25, 52.1)], None, True),
+        # Corners of segments, which are rounded outwards to single precision
+        ([tuple(boxes[5][2:]) * 2], None, False),
+    ]
+    null_speeds = 0
+    for bboxes, hours, wide in requests:
+        rows = [
+            row
+            for batch in index.iter_speed_by_bboxes(bboxes, 50, hours, wide)
+            for row in batch
+        ]
+        assert sorted(rows, key=repr) == expected_rows(
+            boxes, osm_ids, speeds, bboxes, hours or range(24), wide
+        )
+        null_speeds += sum(row[4] is None for row in rows if not wide)
+    assert null_speeds > 0
+    assert all(isinstance(value, int) for value in rows[0])
+
+
+def test_memory_index_version(tmp_path):
+    """Test if a new version is loaded and only the previous one is kept"""
+    fid, boxes, osm_ids, speeds = random_segments(100)
+    write_index(tmp_path, fid, boxes, osm_ids, speeds, version=1)
+    index = MemoryIndex(tmp_path, version_ttl=0)
+    assert index.check_version() and index.stats()["segments"] == 100
+    write_index(tmp_path, fid[:50], boxes[:50], osm_ids[:50], speeds[:50], version=2)
+    write_index(tmp_path, fid[:10], boxes[:10], osm_ids[:10], speeds[:10], version=3)
+    index.check_version()
+    assert index.stats() == {"version": 3, "segments": 10, "requests": 0}
+    assert read_current(tmp_path)["directory"] == "v3"
+    assert sorted(path.name for path in tmp_path.iterdir() if path.is_dir()) == [
+        "v2",
+        "v3",
+    ]
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test request timings"""
+
+from types import SimpleNamespace
+
+from flask import Flask
+
+from sm2t import metrics
+from sm2t.metrics import request_timings, server_timing, timed, timed_iter
+
+
+def test_nested_stages_are_not_counted_twice(monkeypatch):
+    """
+    Test if the time of the query stage is not added to the serialize stage wrapping it
+    :return:
+    """
+    # Fake clock advanced in whole seconds, so that the timings are exact
+    now = [0]
+    monkeypatch.setattr(metrics, "time", SimpleNamespace(perf_counter=lambda: now[0]))
+
+    def batches():
+        for _ in range(3):
+            now[0] += 2
+            yield [1, 2]
+
+    def chunks():
+        for batch in timed_iter(batches(), "query", count="rows"):
+            now[0] += 1
+            yield str(batch)
+
+    with Flask(__name__).test_request_context():
+        assert len(list(timed_iter(chunks(), "serialize", nested=("query",)))) == 3
+        timings = request_timings()
+        assert timings["rows"] == 6
+        assert timings["query"] == 6
+        assert timings["serialize"] == 3
+        assert server_timing(timings).startswith("query;dur=")
+
+
+def test_timings_outside_of_request():
+    """
+    Test if stages can be measured outside of a request, e.g. by the loader
+    :return:
+    """
+    with timed("query"):
+        pass
+    assert request_timings() is None
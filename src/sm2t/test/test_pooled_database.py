@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test queries of the populated database, skipped if no database is reachable"""
+
+import pytest
+
+from sm2t.database import load_speed_by_bbox, open_connection, pooled_connection
+
+
+@pytest.fixture(scope="module", autouse=True)
+def database():
+    """Skip the tests of this module if the database cannot be reached"""
+    conn, message = open_connection()
+    if conn is False:
+        pytest.skip(f"Database is not reachable: {message}")
+    conn.close()
+
+
+def test_pooled_connection_is_reused():
+    """Tests whether connections are returned to and reused from the pool"""
+    with pooled_connection() as conn:
+        first_pid = conn.get_backend_pid()
+    with pooled_connection() as conn:
+        second_pid = conn.get_backend_pid()
+    assert first_pid == second_pid
+
+
+def test_load_speed_by_bbox_exact():
+    """Tests whether the exact intersection selects a subset and adds geometries"""
+    bbox = (13.3472, 52.499, 13.4117, 52.5304)
+    conn, message = open_connection()
+    df = load_speed_by_bbox(bbox, conn)
+    exact = load_speed_by_bbox(bbox, conn, exact=True, geometry="geojson")
+    conn.close()
+    assert len(exact) <= len(df)
+    assert list(exact.columns) == list(df.columns) + ["geometry"]
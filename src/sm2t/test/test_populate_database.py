@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test functions loading data into the database"""
+
+import re
+
+import populate_database
+from benchmarks.synthetic_city import write_city_dumps
+from populate_database import (
+    FID_OFFSET_STEP,
+    HIGHWAYS_COLUMNS,
+    SPEED_TABLE_COLUMNS,
+    LineStream,
+    copy_rows,
+    find_city_files,
+    plan_imports,
+    read_copy_columns,
+    update_derived_data,
+)
+
+DUMP = (
+    "SET client_encoding = 'UTF8';\n"
+    "COPY public.speed_predicted_berlin (hour_of_day, fid, speed_kph_p85, model) FROM stdin;\n"
+    "6\t1\t41\tA\n"
+    "7\t\\N\t28\tA\n"
+    "\\.\n"
+    "ALTER TABLE public.speed_predicted_berlin OWNER TO postgres;\n"
+)
+
+
+def test_read_copy_columns(tmp_path):
+    """Test if columns of the COPY statement are found"""
+    dump_file = tmp_path / "speed_predicted_berlin.sql"
+    dump_file.write_text(DUMP)
+    assert read_copy_columns(dump_file) == [
+        "hour_of_day",
+        "fid",
+        "speed_kph_p85",
+        "model",
+    ]
+
+
+def test_copy_rows(tmp_path):
+    """Test if columns are selected and the fid offset is applied while reading"""
+    dump_file = tmp_path / "speed_predicted_berlin.sql"
+    dump_file.write_text(DUMP)
+    rows = list(
+        copy_rows(dump_file, ["fid", "hour_of_day", "speed_kph_p85"], 100000000000)
+    )
+    assert rows == ["100000000001\t6\t41\n", "\\N\t7\t28\n"]
+
+
+def test_line_stream():
+    """Test if the stream returns all lines in chunks of the requested size"""
+    stream = LineStream(["ab\n", "cde\n", "f\n"])
+    chunks = []
+    while True:
+        chunk = stream.read(4)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    assert chunks == ["ab\nc", "de\nf", "\n"]
+    assert stream.n_lines == 3
+
+
+def test_plan_imports_keeps_fid_offsets(tmp_path):
+    """Test if unchanged cities are skipped and offsets of known cities are kept"""
+    cities = []
+    for city_name in ["berlin", "nairobi", "seattle"]:
+        edges_file = tmp_path / f"edges_{city_name}.sql"
+        speed_file = tmp_path / f"speed_predicted_{city_name}.sql"
+        edges_file.write_text(city_name)
+        speed_file.write_text(city_name)
+        cities.append((city_name, edges_file, speed_file))
+
+    jobs, removed = plan_imports(cities[1:], {})
+    assert [(job[0], job[3]) for job in jobs] == [
+        ("nairobi", 0),
+        ("seattle", FID_OFFSET_STEP),
+    ]
+    manifest = {job[0]: {"checksum": job[4], "fid_offset": job[3]} for job in jobs}
+    manifest["paris"] = {"checksum": "", "fid_offset": 2 * FID_OFFSET_STEP}
+    cities[2][2].write_text("changed")
+
+    jobs, removed = plan_imports(cities, manifest)
+    assert [(job[0], job[3]) for job in jobs] == [
+        ("berlin", 3 * FID_OFFSET_STEP),
+        ("seattle", FID_OFFSET_STEP),
+    ]
+    assert removed == ["paris"]
+
+
+def test_synthetic_city_dumps_can_be_loaded(tmp_path):
+    """Test if the dumps of the benchmark generator are found and read by the loader"""
+    city = write_city_dumps(tmp_path, "alpha", 50, 1e6, seed=1)
+    [(city_name, edges_file, speed_file)] = find_city_files(tmp_path)
+    assert city_name == "alpha"
+    edges = list(copy_rows(edges_file, HIGHWAYS_COLUMNS, FID_OFFSET_STEP))
+    speed = list(copy_rows(speed_file, SPEED_TABLE_COLUMNS, FID_OFFSET_STEP))
+    assert len(edges) == city["edges"] == 50
+    assert len(speed) == city["speed"]
+    assert edges[0].startswith(f"{FID_OFFSET_STEP + 1}\t")
+    assert edges[0].split("\t")[4].startswith("0102000020E6100000")
+
+
+def test_shard_import_keeps_files_of_primary(tmp_path, monkeypatch):
+    """Test if the import of a shard only updates the registry, not the files served
+    from the primary database"""
+    registered = []
+    monkeypatch.setattr(populate_database, "update_registry", registered.append)
+    monkeypatch.setenv("POSTGRES_DB", "postgres")
+    monkeypatch.setenv("DB_SHARDS", "shard1=db-shard1:5432")
+    monkeypatch.setenv("SNAPSHOT_DIR", str(tmp_path / "snapshots"))
+    monkeypatch.setenv("DATA_VERSION_FILE", str(tmp_path / "data_version.json"))
+    monkeypatch.delenv("MEMORY_INDEX_DIR", raising=False)
+    monkeypatch.delenv("TILE_ARCHIVE", raising=False)
+    update_derived_data("shard1")
+    assert registered == ["shard1"]
+    assert not (tmp_path / "snapshots").exists()
+    assert not (tmp_path / "data_version.json").exists()
+
+
+def test_shadow_build_names_the_shadow_schema():
+    """Test if the tables and indexes of the shadow build are schema-qualified, so
+    that statements on an empty shadow schema do not fall through to public"""
+    statements = []
+
+    class FakeConnection:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            return False
+
+        def execution_options(self, **kwargs):
+            return self
+
+        def execute(self, query, *args, **kwargs):
+            statements.append(str(query))
+
+    class FakeEngine:
+        connect = FakeConnection
+
+    engine = FakeEngine()
+    populate_database.create_highways_table(engine, "sm2t_next")
+    populate_database.create_speed_table(engine, "sm2t_next")
+    populate_database.create_manifest_table(engine, "sm2t_next")
+    populate_database.create_index(engine, "sm2t_next")
+    populate_database.analyze_tables(engine, "sm2t_next")
+    populate_database.create_packed_table(engine, "sm2t_next")
+    populate_database.create_density_table(engine, "sm2t_next", 0.01)
+    populate_database.create_coverage_table(engine, "sm2t_next", 0.01)
+    populate_database.bump_dataset_version(engine, "sm2t_next")
+    tables = re.compile(
+        r"\b(?:TABLE(?: IF (?:NOT )?EXISTS)?|INDEX IF EXISTS|ON|FROM|INTO|CLUSTER|ANALYZE)"
+        r"\s+(?!\()([\w.]+)"
+    )
+    names = [name for statement in statements for name in tables.findall(statement)]
+    assert len(names) > 30
+    assert [
+        name
+        for name in names
+        if not name.startswith("sm2t_next.") and name != "public.dataset_version_seq"
+    ] == []
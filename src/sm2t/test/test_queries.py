@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test prepared statements"""
+
+from sm2t.database import (
+    bbox_region,
+    changes_query,
+    changeset_chain,
+    iter_speed,
+    speed_query,
+)
+from sm2t.queries import positional_query, statement_name
+
+
+class FakeCursor:
+    """Cursor recording the executed statements and returning rows in batches"""
+
+    def __init__(self, connection, name=None):
+        self.connection = connection
+        self.name = name
+        self.rows = [(i, 1, 2, 7, 30) for i in range(5)]
+
+    def execute(self, query, params=None):
+        self.connection.statements.append((self.name, query.strip()))
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    """Connection creating FakeCursor objects"""
+
+    def __init__(self):
+        self.statements = []
+
+    def cursor(self, name=None):
+        return FakeCursor(self, name)
+
+
+def test_positional_query():
+    """
+    Test if named parameters are numbered in order of appearance and repeated ones are reused
+    :return:
+    """
+    query, names = positional_query(
+        "SELECT %(a)s, %(b)s::int[], %(a)s FROM t WHERE x = ANY(%(b)s);"
+    )
+    assert query == "SELECT $1, $2::int[], $1 FROM t WHERE x = ANY($2)"
+    assert names == ["a", "b"]
+
+
+def test_bbox_query_text_is_independent_of_bbox():
+    """
+    Test if requests for different bounding boxes share one prepared statement
+    :return:
+    """
+    query_a, params_a = speed_query(bbox_region([8.0, 49.0, 8.1, 49.1]))
+    query_b, params_b = speed_query(bbox_region([13.3, 52.5, 13.4, 52.6]))
+    assert statement_name(query_a) == statement_name(query_b)
+    assert params_a["min_lon"] == 8.0 and params_b["max_lat"] == 52.6
+
+
+def test_exact_and_geometry_options_extend_query(monkeypatch):
+    """
+    Test if the default query is unchanged and the options add the refinement and geometry
+    :return:
+    """
+    bbox = [8.0, 49.0, 8.1, 49.1]
+    for layout in ["long", "packed"]:
+        monkeypatch.setenv("SPEED_LAYOUT", layout)
+        for wide in [False, True]:
+            query, params = speed_query(bbox_region(bbox), wide=wide)
+            assert "ST_Intersects" not in query and "geometry," not in query
+            query, _ = speed_query(bbox_region(bbox, exact=True), wide=wide)
+            assert "ST_Intersects" in query
+            query, params = speed_query(
+                bbox_region(bbox), wide=wide, geometry="geojson", simplify=0.0001
+            )
+            assert "ST_AsGeoJSON(ST_Simplify(" in query and params["simplify"] == 0.0001
+            assert query.count("AS geometry") == 1
+
+
+def test_changeset_chain():
+    """
+    Test if changesets are chained back to the version of the client and broken
+    chains are detected
+    :return:
+    """
+    changesets = {5: 3, 7: 5, 9: 7}
+    assert changeset_chain(changesets, 3, 9) == [9, 7, 5]
+    assert changeset_chain(changesets, 7, 9) == [9]
+    assert changeset_chain(changesets, 9, 9) == []
+    # Pruned changesets and versions which have been rolled back
+    assert changeset_chain(changesets, 1, 9) is None
+    assert changeset_chain(changesets, 8, 9) is None
+
+
+def test_changes_query_returns_latest_change_per_segment():
+    """
+    Test if the changes query selects one row per segment from the changesets
+    :return:
+    """
+    query, params = changes_query([9, 7], bbox_region([8.0, 49.0, 8.1, 49.1]))
+    assert "DISTINCT ON (changes.osm_way_id" in query
+    assert "changes.version DESC" in query and "changes.geometry &&" in query
+    assert params["versions"] == [9, 7] and params["min_lon"] == 8.0
+
+
+def test_packed_queries_keep_rows_with_null_speed(monkeypatch):
+    """
+    Test if the packed layout selects hours by the mask of rows in the speed table,
+    so rows whose speed is NULL are returned as by the long layout
+    :return:
+    """
+    monkeypatch.setenv("SPEED_LAYOUT", "packed")
+    bbox = [8.0, 49.0, 8.1, 49.1]
+    for kwargs in [{}, {"geometry": "wkb"}]:
+        query, _ = speed_query(bbox_region(bbox), **kwargs)
+        assert "IS NOT NULL" not in query
+        assert "hour_mask & (1 << (hourly.hour - 1)::int) <> 0" in query
+    query, _ = speed_query(bbox_region(bbox), hours=[0, 2], wide=True)
+    assert "packed.hour_mask & 5 <> 0" in query
+
+
+def test_streamed_speed_query_is_prepared(monkeypatch):
+    """
+    Test if streaming executes the prepared statement and fetches the rows in batches,
+    and a server-side cursor runs the query if prepared statements are disabled
+    :return:
+    """
+    region = bbox_region([8.0, 49.0, 8.1, 49.1])
+    name = statement_name(speed_query(region)[0])
+    conn = FakeConnection()
+    batches = list(iter_speed(region, conn, batch_size=2))
+    assert [len(rows) for rows in batches] == [2, 2, 1]
+    assert conn.statements[0][1].startswith(f"PREPARE {name} AS")
+    arguments = "%(min_lon)s, %(min_lat)s, %(max_lon)s, %(max_lat)s"
+    assert conn.statements[1] == (None, f"EXECUTE {name}({arguments});")
+    list(iter_speed(region, conn, batch_size=2))
+    assert conn.statements[2][1].startswith(f"EXECUTE {name}(")
+
+    monkeypatch.setenv("PREPARED_STATEMENTS", "false")
+    conn = FakeConnection()
+    assert len(list(iter_speed(region, conn, batch_size=2))) == 3
+    assert conn.statements[0][0] == "speed_by_bbox"
+    assert conn.statements[0][1] == speed_query(region)[0].strip()
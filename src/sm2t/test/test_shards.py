@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test routing of requests to shards"""
+
+from contextlib import contextmanager
+
+import pytest
+
+from sm2t import shards
+from sm2t.database import database_address, shard_addresses
+
+
+def test_shard_addresses(monkeypatch):
+    """Test if shards are parsed from DB_SHARDS and the primary database is the default"""
+    monkeypatch.setenv("HOST", "db")
+    monkeypatch.setenv("POSTGRES_PORT", "5432")
+    monkeypatch.setenv("POSTGRES_DB", "postgres")
+    monkeypatch.setenv("DB_SHARDS", "shard1=db-shard1:5433,shard2=/tmp/pg:5432/sm2t")
+    assert shard_addresses()["shard1"] == {
+        "host": "db-shard1",
+        "port": "5433",
+        "dbname": "postgres",
+    }
+    assert database_address("shard2")["host"] == "/tmp/pg"
+    assert database_address("shard2")["dbname"] == "sm2t"
+    assert database_address()["host"] == "db"
+    monkeypatch.setenv("DB_SHARD", "shard1")
+    assert database_address()["host"] == "db-shard1"
+    with pytest.raises(ValueError):
+        database_address("shard3")
+
+
+def test_bboxes_are_routed_to_overlapping_shards():
+    """Test if only shards with cities overlapping the bounding boxes are selected"""
+    registry = shards.ShardRegistry()
+    registry.update(
+        [
+            ("berlin", "shard2", 13.08, 52.33, 13.76, 52.67),
+            ("heidelberg", "shard1", 8.57, 49.35, 8.8, 49.46),
+            ("mannheim", "shard1", 8.41, 49.41, 8.59, 49.59),
+        ]
+    )
+    assert not registry.refresh_due()
+    assert registry.shards_for_bboxes([[8.6, 49.4, 8.7, 49.45]]) == ["shard1"]
+    assert registry.shards_for_bboxes([[8.6, 49.4, 13.1, 52.4]]) == [
+        "shard1",
+        "shard2",
+    ]
+    assert registry.shards_for_bboxes([[0, 0, 1, 1]]) == []
+    assert registry.shards() == ["shard1", "shard2"]
+
+
+def test_batches_of_shards_are_merged(monkeypatch):
+    """Test if the batches of all shards are yielded and errors are raised"""
+
+    @contextmanager
+    def fake_connection(shard=None):
+        yield shard
+
+    def fake_iter_speed(region, conn, **kwargs):
+        if conn == "broken":
+            raise RuntimeError("shard is down")
+        for i in range(3):
+            yield [(conn, i)]
+
+    monkeypatch.setattr(shards, "pooled_connection", fake_connection)
+    monkeypatch.setattr(shards, "iter_speed", fake_iter_speed)
+    batches = list(shards.iter_speed_shards(None, ["shard1", "shard2"]))
+    assert sorted(row for rows in batches for row in rows) == [
+        ("shard1", 0),
+        ("shard1", 1),
+        ("shard1", 2),
+        ("shard2", 0),
+        ("shard2", 1),
+        ("shard2", 2),
+    ]
+    with pytest.raises(RuntimeError):
+        list(shards.iter_speed_shards(None, ["shard1", "broken"]))
@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test snapshot files"""
+
+import pytest
+
+from sm2t.snapshots import read_snapshot_index, write_snapshot, write_snapshot_index
+
+pa = pytest.importorskip("pyarrow")
+
+
+def test_write_snapshot(tmp_path):
+    """Test if snapshots are sorted by osm_way_id and can be memory-mapped"""
+    path = str(tmp_path / "city.arrow")
+    speeds = tuple(range(24))
+    batches = [[(30, 1, 2) + speeds, (10, 3, 4) + speeds], [(20, 5, 6) + (None,) * 24]]
+    assert write_snapshot(path, batches) == 3
+    table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+    assert table.column("osm_way_id").to_pylist() == [10, 20, 30]
+    assert table.column("speed_kph_p85_23").to_pylist() == [23, None, 23]
+
+
+def test_snapshot_index(tmp_path):
+    """Test if the index is written and read"""
+    assert read_snapshot_index(str(tmp_path)) == {}
+    index = {"city": {"file": "city.arrow", "sha256": "abc"}}
+    write_snapshot_index(str(tmp_path), index)
+    assert read_snapshot_index(str(tmp_path)) == index
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test vector tiles and tile archives"""
+
+from sm2t.tiles import (
+    TileArchive,
+    gzip_tile,
+    lat_to_tile,
+    lon_to_tile,
+    min_tile_zoom,
+    tms_row,
+    write_archive,
+)
+
+
+def test_tile_indices():
+    """Test if coordinates are mapped to tiles of the XYZ scheme"""
+    assert min_tile_zoom(0.2) == 11
+    assert lon_to_tile(13.38, 14) == 8800
+    assert lat_to_tile(52.52, 14) == 5373
+    assert lat_to_tile(-85.2, 2) == 3
+    assert tms_row(14, 5373) == 2**14 - 1 - 5373
+
+
+def test_tile_archive(tmp_path):
+    """Test if tiles written to an archive are found and a new archive is picked up"""
+    path = str(tmp_path / "tiles.mbtiles")
+    archive = TileArchive(path)
+    assert archive.get(12, 1, 2) is None
+
+    write_archive(
+        path, [(12, 1, 2, gzip_tile(b"tile"))], {"minzoom": 11, "maxzoom": 12}
+    )
+    assert archive.zoom_range() == (11, 12)
+    assert archive.get(12, 1, 2) == gzip_tile(b"tile")
+    assert archive.get(12, 1, 3) == b""
+
+    write_archive(path, [(12, 1, 3, gzip_tile(b"new"))], {"minzoom": 11, "maxzoom": 12})
+    assert archive.get(12, 1, 3) == gzip_tile(b"new")
@@ -2,7 +2,20 @@
 # -*- coding: utf-8 -*-
 """Test utility functions"""
 
-from sm2t.utils import parse_bbox
+import subprocess
+import sys
+
+from sm2t.utils import (
+    bboxes_shape,
+    check_area,
+    csv_chunks,
+    geometry_shape,
+    parse_bbox,
+    parse_bboxes,
+    parse_body_hours,
+    parse_hours,
+    parse_osm_ids,
+)
 import datetime
 
 
@@ -18,3 +31,128 @@ def test_parse_bbox():
     coordinates, outfile = parse_bbox(bbox)
     assert coordinates == expected_coordinates
     assert expected_outfile == outfile
+
+
+def test_csv_chunks():
+    """
+    Test if batches of rows are encoded as one CSV with header
+    :return:
+    """
+    batches = [[(1, 2, 3, 0, 30), (1, 2, 3, 1, 32)], [(4, 5, 6, 0, None)]]
+    chunks = list(csv_chunks(batches, ["a", "b", "c", "hour", "speed"]))
+    assert len(chunks) == 3
+    assert b"".join(chunks) == b"a,b,c,hour,speed\n1,2,3,0,30\n1,2,3,1,32\n4,5,6,0,\n"
+
+
+def test_parse_hours():
+    """
+    Test if hours and time windows are parsed, including windows wrapping around midnight
+    :return:
+    """
+    assert parse_hours() == (None, None)
+    assert parse_hours("8,7,8") == ([7, 8], None)
+    assert parse_hours(hour_from=16, hour_to=18) == ([16, 17, 18], None)
+    assert parse_hours(hour_from=22, hour_to=1) == ([0, 1, 22, 23], None)
+    assert parse_hours(hour_to=2) == ([0, 1, 2], None)
+    assert parse_hours("24")[0] is False
+    assert parse_hours("a")[0] is False
+    assert parse_hours("7", hour_from=8)[0] is False
+
+
+def test_parse_body_hours():
+    """
+    Test if hours of a JSON body of another type than integers are rejected
+    :return:
+    """
+    assert parse_body_hours({}) == (None, None)
+    assert parse_body_hours({"hours": 7}) == ([7], None)
+    assert parse_body_hours({"hours": [8, 7]}) == ([7, 8], None)
+    assert parse_body_hours({"hour_from": 22, "hour_to": 1})[0] == [0, 1, 22, 23]
+    for body in [
+        {"hours": 7.5},
+        {"hours": "7"},
+        {"hours": {"from": 7}},
+        {"hours": [7.5]},
+        {"hours": [[7]]},
+        {"hours": True},
+        {"hour_from": [1]},
+        {"hour_to": "2"},
+        {"hour_from": 1.0, "hour_to": 2},
+    ]:
+        hours, message = parse_body_hours(body)
+        assert hours is False and message.startswith("Hours are invalid")
+
+
+def test_parse_bboxes_and_total_area():
+    """
+    Test if a list of bounding boxes is parsed and its total area counts overlaps once
+    :return:
+    """
+    bboxes, message = parse_bboxes([[0, 0, 0.2, 0.2], "0.1,0.1,0.3,0.3"])
+    assert message is None
+    assert bboxes == [[0, 0, 0.2, 0.2], [0.1, 0.1, 0.3, 0.3]]
+    assert abs(bboxes_shape(bboxes).area - 0.07) < 1e-9
+    assert check_area(bboxes_shape(bboxes), 0.08)[0]
+    assert not check_area(bboxes_shape(bboxes), 0.06)[0]
+    assert parse_bboxes([[0, 0, 0.2]])[0] is False
+    assert parse_bboxes([[0.2, 0, 0.1, 0.2]])[0] is False
+    assert parse_bboxes([])[0] is False
+    assert parse_bboxes([[float("nan"), 0, 1, 1]])[0] is False
+    assert parse_bboxes([[0, 0, float("inf"), 1]])[0] is False
+    assert parse_bboxes(["nan,0,1,1"])[0] is False
+    assert parse_bbox("nan,0,1,1")[0] is False
+    assert parse_bbox("a,0,1,1")[0] is False
+
+
+def test_geometry_shape():
+    """
+    Test if lines require a buffer
+    :return:
+    """
+    line = {"type": "LineString", "coordinates": [[0, 0], [1, 0]]}
+    assert geometry_shape(line)[0] is False
+    region, message = geometry_shape({"type": "Feature", "geometry": line}, 0.01)
+    assert message is None
+    assert abs(region.area - 0.02) < 0.001
+    assert geometry_shape({"type": "Line"})[0] is False
+
+
+def test_parse_osm_ids():
+    """
+    Test if osm_way_ids and node pairs are parsed
+    :return:
+    """
+    assert parse_osm_ids([1, "2"]) == ([1, 2], None)
+    assert parse_osm_ids([[1, 2], ["3", 4]], pairs=True) == ([(1, 2), (3, 4)], None)
+    assert parse_osm_ids([[1, 2, 3]], pairs=True)[0] is False
+    assert parse_osm_ids(["a"])[0] is False
+    assert parse_osm_ids([])[0] is False
+
+
+def test_serving_modules_do_not_load_ingestion_dependencies():
+    """Test if the modules of the API workers import without geopandas, pandas, sqlalchemy"""
+    script = (
+        "import sys\n"
+        "import sm2t.admission, sm2t.cache, sm2t.database, sm2t.formats, sm2t.tiles\n"
+        "print(' '.join(m for m in ['geopandas', 'pandas', 'sqlalchemy'] if m in sys.modules))"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", script], check=True, capture_output=True, text=True
+    ).stdout
+    assert output.strip() == ""
+
+
+def test_optional_dependencies_are_imported_on_use():
+    """Test if pyarrow, zstandard and shapely are imported by the requests using them,
+    and the modules used by the loader import neither flask nor prometheus_client"""
+    script = (
+        "import sys\n"
+        "import sm2t.admission, sm2t.cache, sm2t.coverage, sm2t.database, sm2t.formats\n"
+        "import sm2t.memory_index, sm2t.shards, sm2t.snapshots, sm2t.tiles, sm2t.utils\n"
+        "modules = ['pyarrow', 'zstandard', 'shapely', 'flask', 'prometheus_client']\n"
+        "print(' '.join(m for m in modules if m in sys.modules))"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", script], check=True, capture_output=True, text=True
+    ).stdout
+    assert output.strip() == ""
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Mapbox Vector Tiles of hourly speeds and MBTiles archives of pre-rendered tiles"""
+
+import gzip
+import math
+import os
+import sqlite3
+import threading
+
+from sm2t import queries
+from sm2t.database import packed_layout, wide_speed_columns
+
+TILE_LAYER = "speed"
+TILE_EXTENT = 4096
+MAX_ZOOM = 22
+
+
+def min_tile_zoom(max_bbox_degree: float = None):
+    """
+    Lowest zoom level whose tiles are not wider than the maximum bounding box
+    :param max_bbox_degree: Maximum width of a bounding box. Defaults to MAX_BBOX_DEGREE.
+    :return: Zoom level
+    """
+    if max_bbox_degree is None:
+        max_bbox_degree = float(os.getenv("MAX_BBOX_DEGREE"))
+    return max(0, math.ceil(math.log2(360 / max_bbox_degree)))
+
+
+def valid_tile(z: int, x: int, y: int):
+    """
+    Check if tile indices exist
+    :param z: Zoom level
+    :param x: Column
+    :param y: Row, counted from the north (XYZ scheme)
+    :return: bool
+    """
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2**z and 0 <= y < 2**z
+
+
+def tms_row(z: int, y: int):
+    """Row of a tile counted from the south as used by MBTiles"""
+    return 2**z - 1 - y
+
+
+def lon_to_tile(lon: float, z: int):
+    """Column of the tile containing a longitude"""
+    return min(2**z - 1, max(0, math.floor((lon + 180) / 360 * 2**z)))
+
+
+def lat_to_tile(lat: float, z: int):
+    """Row of the tile containing a latitude (XYZ scheme)"""
+    lat = max(-85.0511, min(85.0511, lat))
+    rad = math.radians(lat)
+    row = (1 - math.log(math.tan(rad) + 1 / math.cos(rad)) / math.pi) / 2 * 2**z
+    return min(2**z - 1, max(0, math.floor(row)))
+
+
+def tile_query(z: int, x: int, y: int):
+    """
+    SQL query rendering the highway segments of a tile with their 24 hourly speeds
+    as Mapbox Vector Tile
+    :param z: Zoom level
+    :param x: Column
+    :param y: Row (XYZ scheme)
+    :return: SQL query string, dictionary of query parameters
+    """
+    columns = wide_speed_columns()[3:]
+    if packed_layout():
+        hourly_speeds = ", ".join(
+            f"packed.speeds[{hour + 1}]::int AS {column}"
+            for hour, column in enumerate(columns)
+        )
+        segments = f"""
+            SELECT packed.geometry, packed.osm_way_id, packed.osm_start_node_id,
+            packed.osm_end_node_id, {hourly_speeds}
+            FROM highways_packed AS packed
+            WHERE packed.geometry && ST_Transform(ST_TileEnvelope(%(z)s, %(x)s, %(y)s), 4326)
+        """
+    else:
+        hourly_speeds = ", ".join(
+            f"(max(speed.speed_kph_p85) FILTER (WHERE speed.hour_of_day = {hour}))::int AS {column}"
+            for hour, column in enumerate(columns)
+        )
+        segments = f"""
+            SELECT highways.geometry, highways.osm_way_id, highways.osm_start_node_id,
+            highways.osm_end_node_id, {hourly_speeds}
+            FROM highways
+            JOIN speed ON (speed.fid = highways.fid)
+            WHERE highways.geometry && ST_Transform(ST_TileEnvelope(%(z)s, %(x)s, %(y)s), 4326)
+            GROUP BY highways.fid
+        """
+    return (
+        f"""
+        SELECT ST_AsMVT(features, '{TILE_LAYER}', {TILE_EXTENT}, 'geom')
+        FROM (
+          SELECT ST_AsMVTGeom(
+            ST_Transform(segments.geometry, 3857),
+            ST_TileEnvelope(%(z)s, %(x)s, %(y)s),
+            {TILE_EXTENT}
+          ) AS geom,
+          segments.osm_way_id, segments.osm_start_node_id, segments.osm_end_node_id,
+          {", ".join(f"segments.{column}" for column in columns)}
+          FROM ({segments}) AS segments
+        ) AS features;
+        """,
+        {"z": z, "x": x, "y": y},
+    )
+
+
+def render_tile(conn, z: int, x: int, y: int):
+    """
+    Render a tile from the database
+    :param conn: psycopg2.connection object
+    :param z: Zoom level
+    :param x: Column
+    :param y: Row (XYZ scheme)
+    :return: Mapbox Vector Tile as bytes, empty if there are no segments in the tile
+    """
+    query, params = tile_query(z, x, y)
+    cur = conn.cursor()
+    try:
+        queries.execute(cur, query, params)
+        data = cur.fetchone()[0]
+    finally:
+        cur.close()
+    conn.commit()
+    return bytes(data) if data is not None else b""
+
+
+def write_archive(path, tiles, metadata: dict):
+    """
+    Write tiles to an MBTiles archive. The archive is written to a temporary file
+    first and moved into place, so readers never see a partially written archive.
+    :param path: Path of the archive
+    :param tiles: Iterable of (z, x, y, data) with y in the XYZ scheme and gzipped data
+    :param metadata: Dictionary of metadata, e.g. minzoom, maxzoom, version
+    :return: Number of tiles written
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    con = sqlite3.connect(tmp_path)
+    try:
+        con.execute("CREATE TABLE metadata (name text, value text);")
+        con.execute(
+            "CREATE TABLE tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob);"
+        )
+        metadata = {"name": "sm2t", "format": "pbf", **metadata}
+        con.executemany(
+            "INSERT INTO metadata VALUES (?, ?);",
+            [(name, str(value)) for name, value in metadata.items()],
+        )
+        n_tiles = 0
+        for z, x, y, data in tiles:
+            con.execute(
+                "INSERT INTO tiles VALUES (?, ?, ?, ?);",
+                (z, x, tms_row(z, y), sqlite3.Binary(data)),
+            )
+            n_tiles += 1
+        con.execute(
+            "CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row);"
+        )
+        con.commit()
+    finally:
+        con.close()
+    os.replace(tmp_path, path)
+    return n_tiles
+
+
+class TileArchive:
+    """
+    Read-only access to an MBTiles archive of gzipped tiles. The archive file is
+    memory-mapped, so tiles are looked up without copying the file into each worker.
+    A new archive moved into place by the pre-rendering job is opened on the next lookup.
+    """
+
+    def __init__(self, path, mmap_size=2**30):
+        """
+        :param path: Path of the archive
+        :param mmap_size: Maximum number of bytes of the archive mapped into memory
+        """
+        self.path = path
+        self.mmap_size = mmap_size
+        self.metadata = {}
+        self._con = None
+        self._stat = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        """Open the archive if it has been replaced since it was opened or the worker was forked"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        key = (stat.st_ino, stat.st_mtime_ns, os.getpid())
+        if self._con is None or key != self._stat:
+            if self._con is not None and self._stat[2] == os.getpid():
+                self._con.close()
+            self._con = sqlite3.connect(
+                f"file:{self.path}?mode=ro&immutable=1",
+                uri=True,
+                check_same_thread=False,
+            )
+            self._con.execute(f"PRAGMA mmap_size={int(self.mmap_size)};")
+            self.metadata = dict(self._con.execute("SELECT name, value FROM metadata;"))
+            self._stat = key
+        return self._con
+
+    def zoom_range(self):
+        """
+        Zoom levels contained in the archive
+        :return: (minzoom, maxzoom) or None if there is no archive
+        """
+        with self._lock:
+            if self._open() is None:
+                return None
+            return int(self.metadata["minzoom"]), int(self.metadata["maxzoom"])
+
+    def get(self, z: int, x: int, y: int):
+        """
+        Look up a tile
+        :param z: Zoom level
+        :param x: Column
+        :param y: Row (XYZ scheme)
+        :return: Gzipped tile, empty if the tile holds no segments, None if there is no archive
+        """
+        with self._lock:
+            con = self._open()
+            if con is None:
+                return None
+            row = con.execute(
+                "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?;",
+                (z, x, tms_row(z, y)),
+            ).fetchone()
+        return bytes(row[0]) if row is not None else b""
+
+
+_tile_archive = None
+
+
+def get_tile_archive():
+    """
+    Returns the tile archive at TILE_ARCHIVE
+    :return: TileArchive or None if TILE_ARCHIVE is not set
+    """
+    global _tile_archive
+    path = os.getenv("TILE_ARCHIVE")
+    if not path:
+        return None
+    if _tile_archive is None or _tile_archive.path != path:
+        _tile_archive = TileArchive(
+            path,
+            mmap_size=int(float(os.getenv("TILE_ARCHIVE_MMAP_MB", 1024)) * 2**20),
+        )
+    return _tile_archive
+
+
+def gzip_tile(data: bytes):
+    """Compress a tile as stored in MBTiles archives"""
+    return gzip.compress(data, compresslevel=6, mtime=0) if data else b""
@@ -1,11 +1,22 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-"""Utility functions"""
+"""Utility functions
 
+shapely is imported by the functions handling the regions of batch requests, so
+that it is not loaded by requests for single bounding boxes.
+"""
+
+import csv
 import datetime
+import io
 import logging
+import math
 import os
 
+import numpy as np
+
+from sm2t.data_version import last_modified
+
 
 def parse_bbox(bbox: str):
     """
@@ -13,21 +24,35 @@ def parse_bbox(bbox: str):
     :param bbox: Bounding box as str min_lon,min_lat,max_lon,max_lat
     :return: List of coordinates, filename with bounding box
     """
-    coords = [float(x) for x in bbox.split(",")]
-    if len(coords) < 4:
+    try:
+        coords = [float(x) for x in bbox.split(",")]
+    except ValueError:
+        coords = []
+    if len(coords) < 4 or not all(math.isfinite(x) for x in coords):
         return (
             False,
             "Bounding box is invalid. Required format: min_lon,min_lat,max_lon,max_lat",
         )
     rounded = [int(round(x * 1e6, 0)) for x in coords]
-    date = datetime.date.today().strftime("%Y%m%d")
 
     c0 = f"w{rounded[0] * -1}" if rounded[0] < 0 else f"e{rounded[0]}"
     c2 = f"w{rounded[2] * -1}" if rounded[2] < 0 else f"e{rounded[2]}"
     c1 = f"s{rounded[1] * -1}" if rounded[1] < 0 else f"n{rounded[1]}"
     c3 = f"s{rounded[3] * -1}" if rounded[3] < 0 else f"n{rounded[3]}"
 
-    return coords, f"sm2t-{date}-{c0}_{c1}_{c2}_{c3}.csv"
+    return coords, output_filename(f"{c0}_{c1}_{c2}_{c3}")
+
+
+def output_filename(label: str):
+    """
+    Name of a downloaded file. It holds the date of the live data version,
+    so that it does not change between data imports, or today's date if it is unknown.
+    :param label: Description of the requested data, e.g. the bounding box
+    :return: File name with date and label
+    """
+    created_at = last_modified()
+    date = (created_at or datetime.date.today()).strftime("%Y%m%d")
+    return f"sm2t-{date}-{label}.csv"
 
 
 def check_bbox(bbox: list, bbox_max: float):
@@ -36,6 +61,11 @@ def check_bbox(bbox: list, bbox_max: float):
     :param bbox:
     :return:
     """
+    if not all(math.isfinite(x) for x in bbox[:4]):
+        return (
+            False,
+            "Bounding box is invalid. Coordinates must be finite numbers.",
+        )
     if (bbox[2] < bbox[0]) or (bbox[3] < bbox[1]):
         return (
             False,
@@ -50,6 +80,173 @@ def check_bbox(bbox: list, bbox_max: float):
         return True, None
 
 
+def parse_bboxes(bboxes: list):
+    """
+    Parse a list of bounding boxes. The number of boxes is limited by MAX_BATCH_BBOXES.
+    :param bboxes: List of bounding boxes, each as list or str min_lon,min_lat,max_lon,max_lat
+    :return: List of coordinate lists or False, error message
+    """
+    if not isinstance(bboxes, list) or len(bboxes) == 0:
+        return False, "bboxes must be a list of bounding boxes."
+    max_bboxes = int(os.getenv("MAX_BATCH_BBOXES", 1000))
+    if len(bboxes) > max_bboxes:
+        return False, f"At most {max_bboxes} bounding boxes can be requested at once."
+    parsed = []
+    for bbox in bboxes:
+        try:
+            coords = [
+                float(x) for x in (bbox.split(",") if isinstance(bbox, str) else bbox)
+            ]
+        except (TypeError, ValueError):
+            coords = []
+        if len(coords) != 4:
+            return (
+                False,
+                "Bounding box is invalid. Required format: min_lon,min_lat,max_lon,max_lat",
+            )
+        bbox_ok, message = check_bbox(coords, float("inf"))
+        if not bbox_ok:
+            return False, message
+        parsed.append(coords)
+    return parsed, None
+
+
+def parse_osm_ids(ids: list, pairs: bool = False):
+    """
+    Parse a list of OSM ids. The number of ids is limited by MAX_LOOKUP_IDS.
+    :param ids: List of osm_way_ids or of [osm_start_node_id, osm_end_node_id] pairs
+    :param pairs: Whether ids is a list of node pairs
+    :return: List of ids or of (start, end) tuples or False, error message
+    """
+    if not isinstance(ids, list) or len(ids) == 0:
+        return False, "Ids must be a list."
+    max_ids = int(os.getenv("MAX_LOOKUP_IDS", 10000))
+    if len(ids) > max_ids:
+        return False, f"At most {max_ids} ids can be requested at once."
+    try:
+        if pairs:
+            parsed = [(int(start), int(end)) for start, end in ids]
+        else:
+            parsed = [int(x) for x in ids]
+    except (TypeError, ValueError):
+        if pairs:
+            return False, "Node pairs are invalid. Required format: [[start, end], ...]"
+        return False, "Ids are invalid. Ids must be integers."
+    return parsed, None
+
+
+def bboxes_shape(bboxes: list):
+    """
+    Union of bounding boxes
+    :param bboxes: List of bounding boxes (min_lon, min_lat, max_lon, max_lat)
+    :return: shapely geometry
+    """
+    from shapely.geometry import box
+    from shapely.ops import unary_union
+
+    return unary_union([box(*bbox) for bbox in bboxes])
+
+
+def geometry_shape(geometry: dict, buffer: float = 0):
+    """
+    Parse a GeoJSON geometry and buffer it
+    :param geometry: GeoJSON geometry or feature in geographic coordinates
+    :param buffer: Buffer in degree. Required for points and lines.
+    :return: shapely geometry or False, error message
+    """
+    from shapely.errors import ShapelyError
+    from shapely.geometry import shape
+
+    if isinstance(geometry, dict) and geometry.get("type") == "Feature":
+        geometry = geometry.get("geometry")
+    try:
+        region = shape(geometry)
+    except (AttributeError, KeyError, TypeError, ValueError, ShapelyError):
+        return False, "Geometry is invalid. Required format: GeoJSON geometry."
+    if buffer < 0:
+        return False, "Buffer must not be negative."
+    if buffer > 0:
+        region = region.buffer(buffer)
+    if region.is_empty or region.area == 0:
+        return False, "Geometry has no area. Points and lines require a buffer."
+    return region, None
+
+
+def check_area(region, max_area: float):
+    """
+    Check if the total area of the requested region is lower than maximum
+    :param region: shapely geometry
+    :param max_area: Maximum area in square degree
+    :return:
+    """
+    if region.area > max_area:
+        return (
+            False,
+            f"Requested area is too big. The maximum total area is {max_area:g} square degree.",
+        )
+    return True, None
+
+
+def parse_hours(hours: str = None, hour_from: int = None, hour_to: int = None):
+    """
+    Parse the requested hours of day
+    :param hours: Comma separated hours of day, e.g. "7,8,17"
+    :param hour_from: First hour of a time window
+    :param hour_to: Last hour of a time window (inclusive). If it is smaller than
+    hour_from, the window wraps around midnight.
+    :return: Sorted list of hours or None if all hours are requested, error message
+    """
+    if hours is None and hour_from is None and hour_to is None:
+        return None, None
+    if hours is not None and (hour_from is not None or hour_to is not None):
+        return False, "Either hours or hour_from and hour_to can be specified."
+    try:
+        if hours is not None:
+            selected = {int(x) for x in hours.split(",") if x.strip() != ""}
+        else:
+            first = 0 if hour_from is None else int(hour_from)
+            last = 23 if hour_to is None else int(hour_to)
+            if first <= last:
+                selected = set(range(first, last + 1))
+            else:
+                selected = set(range(first, 24)) | set(range(0, last + 1))
+    except (AttributeError, TypeError, ValueError):
+        return (
+            False,
+            "Hours are invalid. Hours of day must be integers between 0 and 23.",
+        )
+    if not selected or min(selected) < 0 or max(selected) > 23:
+        return (
+            False,
+            "Hours are invalid. Hours of day must be integers between 0 and 23.",
+        )
+    return sorted(selected), None
+
+
+def parse_body_hours(body: dict):
+    """
+    Parse the requested hours of day of a JSON body
+    :param body: JSON body with hours as integer or list of integers, or hour_from
+    and hour_to as integers
+    :return: Sorted list of hours or None if all hours are requested, error message
+    """
+    message = "Hours are invalid. Hours of day must be integers between 0 and 23."
+    hours = body.get("hours")
+    if isinstance(hours, list):
+        if not all(type(hour) is int for hour in hours):
+            return False, message
+        hours = ",".join(str(hour) for hour in hours)
+    elif type(hours) is int:
+        hours = str(hours)
+    elif hours is not None:
+        return False, message
+    hour_from = body.get("hour_from")
+    hour_to = body.get("hour_to")
+    if any(hour is not None and type(hour) is not int for hour in (hour_from, hour_to)):
+        return False, message
+    return parse_hours(hours, hour_from, hour_to)
+
+
 def init_logger(name, log_file=None):
     """
     Set up a logger instance with stream and file logger
@@ -79,3 +276,68 @@ def init_logger(name, log_file=None):
         filehandler.setFormatter(formatter)
         logger.addHandler(filehandler)
     return logger
+
+
+def env_flag(name: str, default: bool = False):
+    """
+    Read a boolean flag from the environment
+    :param name: Name of the environment variable
+    :param default: Value if the variable is not set
+    :return: bool
+    """
+    value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def encode_csv(rows):
+    """
+    Encode rows as CSV
+    :param rows: Iterable of row tuples
+    :return: bytes
+    """
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator="\n").writerows(rows)
+    return buffer.getvalue().encode()
+
+
+def csv_chunks(batches, columns: list):
+    """
+    Encode batches of rows as CSV
+    :param batches: Iterable of lists of row tuples
+    :param columns: Column names written as header
+    :return: Generator of bytes, one chunk per batch
+    """
+    yield encode_csv([columns])
+    for rows in batches:
+        yield encode_csv(rows)
+
+
+def float32_box(bbox):
+    """
+    Round a bounding box outwards to single precision. PostGIS stores the
+    bounding boxes of geometries as floats, so the && operator compares these rounded boxes.
+    :param bbox: Bounding box (min_lon, min_lat, max_lon, max_lat)
+    :return: Tuple of rounded coordinates
+    """
+    min_lon, min_lat, max_lon, max_lat = (np.float32(x) for x in bbox)
+    if float(min_lon) > bbox[0]:
+        min_lon = np.nextafter(min_lon, np.float32(-np.inf))
+    if float(min_lat) > bbox[1]:
+        min_lat = np.nextafter(min_lat, np.float32(-np.inf))
+    if float(max_lon) < bbox[2]:
+        max_lon = np.nextafter(max_lon, np.float32(np.inf))
+    if float(max_lat) < bbox[3]:
+        max_lat = np.nextafter(max_lat, np.float32(np.inf))
+    return float(min_lon), float(min_lat), float(max_lon), float(max_lat)
+
+
+def boxes_overlap(a, b):
+    """
+    Check if two bounding boxes overlap or touch
+    :param a: Bounding box (min_lon, min_lat, max_lon, max_lat)
+    :param b: Bounding box (min_lon, min_lat, max_lon, max_lat)
+    :return: bool
+    """
+    return a[0] <= b[2] and a[2] >= b[0] and a[1] <= b[3] and a[3] >= b[1]